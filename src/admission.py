@@ -0,0 +1,166 @@
+"""
+ANSIBLE-LINK class for job admission
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import time
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+class ControllerLoad:
+    """load average per cpu and available memory of the controller from /proc, read at most once per interval"""
+
+    def __init__(self, proc_dir='/proc', interval=1):
+        self.proc_dir = Path(proc_dir)
+        self.interval = interval
+        self.cpus = os.cpu_count() or 1
+        self._sample = (None, None)
+        self._sampled_at = None
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """(1 minute load average per cpu, available memory in bytes), None where /proc can't tell"""
+        with self._lock:
+            now = time.monotonic()
+            if self._sampled_at is None or now - self._sampled_at >= self.interval:
+                self._sample = (self._load(), self._available_memory())
+                self._sampled_at = now
+            return self._sample
+
+    def load(self):
+        return self.sample()[0]
+
+    def available_memory(self):
+        return self.sample()[1]
+
+    def _load(self):
+        try:
+            with open(self.proc_dir / 'loadavg', 'r') as f:
+                return float(f.read().split()[0]) / self.cpus
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _available_memory(self):
+        try:
+            with open(self.proc_dir / 'meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+class AdmissionController:
+    """budgets the forks of the jobs running in this process, delays or downscales jobs beyond it or on a loaded controller"""
+
+    def __init__(self, load=None, **settings):
+        self.load = load or ControllerLoad()
+        self._granted = {}  # job_id -> forks
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self.configure(**settings)
+
+    def configure(self, enabled=True, max_forks=0, max_forks_per_job=0, playbooks=None, downscale=True, min_forks=1,
+                  max_load=0, min_available_memory=0, memory_per_fork=0, poll_interval=1):
+        # also applied to a running controller by a config reload, jobs already admitted keep their forks
+        with self._cond:
+            self.enabled = enabled
+            self.max_forks = max_forks
+            self.max_forks_per_job = max_forks_per_job
+            self.playbook_caps = playbooks or {}
+            self.downscale = downscale
+            self.min_forks = max(1, min_forks)
+            self.max_load = max_load
+            self.min_available_memory = min_available_memory
+            self.memory_per_fork = memory_per_fork
+            self.poll_interval = poll_interval
+            self._cond.notify_all()
+
+    def forks_in_use(self):
+        with self._cond:
+            return sum(self._granted.values())
+
+    def waiting(self):
+        return self._waiting
+
+    def capped_forks(self, playbook, forks):
+        """forks of a request after the per job and per playbook caps"""
+        for cap in (self.max_forks_per_job or self.max_forks, self.playbook_caps.get(playbook)):
+            if cap:
+                forks = min(forks, cap)
+        return forks
+
+    def acquire(self, job_id, playbook, forks, cancelled=None):
+        """blocks until the job may start, returns (forks, result) with result 'admitted', 'downscaled' or 'delayed'
+        (admitted after waiting), or (None, 'cancelled') when cancelled() turned true while waiting"""
+        if not self.enabled:
+            with self._cond:
+                self._granted[job_id] = forks
+            return forks, 'admitted'
+
+        forks = self.capped_forks(playbook, forks)
+        delayed = False
+        with self._cond:
+            self._waiting += 1
+        try:
+            while True:
+                # sampled outside the lock, /proc reads must not block releases
+                load, memory = self.load.sample()
+                with self._cond:
+                    granted, reason = self._decide(forks, load, memory)
+                    if granted:
+                        self._granted[job_id] = granted
+                        break
+                    if not delayed:
+                        logger.info(f"Job {job_id} delayed: {reason}")
+                        delayed = True
+                    self._cond.wait(self.poll_interval)
+                if cancelled and cancelled():
+                    return None, 'cancelled'
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+        if granted < forks:
+            logger.info(f"Job {job_id} admitted with {granted} of {forks} forks: {reason}")
+            return granted, 'downscaled'
+        return granted, 'delayed' if delayed else 'admitted'
+
+    def release(self, job_id):
+        with self._cond:
+            if self._granted.pop(job_id, None) is not None:
+                self._cond.notify_all()
+
+    def _decide(self, forks, load, memory):
+        """(forks to grant, reason), 0 forks when the job has to wait"""
+        in_use = self.forks_in_use()
+        # an idle controller always starts a job, a loaded host or an oversized job never waits forever
+        if self._granted:
+            if self.max_load and load is not None and load > self.max_load:
+                return 0, f"load {load:.2f} per cpu above {self.max_load}"
+            if self.min_available_memory and memory is not None and memory < self.min_available_memory:
+                return 0, f"{memory // MB} MB memory available, below {self.min_available_memory // MB} MB"
+
+        available, limit = forks, None
+        if self.max_forks and self.max_forks - in_use < available:
+            available, limit = self.max_forks - in_use, f"{in_use} of {self.max_forks} forks in use"
+        if self.memory_per_fork and memory is not None:
+            by_memory = (memory - self.min_available_memory) // self.memory_per_fork
+            if by_memory < available:
+                available, limit = by_memory, f"{memory // MB} MB memory available for {by_memory} forks"
+        if not self._granted:
+            available = max(available, min(forks, self.min_forks) if self.downscale else forks)
+
+        if available >= forks:
+            return forks, None
+        if self.downscale and available >= self.min_forks:
+            return int(available), limit
+        return 0, limit
@@ -8,23 +8,41 @@ License: MPL2
 
 import os
 import re
+import time
 import uuid
-import yaml
+import gzip
+import json
 import base64
 import logging
 import threading
 from datetime import datetime
 from pathlib import Path
+from dataclasses import replace
+from urllib.parse import urlencode
 
-import ansible_runner
-from ansible_runner.config.runner import RunnerConfig
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_restx import Api, Resource, fields
-from prometheus_client import Counter, Histogram, Gauge, start_http_server
+from prometheus_client import Counter, Histogram, Gauge
 
 from version import VERSION
-from webhook import WebhookSender
-from job_storage import JobStorage
+from webhook import WebhookSender, WebhookMetrics
+from job_storage import create_job_storage, encode_cursor, INDEXED_FIELDS
+from scheduler import JobScheduler, SchedulerFull, PRIORITIES
+from events import EventBroadcaster
+from playbook_index import PlaybookIndex
+from inventory import InventoryCache, InventoryError
+from validation import PlaybookRequestValidator
+from dedup import JobDeduplicator, spec_key
+from retention import RetentionManager, RetentionMetrics
+from executor import create_executor, CancelToken
+from coordination import LeaderLock, MetricsExporter, SlotLeases, GaugeSampler
+from timings import TimingAggregator
+from event_index import EventIndexer, artifact_events, event_row
+from compression import iter_file
+from startup import StartupTimer, gunicorn_preload
+from admission import AdmissionController, MB
+from sharding import partition_hosts, shard_limit, merge_stats, combined_status
+from config_reload import ConfigError, ConfigWatcher, read_config, resolve_paths, config_digest, changed_keys, keep_restart_keys, install_reload_signal
 
 app = Flask(__name__)
 prefix=f'/api/v{VERSION.split(".")[0]}'
@@ -38,6 +56,23 @@ api = Api(app,
 
 ns = api.namespace('ansible', description='Ansible operations')
 
+# job_id -> TimingAggregator of the jobs running in this process
+live_timings = {}
+# job_id -> CancelToken of the jobs running in this process
+running_jobs = {}
+# pid of the process that started its services, differs from os.getpid() in a freshly forked worker
+services_pid = None
+# set in a gunicorn master that imported the app with --preload
+preloaded = False
+# digest of the config file content in use, reload_config() swaps config only when it changed
+config_version = None
+config_lock = threading.Lock()
+
+# statuses of jobs that are not done yet
+ACTIVE_STATUSES = ('pending', 'running', 'cancelling')
+RUNNER_STATUSES = {'successful': 'completed', 'canceled': 'cancelled', 'timeout': 'timed_out'}
+JOB_WEBHOOK_EVENTS = {'cancelled': 'job_cancelled', 'timed_out': 'job_timed_out'}
+
 playbook_model = api.model('PlaybookRequest', {
     'playbook': fields.String(required=True, description='Playbook name (e.g., "site.yml")'),
     'inventory': fields.String(description='Inventory file name. If not provided, the default inventory will be used.'),
@@ -47,112 +82,107 @@ playbook_model = api.model('PlaybookRequest', {
     'limit': fields.String(description='Limit the playbook run to specific hosts or groups (e.g., "webservers,dbservers")'),
     'tags': fields.String(description='Comma-separated string of tags to run in the playbook (e.g., "tag1,tag2")'),
     'skip_tags': fields.String(description='Comma-separated string of tags to skip in the playbook (e.g., "tag3,tag4")'),
-    'cmdline': fields.String(description='Custom command-line arguments for Ansible')
+    'cmdline': fields.String(description='Custom command-line arguments for Ansible'),
+    'priority': fields.String(description='Scheduling priority ("high", "normal", "low"). Default is "normal".', default='normal', enum=list(PRIORITIES)),
+    'timeout': fields.Integer(description='Seconds the job may run before it is stopped as "timed_out", 0 for no limit. Default from the timeouts config.', min=0),
+    'shards': fields.Integer(description='Split the hosts matching "limit" into this many parallel child jobs. Default is one job.', min=1)
 })
 
 job_model = api.model('JobResponse', {
     'job_id': fields.String(description='Unique job ID (UUID)'),
-    'status': fields.String(description='Current job status ("pending", "running", "completed", "failed", "error")'),
+    'status': fields.String(description='Current job status ("pending", "running", "cancelling", "completed", "failed", "error", "rejected", "cancelled", "timed_out")'),
+    'errors': fields.List(fields.String, description='List of error messages, if any', allow_none=True),
+    'deduplicated': fields.String(description='"inflight" or "cached" when an identical existing job answered the request', allow_none=True),
+    'shard_job_ids': fields.List(fields.String, description='IDs of the child jobs of a sharded job, in host order', allow_none=True)
+})
+
+batch_model = api.model('BatchRequest', {
+    'jobs': fields.List(fields.Nested(playbook_model), description='Job specs, one job each'),
+    'playbook': fields.String(description='Playbook for every job, when one spec is fanned out over "limit"'),
+    'limit': fields.List(fields.String, description='One job per host pattern, the other fields of the spec are shared'),
+    'max_parallel': fields.Integer(description='Max jobs of the batch running at the same time. Default is no limit.'),
+    'stop_on_failure': fields.Boolean(description='Cancel the queued jobs of the batch once one fails. Default is false.', default=False)
+})
+
+batch_response_model = api.model('BatchResponse', {
+    'batch_id': fields.String(description='Unique batch ID (UUID)'),
+    'status': fields.String(description='Batch status ("pending", "error", "rejected")'),
+    'job_ids': fields.List(fields.String, description='IDs of the jobs in the batch, in request order', allow_none=True),
     'errors': fields.List(fields.String, description='List of error messages, if any', allow_none=True)
 })
 
+validation_model = api.model('ValidationResponse', {
+    'valid': fields.Boolean(description='Whether the request would be accepted by POST /playbook'),
+    'errors': fields.List(fields.String, description='All validation errors'),
+    'request': fields.Raw(description='The normalized request, if valid', allow_none=True)
+})
+
 available_playbooks_model = api.model('AvailablePlaybooks', {
     'playbooks': fields.List(fields.String, description='List of available playbook paths')
 })
 
+def config_file():
+    return os.environ.get('ANSIBLE_LINK_CONFIG_PATH', Path(__file__).parent.absolute() / 'config.yml')
+
 def load_config():
-    current_dir = Path(__file__).parent.absolute()
-    default_config_path = current_dir / 'config.yml'
-    config_path = os.environ.get('ANSIBLE_LINK_CONFIG_PATH', default_config_path)
+    config_path = config_file()
     print(f"{datetime.now().isoformat()} - INFO - Loading configuration from {config_path}")
     try:
-        with open(config_path, 'r') as f:
-            config = yaml.safe_load(f)
+        config, _ = read_config(config_path)
 
         # resolve relative paths
-        for key in ['playbook_dir', 'inventory_file', 'job_storage_dir']:
-            if key in config and not os.path.isabs(config[key]):
-                config[key] = os.path.abspath(os.path.join(current_dir, config[key]))
-                print(f"{datetime.now().isoformat()} - INFO - Resolved {key} to {config[key]}")
+        for key in resolve_paths(config, Path(__file__).parent.absolute()):
+            print(f"{datetime.now().isoformat()} - INFO - Resolved {key} to {config[key]}")
 
         return config
     except Exception as e:
         print(f"{datetime.now().isoformat()} - ERROR - Failed to load configuration: {e} - is ANSIBLE_LINK_CONFIG_PATH set correctly?")
         raise
 
-def validate_playbook(playbook):
-    playbook_path = Path(config['playbook_dir']) / playbook
-    if not playbook_path.is_file():
-        raise ValueError(f"Playbook {playbook_path} not found")
-    if playbook_path.suffix not in ['.yml', '.yaml']:
-        raise ValueError(f"Invalid playbook file type: {playbook}")
-
-    if compiled_whitelist and not any(pattern.match(playbook) for pattern in compiled_whitelist):
-        raise ValueError(f"Playbook {playbook} is not in the whitelist")
-
-    return str(playbook_path)
-
-def validate_playbook_request(data, config):
-    errors = []
-
-    try:
-        playbook_path = validate_playbook(data['playbook'])
-    except ValueError as e:
-        errors.append(str(e))
-    else:
-        data['playbook_path'] = playbook_path
-
-    if 'inventory' in data:
-        inventory_path = Path(data['inventory'])
-        if not inventory_path.is_absolute():
-            inventory_path = Path(__file__).parent.absolute() / inventory_path
-    else:
-        inventory_path = Path(config['inventory_file'])
-    
-    if not inventory_path.is_file():
-        errors.append(f"Inventory file not found: {inventory_path}")
-    data['inventory_path'] = str(inventory_path)
-
-    if 'vars' in data and not isinstance(data['vars'], dict):
-        errors.append("'vars' must be a dictionary")
-
-    if 'forks' in data:
-        try:
-            forks = int(data['forks'])
-            if forks < 1:
-                errors.append("'forks' must be a positive integer")
-        except ValueError:
-            errors.append("'forks' must be an integer")
-
-    if 'verbosity' in data:
-        try:
-            verbosity = int(data['verbosity'])
-            if verbosity not in range(5):  # 0 to 4
-                errors.append("'verbosity' must be an integer between 0 and 4")
-        except ValueError:
-            errors.append("'verbosity' must be an integer")
-
-    if 'limit' in data and not isinstance(data['limit'], str):
-        errors.append("'limit' must be a string")
-
-    for tag_field in ['tags', 'skip_tags']:
-        if tag_field in data:
-            if not isinstance(data[tag_field], str):
-                errors.append(f"'{tag_field}' must be a comma-separated string")
-            else:
-                tags = data[tag_field].split(',')
-                for tag in tags:
-                    if not re.match(r'^[a-zA-Z0-9_]+$', tag.strip()):
-                        errors.append(f"Invalid tag in '{tag_field}': {tag}")
-
-    if 'cmdline' in data and not isinstance(data['cmdline'], str):
-        errors.append("'cmdline' must be a string")
-
-    return errors
-
-def run_playbook(job_id, playbook_path, inventory_path, vars, forks=5, verbosity=0, limit=None, tags=None, skip_tags=None, cmdline=None):
+def run_playbook(job_id, playbook_path, inventory_path, vars, forks=5, verbosity=0, limit=None, tags=None, skip_tags=None, cmdline=None, timeout=None):
+    # waits while the forks budget, cpu or memory of the controller is exhausted, may lower forks
+    requested_forks = forks
+    forks = admit_job(job_id, playbook_path, forks)
+
+    # DELETE /job/<job_id> may have cancelled it while queued, possibly from another worker process
+    if forks is None or not job_storage.update_job_status_if(job_id, 'running', ['pending']):
+        admission_controller.release(job_id)
+        logger.info(f"Job {job_id} was cancelled before it started")
+        event_broadcaster.publish(job_id, 'status', {'status': 'cancelled'})
+        event_broadcaster.close(job_id)
+        return 'cancelled'
+
+    # a reload replaces config, this job keeps running with the one it started with
+    job_config = config
     ACTIVE_JOBS.inc()
     start_time = datetime.now()
+    event_broadcaster.publish(job_id, 'status', {'status': 'running'})
+    if forks != requested_forks:
+        event_broadcaster.publish(job_id, 'admission', {'forks': forks, 'requested_forks': requested_forks})
+    output_log = job_storage.open_output_log(job_id)
+    timings = live_timings[job_id] = TimingAggregator(observer=task_duration_observer(playbook_path, job_config))
+    # the other worker processes only see the timings in the storage
+    timings_interval = job_config.get('timings', {}).get('save_interval', 10)
+    timings_saved = time.monotonic()
+    indexer = event_indexer(job_id, job_config)
+    poll_interval = job_config.get('timeouts', {}).get('poll_interval', 1)
+    cancel_token = running_jobs[job_id] = CancelToken(timeout, check=lambda: job_status(job_id) == 'cancelling',
+                                                      check_interval=poll_interval)
+    finished = False
+
+    def finish():
+        # before the terminal status, a client seeing it finds the forks released and the output and timings saved
+        nonlocal finished
+        if finished:
+            return
+        finished = True
+        running_jobs.pop(job_id, None)
+        admission_controller.release(job_id)
+        if indexer:
+            indexer.flush()
+        output_log.close()
+        compress_output(job_id, job_config)
+        save_timings(job_id)
 
     webhook_sender.send("job_started", {
         "job_id": job_id,
@@ -164,7 +194,7 @@ def run_playbook(job_id, playbook_path, inventory_path, vars, forks=5, verbosity
         job_private_data_dir = job_storage_dir / job_id
         job_private_data_dir.mkdir(parents=True, exist_ok=True)
 
-        runner_config = RunnerConfig(
+        runner_kwargs = dict(
             private_data_dir=str(job_private_data_dir),
             playbook=playbook_path,
             inventory=inventory_path,
@@ -175,44 +205,66 @@ def run_playbook(job_id, playbook_path, inventory_path, vars, forks=5, verbosity
             tags=tags,
             skip_tags=skip_tags,
             cmdline=cmdline,
-            suppress_ansible_output=config.get('suppress_ansible_output', False),
-            omit_event_data=config.get('omit_event_data', False),
-            only_failed_event_data=config.get('only_failed_event_data', False)
+            suppress_ansible_output=job_config.get('suppress_ansible_output', False),
+            omit_event_data=job_config.get('omit_event_data', False),
+            only_failed_event_data=job_config.get('only_failed_event_data', False),
+            # how often ansible-runner asks cancel_token whether to stop
+            settings={'pexpect_timeout': poll_interval}
         )
-        logger.debug(f"RunnerConfig: {runner_config.__dict__}")
 
-        runner_config.prepare()
+        def on_event(stdout, summary):
+            nonlocal timings_saved
+            if stdout:
+                output_log.write(stdout + '\n')
+            timings.add(summary)
+            if timings_interval and time.monotonic() - timings_saved >= timings_interval:
+                timings_saved = time.monotonic()
+                save_timings(job_id, timings)
+            if indexer:
+                indexer.add(summary)
+            event_broadcaster.publish(job_id, 'runner_event', summary)
+
+        def on_status(runner_status):
+            event_broadcaster.publish(job_id, 'runner_status', {'status': runner_status})
 
-        runner = ansible_runner.Runner(config=runner_config)
-        ansible_command = ' '.join(runner.config.command)
-        logger.info(f"Runner: {ansible_command}")
-        result = runner.run()
+        result = job_executor.execute(job_id, runner_kwargs, on_event, on_status, cancel_token)
 
-        logger.debug(f"Runner result: {result}")
+        status = RUNNER_STATUSES.get(result['status'], 'failed')
+        if status == 'cancelled':
+            status = cancel_token.reason or status
 
-        status = 'completed' if runner.status == 'successful' else 'failed'
+        if result['stdout']:
+            output_log.write(result['stdout'])
+        finish()
 
         job_storage.update_job_status(job_id, status)
         job_storage.save_job_output(job_id, 
-                                    runner.stdout.read(), 
-                                    runner.stderr.read(), 
-                                    runner.stats,
-                                    ansible_command)
+                                    None, 
+                                    result['stderr'], 
+                                    result['stats'],
+                                    result['command'])
+        event_broadcaster.publish(job_id, 'status', {'status': status, 'stats': result['stats']})
 
-        logger.info(f"Job {job_id} completed with status: {status} | {runner.status}")
+        logger.info(f"Job {job_id} completed with status: {status} | {result['status']}")
 
         PLAYBOOK_RUNS.labels(playbook=playbook_path, status=status).inc()
 
-        webhook_sender.send("job_completed", {
+        webhook_sender.send(JOB_WEBHOOK_EVENTS.get(status, "job_completed"), {
             "job_id": job_id,
             "playbook": playbook_path,
             "status": status
         })
+        return status
 
     except Exception as e:
         logger.error(f"Error in job {job_id}: {str(e)}")
+        try:
+            finish()
+        except Exception as finish_error:
+            logger.error(f"Failed to finish job {job_id}: {str(finish_error)}")
         job_storage.update_job_status(job_id, 'error')
-        job_storage.save_job_output(job_id, '', str(e), {})
+        job_storage.save_job_output(job_id, None, str(e), {})
+        event_broadcaster.publish(job_id, 'status', {'status': 'error', 'error': str(e)})
 
         PLAYBOOK_RUNS.labels(playbook=playbook_path, status='error').inc()
 
@@ -222,11 +274,144 @@ def run_playbook(job_id, playbook_path, inventory_path, vars, forks=5, verbosity
             "status": "error",
             "error": str(e)
         })
+        return 'error'
     finally:
+        finish()
+        event_broadcaster.close(job_id)
         ACTIVE_JOBS.dec()
         duration = (datetime.now() - start_time).total_seconds()
         PLAYBOOK_DURATION.labels(playbook=playbook_path).observe(duration)
 
+def admit_job(job_id, playbook_path, forks):
+    """the forks the job may start with, None if it was cancelled while waiting for admission"""
+    playbook = os.path.relpath(playbook_path, config['playbook_dir'])
+    forks, result = admission_controller.acquire(job_id, playbook, forks, cancelled=lambda: job_status(job_id) != 'pending')
+    ADMISSION_DECISIONS.labels(result=result).inc()
+    return forks
+
+def admission_settings(config):
+    admission_config = config.get('admission', {})
+    return dict(enabled=admission_config.get('enabled', False),
+                max_forks=admission_config.get('max_forks', 0),
+                max_forks_per_job=admission_config.get('max_forks_per_job', 0),
+                playbooks=admission_config.get('playbooks'),
+                downscale=admission_config.get('downscale', True),
+                min_forks=admission_config.get('min_forks', 1),
+                max_load=admission_config.get('max_load', 0),
+                min_available_memory=admission_config.get('min_available_memory_mb', 0) * MB,
+                memory_per_fork=admission_config.get('memory_per_fork_mb', 0) * MB,
+                poll_interval=admission_config.get('poll_interval', 1))
+
+def compress_output(job_id, job_config=None):
+    output_config = (job_config or config).get('output', {})
+    if not output_config.get('compress', True):
+        return
+    try:
+        saved = job_storage.compress_output(job_id, level=output_config.get('level', 6),
+                                            segment_size=output_config.get('segment_size', 1024 * 1024))
+        logger.debug(f"Compressed output of job {job_id}, {saved} bytes saved")
+    except Exception as e:
+        logger.error(f"Failed to compress output of job {job_id}: {str(e)}")
+
+def job_status(job_id):
+    return (job_storage.get_job(job_id) or {}).get('status')
+
+def task_duration_observer(playbook_path, job_config=None):
+    if not (job_config or config).get('timings', {}).get('metrics', False):
+        return None
+    return lambda duration, result: TASK_DURATION.labels(playbook=playbook_path, result=result).observe(duration)
+
+def save_timings(job_id, timings=None):
+    # without timings the job is done and its aggregator is dropped
+    if timings is None:
+        timings = live_timings.pop(job_id, None)
+    if timings is None:
+        return
+    try:
+        summary = timings.summary()
+        if summary['task_count']:
+            job_storage.save_job_timings(job_id, summary)
+    except Exception as e:
+        logger.error(f"Failed to save timings of job {job_id}: {str(e)}")
+
+def event_indexer(job_id, job_config=None):
+    index_config = (job_config or config).get('event_index', {})
+    if not index_config.get('enabled', True):
+        return None
+    return EventIndexer(job_storage, job_id,
+                        batch_size=index_config.get('batch_size', 200),
+                        flush_interval=index_config.get('flush_interval', 2),
+                        stdout_limit=index_config.get('stdout_limit', 4096))
+
+def index_artifact_events(job_id):
+    # jobs run before the index existed (or with it disabled) are indexed from their runner artifacts once
+    if job_storage.has_job_events(job_id):
+        return
+    stdout_limit = config.get('event_index', {}).get('stdout_limit', 4096)
+    rows = [row for row in (event_row(event, stdout_limit) for event in artifact_events(job_storage_dir / job_id)) if row]
+    if rows:
+        job_storage.save_job_events(job_id, rows)
+        logger.info(f"Indexed {len(rows)} events of job {job_id} from its runner artifacts")
+
+def run_batch_job(batch_id, stop_on_failure, job_id, *args):
+    status = run_playbook(job_id, *args)
+    if stop_on_failure and status != 'completed':
+        cancelled = job_scheduler.cancel_group(batch_id)
+        if cancelled:
+            cancel_jobs(cancelled)
+            logger.warning(f"Job {job_id} of batch {batch_id} {status}, cancelled {len(cancelled)} queued jobs")
+
+def run_deduplicated_job(deduplicator, dedup_key, playbook, job_id, *args):
+    # the deduplicator that registered the job, a reload may have replaced or disabled the global one since
+    status = 'error'
+    try:
+        status = run_playbook(job_id, *args)
+    finally:
+        deduplicator.finish(dedup_key, job_id, status, playbook)
+
+def cancel_jobs(job_ids, status='cancelled'):
+    job_storage.update_jobs_status(job_ids, status)
+    for job_id in job_ids:
+        event_broadcaster.publish(job_id, 'status', {'status': status})
+        event_broadcaster.close(job_id)
+
+def job_record(playbook_request, **extra):
+    return dict({
+        'status': 'pending',
+        'playbook': playbook_request.playbook_path,
+        'inventory': playbook_request.inventory_path,
+        'vars': playbook_request.vars,
+        'forks': playbook_request.forks,
+        'verbosity': playbook_request.verbosity,
+        'limit': playbook_request.limit,
+        'tags': playbook_request.tags,
+        'skip_tags': playbook_request.skip_tags,
+        'cmdline': playbook_request.cmdline,
+        'priority': playbook_request.priority,
+        'timeout': playbook_request.timeout,
+        'start_time': datetime.now().isoformat(),
+    }, **extra)
+
+def run_playbook_args(job_id, playbook_request):
+    return (
+        job_id,
+        playbook_request.playbook_path,
+        playbook_request.inventory_path,
+        playbook_request.vars,
+        playbook_request.forks,
+        playbook_request.verbosity,
+        playbook_request.limit,
+        playbook_request.tags,
+        playbook_request.skip_tags,
+        playbook_request.cmdline,
+        playbook_request.timeout
+    )
+
+def queue_full_response():
+    retry_after = config.get('scheduler', {}).get('retry_after', 30)
+    logger.warning(f"Job queue full ({job_scheduler.queue_depth()} pending), rejecting request")
+    return {'job_id': None, 'status': 'error', 'errors': ['Job queue is full, retry later']}, 429, {'Retry-After': str(retry_after)}
+
 @ns.route('/playbook')
 class AnsiblePlaybook(Resource):
     @ns.expect(playbook_model)
@@ -235,121 +420,1019 @@ class AnsiblePlaybook(Resource):
         try:
             data = api.payload
             logger.debug(f"Received /playbook request: {data}")
-            validation_errors = validate_playbook_request(data, config)
+            playbook_request, validation_errors = request_validator.validate(data)
             if validation_errors:
                 logger.error(f"Validation errors: {validation_errors}")
                 return {'job_id': None, 'status': 'error', 'errors': validation_errors}, 400
 
+            if playbook_request.shards and playbook_request.shards > 1:
+                return submit_sharded_job(playbook_request)
+
             job_id = str(uuid.uuid4())
-            job_data = {
-                'status': 'pending',
-                'playbook': data['playbook_path'],
-                'inventory': data['inventory_path'],
-                'vars': data.get('vars', {}),
-                'forks': data.get('forks', 5),
-                'verbosity': data.get('verbosity', 0),
-                'limit': data.get('limit'),
-                'tags': data.get('tags'),
-                'skip_tags': data.get('skip_tags'),
-                'cmdline': data.get('cmdline'),
-                'start_time': datetime.now().isoformat(),
-            }
-            job_storage.save_job(job_id, job_data)
-
-            threading.Thread(target=run_playbook, args=(
-                job_id, 
-                data['playbook_path'],
-                data['inventory_path'],
-                data.get('vars', {}),
-                data.get('forks', 5),
-                data.get('verbosity', 0),
-                data.get('limit'),
-                data.get('tags'),
-                data.get('skip_tags'),
-                data.get('cmdline')
-            )).start()
-
-            logger.info(f"Started job {job_id} for playbook {data['playbook']}")
-            return {'job_id': job_id, 'status': 'running', 'errors': None}, 202
+            func, args = run_playbook, run_playbook_args(job_id, playbook_request)
+
+            dedup_key = None
+            deduplicator = job_deduplicator
+            if deduplicator and deduplicator.ttl_for(playbook_request.playbook) is not None:
+                dedup_key = spec_key(playbook_request)
+                existing = deduplicator.acquire(dedup_key, job_id)
+                if existing:
+                    existing_job_id, result = existing
+                    DEDUP_REQUESTS.labels(result=result).inc()
+                    existing_job = job_storage.get_job(existing_job_id) or {}
+                    logger.info(f"Request for playbook {playbook_request.playbook} answered by {result} job {existing_job_id}")
+                    return {'job_id': existing_job_id, 'status': existing_job.get('status', 'pending'),
+                            'errors': None, 'deduplicated': result}, 200 if result == 'cached' else 202
+                DEDUP_REQUESTS.labels(result='miss').inc()
+                func, args = run_deduplicated_job, (deduplicator, dedup_key, playbook_request.playbook) + args
+
+            # shed load before touching storage
+            if job_scheduler.is_full():
+                if dedup_key:
+                    deduplicator.release(dedup_key, job_id)
+                return queue_full_response()
+
+            job_storage.save_job(job_id, job_record(playbook_request))
+            event_broadcaster.open(job_id)
+
+            try:
+                job_scheduler.submit(job_id, func, args=args, priority=playbook_request.priority)
+            except SchedulerFull:
+                if dedup_key:
+                    deduplicator.release(dedup_key, job_id)
+                job_storage.update_job_status(job_id, 'rejected')
+                event_broadcaster.close(job_id)
+                return queue_full_response()
+
+            logger.info(f"Queued job {job_id} for playbook {playbook_request.playbook}")
+            return {'job_id': job_id, 'status': 'pending', 'errors': None}, 202
         except Exception as e:
             logger.error(f"Error starting playbook: {str(e)}")
             return {'job_id': None, 'status': 'error', 'errors': [str(e)]}, 400
 
+def submit_sharded_job(playbook_request):
+    """queues one child job per shard of the hosts matching the limit, the parent job combines their results"""
+    try:
+        hosts = inventory_cache.resolve(playbook_request.inventory_path, playbook_request.limit)
+    except InventoryError as e:
+        return {'job_id': None, 'status': 'error', 'errors': [f"Cannot resolve the hosts to shard: {str(e)}"]}, 400
+    shards = partition_hosts(hosts, playbook_request.shards)
+    if not shards:
+        return {'job_id': None, 'status': 'error', 'errors': [f"No hosts to shard in {playbook_request.inventory_path}"]}, 400
+    if job_scheduler.free_slots() < len(shards):
+        return queue_full_response()
+
+    job_id = str(uuid.uuid4())
+    shard_requests = {}
+    try:
+        for shard_hosts in shards:
+            # in the private data dir of the shard, removed with it by retention
+            shard_id = str(uuid.uuid4())
+            limit = shard_limit(shard_hosts, job_storage_dir / shard_id / 'limit')
+            shard_requests[shard_id] = replace(playbook_request, limit=limit, shards=None)
+    except OSError as e:
+        logger.error(f"Failed to write the host lists of the shards of job {job_id}: {str(e)}")
+        return {'job_id': None, 'status': 'error', 'errors': [f"Cannot write the host lists of the shards: {str(e)}"]}, 500
+    job_storage.save_job(job_id, job_record(playbook_request, shards=len(shards), hosts=len(hosts)))
+    # the shards are a batch named after the parent job
+    job_storage.save_batch(job_id, {'parent_id': job_id, 'created': datetime.now().isoformat()},
+                           {shard_id: job_record(shard_request, batch_id=job_id, parent_id=job_id, shard=index)
+                            for index, (shard_id, shard_request) in enumerate(shard_requests.items())})
+    for shard_id in [job_id, *shard_requests]:
+        event_broadcaster.open(shard_id)
+
+    try:
+        job_scheduler.submit_many([
+            (shard_id, run_shard_job, (job_id,) + run_playbook_args(shard_id, shard_request), shard_request.priority)
+            for shard_id, shard_request in shard_requests.items()
+        ], group=job_id)
+    except SchedulerFull:
+        cancel_jobs([job_id, *shard_requests], 'rejected')
+        return queue_full_response()
+
+    logger.info(f"Queued job {job_id} for playbook {playbook_request.playbook}, {len(hosts)} hosts in {len(shards)} shards")
+    return {'job_id': job_id, 'status': 'pending', 'errors': None, 'shard_job_ids': list(shard_requests)}, 202
+
+def run_shard_job(parent_id, job_id, *args):
+    if job_storage.update_job_status_if(parent_id, 'running', ['pending']):
+        event_broadcaster.publish(parent_id, 'status', {'status': 'running'})
+    try:
+        return run_playbook(job_id, *args)
+    finally:
+        finish_sharded_job(parent_id)
+
+def finish_sharded_job(parent_id):
+    # runs after every shard, the last one to finish stores the combined result
+    batch = job_storage.get_batch(parent_id)
+    if batch is None or any(shard['status'] in ACTIVE_STATUSES for shard in batch['jobs'].values()):
+        return
+    status = combined_status([shard['status'] for shard in batch['jobs'].values()])
+    stats = merge_stats((job_storage.get_job(shard_id) or {}).get('stats') for shard_id in batch['jobs'])
+    job_storage.save_job_output(parent_id, None, None, stats)
+    # two shards finishing at once both get here, only one of them finishes the parent
+    if not job_storage.update_job_status_if(parent_id, status, list(ACTIVE_STATUSES)):
+        return
+    event_broadcaster.publish(parent_id, 'status', {'status': status, 'stats': stats})
+    event_broadcaster.close(parent_id)
+    logger.info(f"Sharded job {parent_id} finished with status: {status}")
+
+    parent = job_storage.get_job(parent_id) or {}
+    webhook_sender.send(JOB_WEBHOOK_EVENTS.get(status, "job_completed"), {
+        "job_id": parent_id,
+        "playbook": parent.get('playbook'),
+        "status": status
+    })
+
+def cancel_sharded_job(job_id):
+    # queued shards are dropped, running ones stopped, the parent finishes with the last of them
+    cancelled = job_scheduler.cancel_group(job_id)
+    if cancelled:
+        cancel_jobs(cancelled)
+    for shard_id, shard in job_storage.get_batch(job_id)['jobs'].items():
+        if shard['status'] == 'pending' and job_storage.update_job_status_if(shard_id, 'cancelled', ['pending']):
+            cancel_jobs([shard_id])
+        elif shard['status'] == 'running':
+            cancel_token = running_jobs.get(shard_id)
+            if cancel_token is not None:
+                cancel_token.cancel()
+            job_storage.update_job_status_if(shard_id, 'cancelling', ['running'])
+    job_storage.update_job_status_if(job_id, 'cancelling', ['pending', 'running'])
+    finish_sharded_job(job_id)
+    status = job_status(job_id)
+    logger.info(f"Cancelling sharded job {job_id}, {len(cancelled)} queued shards dropped")
+    return {'job_id': job_id, 'status': status, 'errors': None}, 202 if status == 'cancelling' else 200
+
+def status_counts(jobs):
+    counts = {}
+    for job in jobs.values():
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+    return counts
+
+def batch_status(jobs):
+    statuses = [job['status'] for job in jobs.values()]
+    if all(status == 'pending' for status in statuses):
+        return 'pending'
+    if any(status in ACTIVE_STATUSES for status in statuses):
+        return 'running'
+    if all(status == 'completed' for status in statuses):
+        return 'completed'
+    return 'failed'
+
+@ns.route('/playbooks/batch')
+class PlaybookBatch(Resource):
+    @ns.expect(batch_model)
+    @ns.marshal_with(batch_response_model)
+    def post(self):
+        try:
+            data = api.payload
+            logger.debug(f"Received /playbooks/batch request: {data}")
+            batch_request, validation_errors = request_validator.validate_batch(data, config.get('batch', {}).get('max_jobs', 100))
+            if validation_errors:
+                logger.error(f"Validation errors: {validation_errors}")
+                return {'batch_id': None, 'status': 'error', 'job_ids': None, 'errors': validation_errors}, 400
+
+            # the whole batch is queued or nothing, check for room before touching storage
+            if job_scheduler.free_slots() < len(batch_request.jobs):
+                return queue_full_response()
+
+            batch_id = str(uuid.uuid4())
+            jobs = {str(uuid.uuid4()): playbook_request for playbook_request in batch_request.jobs}
+            batch_data = {
+                'max_parallel': batch_request.max_parallel,
+                'stop_on_failure': batch_request.stop_on_failure,
+                'created': datetime.now().isoformat(),
+            }
+            job_storage.save_batch(batch_id, batch_data, {job_id: job_record(playbook_request, batch_id=batch_id)
+                                                          for job_id, playbook_request in jobs.items()})
+            for job_id in jobs:
+                event_broadcaster.open(job_id)
+
+            try:
+                job_scheduler.submit_many([
+                    (job_id, run_batch_job, (batch_id, batch_request.stop_on_failure) + run_playbook_args(job_id, playbook_request),
+                     playbook_request.priority)
+                    for job_id, playbook_request in jobs.items()
+                ], group=batch_id, max_parallel=batch_request.max_parallel)
+            except SchedulerFull:
+                cancel_jobs(list(jobs), 'rejected')
+                return queue_full_response()
+
+            logger.info(f"Queued batch {batch_id} with {len(jobs)} jobs")
+            return {'batch_id': batch_id, 'status': 'pending', 'job_ids': list(jobs), 'errors': None}, 202
+        except Exception as e:
+            logger.error(f"Error starting batch: {str(e)}")
+            return {'batch_id': None, 'status': 'error', 'job_ids': None, 'errors': [str(e)]}, 400
+
+@ns.route('/playbooks/batch/<string:batch_id>')
+@ns.param('batch_id', 'The batch identifier')
+class PlaybookBatchStatus(Resource):
+    def get(self, batch_id):
+        batch = job_storage.get_batch(batch_id)
+        if batch is None:
+            api.abort(404, f"Batch {batch_id} not found")
+
+        batch.update({
+            'batch_id': batch_id,
+            'status': batch_status(batch['jobs']),
+            'total': len(batch['jobs']),
+            'counts': status_counts(batch['jobs']),
+        })
+        return batch
+
+@ns.route('/playbook/validate')
+class ValidatePlaybook(Resource):
+    @ns.expect(playbook_model)
+    @ns.marshal_with(validation_model)
+    def post(self):
+        playbook_request, validation_errors = request_validator.validate(api.payload)
+        if validation_errors:
+            return {'valid': False, 'errors': validation_errors, 'request': None}, 400
+        return {'valid': True, 'errors': [], 'request': playbook_request.to_dict()}, 200
+
+JOB_LIST_DEFAULT_FIELDS = ['status', 'playbook']
+JOB_LIST_FIELDS = list(INDEXED_FIELDS) + ['inventory', 'vars', 'forks', 'verbosity', 'limit', 'tags', 'skip_tags', 'cmdline', 'priority']
+JOB_LIST_DEFAULT_LIMIT = 100
+JOB_LIST_MAX_LIMIT = 1000
+
+def parse_job_list_args(args):
+    errors = []
+
+    try:
+        limit = int(args.get('limit', JOB_LIST_DEFAULT_LIMIT))
+        if not 1 <= limit <= JOB_LIST_MAX_LIMIT:
+            errors.append(f"'limit' must be between 1 and {JOB_LIST_MAX_LIMIT}")
+    except ValueError:
+        errors.append("'limit' must be an integer")
+        limit = None
+
+    fields = [field.strip() for field in args['fields'].split(',') if field.strip()] if 'fields' in args else JOB_LIST_DEFAULT_FIELDS
+    unknown_fields = [field for field in fields if field not in JOB_LIST_FIELDS]
+    if unknown_fields:
+        errors.append(f"Unknown fields: {', '.join(unknown_fields)}")
+
+    for key in ['since', 'until']:
+        if key in args:
+            try:
+                datetime.fromisoformat(args[key])
+            except ValueError:
+                errors.append(f"'{key}' must be an ISO 8601 timestamp")
+
+    playbook = args.get('playbook')
+    if playbook and not os.path.isabs(playbook):
+        playbook = str(Path(config['playbook_dir']) / playbook)
+
+    query = {
+        'status': [status.strip() for status in args['status'].split(',')] if args.get('status') else None,
+        'playbook': playbook,
+        'start_after': args.get('since'),
+        'start_before': args.get('until'),
+        'cursor': args.get('cursor'),
+        'limit': limit,
+        'include_data': any(field not in INDEXED_FIELDS for field in fields),
+    }
+    return query, fields, errors
+
 @ns.route('/jobs')
 class JobList(Resource):
+    @ns.doc(params={
+        'status': 'Only jobs with this status, comma-separated for several (e.g. "failed,error")',
+        'playbook': 'Only jobs of this playbook (e.g. "site.yml")',
+        'since': 'Only jobs started at or after this ISO 8601 timestamp',
+        'until': 'Only jobs started before this ISO 8601 timestamp',
+        'limit': f'Page size, default {JOB_LIST_DEFAULT_LIMIT}, max {JOB_LIST_MAX_LIMIT}',
+        'cursor': 'Cursor from the X-Next-Cursor header of the previous page',
+        'fields': f'Comma-separated fields to return per job, default "{",".join(JOB_LIST_DEFAULT_FIELDS)}"',
+    })
     def get(self):
-        return {job_id: {'status': job['status'], 'playbook': job['playbook']} for job_id, job in job_storage.get_all_jobs().items()}
+        query, fields, errors = parse_job_list_args(request.args)
+        if errors:
+            api.abort(400, 'Invalid query', errors=errors)
+
+        # fetch one extra row to know whether there is a next page
+        limit = query['limit']
+        query['limit'] = limit + 1
+        try:
+            jobs = job_storage.list_jobs(**query)
+        except ValueError as e:
+            api.abort(400, str(e))
+
+        headers = {}
+        if len(jobs) > limit:
+            job_ids = list(jobs)[:limit]
+            last_job = jobs[job_ids[-1]]
+            jobs = {job_id: jobs[job_id] for job_id in job_ids}
+            next_cursor = encode_cursor(last_job.get('start_time'), job_ids[-1])
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = f'<{request.base_url}?{next_page_query(request.args, next_cursor)}>; rel="next"'
+
+        data = {job_id: {field: job.get(field) for field in fields} for job_id, job in jobs.items()}
+        response = api.make_response(data, 200, headers)
+        response.add_etag()
+        return response.make_conditional(request)
+
+def next_page_query(args, cursor):
+    params = args.to_dict()
+    params['cursor'] = cursor
+    return urlencode(params)
 
 @ns.route('/job/<string:job_id>')
 @ns.param('job_id', 'The job identifier')
 class Job(Resource):
+    @ns.doc(params={
+        'offset': 'Start of the stdout range, default 0',
+        'limit': 'Length of the stdout range, default until the end',
+        'unit': 'Unit of offset and limit, "bytes" (default) or "lines"',
+        'wait': 'Seconds to wait for an unfinished job to finish before answering (long-poll)',
+    })
     def get(self, job_id):
+        wait = parse_wait(request.args)
         job = job_storage.get_job(job_id)
         if job is None:
             logger.warning(f"Job {job_id} not found")
             api.abort(404, f"Job {job_id} not found")
-        return job
+
+        if wait and job['status'] in ACTIVE_STATUSES:
+            wait_for_job(job_id, job['status'], wait)
+            job = job_storage.get_job(job_id) or job
+
+        if job.get('shards'):
+            shard_jobs = (job_storage.get_batch(job_id) or {}).get('jobs', {})
+            job['shard_jobs'] = shard_jobs
+            job['shard_counts'] = status_counts(shard_jobs)
+
+        if job_storage.has_output_log(job_id):
+            offset, limit, unit = parse_output_range(request.args)
+            job['stdout'], next_offset = job_storage.read_output(job_id, offset, limit, unit)
+            job['stdout_size'] = job_storage.output_size(job_id)
+            if 'offset' in request.args or 'limit' in request.args:
+                job['stdout_next_offset'] = next_offset
+        return gzip_response(api.make_response(job, 200))
+
+    @ns.marshal_with(job_model)
+    def delete(self, job_id):
+        job = job_storage.get_job(job_id)
+        if job is None:
+            api.abort(404, f"Job {job_id} not found")
+
+        if job.get('shards') and job['status'] in ACTIVE_STATUSES:
+            return cancel_sharded_job(job_id)
+
+        if job_storage.update_job_status_if(job_id, 'cancelled', ['pending']):
+            # frees its queue slot right away, queued in another worker process it is skipped when its turn comes
+            if job_scheduler.cancel(job_id) and job_deduplicator:
+                job_deduplicator.release_job(job_id)
+            cancel_jobs([job_id])
+            webhook_sender.send("job_cancelled", {"job_id": job_id, "playbook": job['playbook'], "status": 'cancelled'})
+            logger.info(f"Cancelled queued job {job_id}")
+            return {'job_id': job_id, 'status': 'cancelled', 'errors': None}, 200
+
+        cancel_token = running_jobs.get(job_id)
+        if cancel_token is not None:
+            cancel_token.cancel()
+        # running in another worker process, its cancel token picks this up
+        if cancel_token is not None or job_status(job_id) == 'running':
+            job_storage.update_job_status_if(job_id, 'cancelling', ['running'])
+        status = job_status(job_id)
+        if status in ('running', 'cancelling'):
+            logger.info(f"Cancelling running job {job_id}")
+            return {'job_id': job_id, 'status': 'cancelling', 'errors': None}, 202
+        return {'job_id': job_id, 'status': status, 'errors': [f"Job {job_id} already finished"]}, 409
+
+def parse_wait(args):
+    max_wait = config.get('event_stream', {}).get('max_wait', 300)
+    try:
+        wait = float(args.get('wait', 0))
+    except ValueError:
+        api.abort(400, "'wait' must be a number of seconds")
+    if not 0 <= wait <= max_wait:
+        api.abort(400, f"'wait' must be between 0 and {max_wait}")
+    return wait
+
+def wait_for_job(job_id, status, timeout):
+    # holds the request thread while waiting, asgi:application parks these clients on its event loop instead
+    if event_broadcaster.wait_closed(job_id, timeout) is not None:
+        return
+    # queued or running in another worker process
+    deadline = time.monotonic() + timeout
+    while status in ACTIVE_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(1, remaining))
+        status = job_status(job_id)
+
+def parse_output_range(args):
+    unit = args.get('unit', 'bytes')
+    if unit not in ['bytes', 'lines']:
+        api.abort(400, "'unit' must be 'bytes' or 'lines'")
+    try:
+        offset = int(args.get('offset', 0))
+        limit = int(args['limit']) if 'limit' in args else None
+    except ValueError:
+        api.abort(400, "'offset' and 'limit' must be integers")
+    if offset < 0 or (limit is not None and limit < 0):
+        api.abort(400, "'offset' and 'limit' must not be negative")
+    return offset, limit, unit
+
+def accepts_gzip():
+    return request.accept_encodings.quality('gzip') > 0
+
+def gzip_response(response, min_size=1024):
+    # job output dominates these responses and compresses about 10x
+    response.vary.add('Accept-Encoding')
+    if accepts_gzip() and not response.direct_passthrough and response.content_length and response.content_length >= min_size:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=config.get('output', {}).get('level', 6)))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@ns.route('/job/<string:job_id>/output')
+@ns.param('job_id', 'The job identifier')
+class JobOutput(Resource):
+    @ns.doc(params={
+        'offset': 'Start of the range, default 0',
+        'limit': 'Length of the range, default until the end',
+        'unit': 'Unit of offset and limit, "bytes" (default) or "lines"',
+    })
+    @ns.produces(['text/plain'])
+    def get(self, job_id):
+        if not job_storage.has_output_log(job_id):
+            if job_storage.get_job(job_id) is None:
+                api.abort(404, f"Job {job_id} not found")
+            return Response('', mimetype='text/plain')
+
+        headers = {'X-Output-Size': str(job_storage.output_size(job_id)), 'Vary': 'Accept-Encoding'}
+        if 'offset' in request.args or 'limit' in request.args:
+            offset, limit, unit = parse_output_range(request.args)
+            text, next_offset = job_storage.read_output(job_id, offset, limit, unit)
+            headers['X-Next-Offset'] = str(next_offset)
+            return gzip_response(Response(text, mimetype='text/plain', headers=headers))
+
+        # the stored gzip file is a valid gzip response body, it is sent without decompressing it
+        compressed = job_storage.compressed_output(job_id) if accepts_gzip() else None
+        if compressed is not None:
+            stream, _ = compressed
+            size = stream.seek(0, 2)
+            stream.seek(0)
+            headers.update({'Content-Encoding': 'gzip', 'Content-Length': str(size)})
+            response = Response(iter_file(stream), mimetype='text/plain', headers=headers, direct_passthrough=True)
+            response.call_on_close(stream.close)
+            return response
+        return Response(stream_with_context(job_storage.iter_output(job_id)), mimetype='text/plain', headers=headers)
+
+@ns.route('/job/<string:job_id>/timings')
+@ns.param('job_id', 'The job identifier')
+class JobTimings(Resource):
+    @ns.doc(params={'limit': 'Only the slowest N tasks and hosts'})
+    def get(self, job_id):
+        try:
+            limit = int(request.args['limit']) if 'limit' in request.args else None
+        except ValueError:
+            api.abort(400, "'limit' must be an integer")
+
+        timings = live_timings.get(job_id)
+        if timings is not None:
+            return dict(timings.summary(limit), complete=False)
+
+        # finished, or running in another worker process which saves its timings every timings.save_interval
+        summary = job_storage.get_job_timings(job_id)
+        status = job_status(job_id)
+        if summary is None:
+            if status is None:
+                api.abort(404, f"Job {job_id} not found")
+            api.abort(404, f"No timings recorded for job {job_id}")
+        summary['tasks'] = summary['tasks'][:limit]
+        summary['hosts'] = summary['hosts'][:limit]
+        return dict(summary, complete=status not in ACTIVE_STATUSES)
+
+EVENT_QUERY_DEFAULT_LIMIT = 100
+EVENT_QUERY_MAX_LIMIT = 1000
+EVENT_STATUSES = ['ok', 'changed', 'failed', 'ignored', 'skipped', 'unreachable']
+
+def parse_event_query_args(args):
+    errors = []
+
+    try:
+        limit = int(args.get('limit', EVENT_QUERY_DEFAULT_LIMIT))
+        if not 1 <= limit <= EVENT_QUERY_MAX_LIMIT:
+            errors.append(f"'limit' must be between 1 and {EVENT_QUERY_MAX_LIMIT}")
+    except ValueError:
+        errors.append("'limit' must be an integer")
+        limit = None
+
+    statuses = [status.strip() for status in args['status'].split(',')] if args.get('status') else None
+    unknown_statuses = [status for status in statuses or [] if status not in EVENT_STATUSES]
+    if unknown_statuses:
+        errors.append(f"Unknown statuses: {', '.join(unknown_statuses)}")
+
+    for key in ['since', 'until']:
+        if key in args:
+            try:
+                datetime.fromisoformat(args[key])
+            except ValueError:
+                errors.append(f"'{key}' must be an ISO 8601 timestamp")
+
+    query = {
+        'host': args.get('host'),
+        'status': statuses,
+        'task': args.get('task'),
+        'since': args.get('since'),
+        'until': args.get('until'),
+        'limit': limit,
+    }
+    return query, errors
+
+EVENT_QUERY_PARAMS = {
+    'host': 'Only results of this host',
+    'status': f'Only results with this status, comma-separated for several ({", ".join(EVENT_STATUSES)})',
+    'task': 'Only tasks whose name contains this text',
+    'since': 'Only events created at or after this ISO 8601 timestamp (UTC, as reported by ansible-runner)',
+    'until': 'Only events created before this ISO 8601 timestamp',
+    'limit': f'Page size, default {EVENT_QUERY_DEFAULT_LIMIT}, max {EVENT_QUERY_MAX_LIMIT}',
+}
+
+@ns.route('/job/<string:job_id>/events')
+@ns.param('job_id', 'The job identifier')
+class JobEvents(Resource):
+    @ns.doc(params=dict(EVENT_QUERY_PARAMS, after='Only events after this counter, "next_after" of the previous page'))
+    def get(self, job_id):
+        query, errors = parse_event_query_args(request.args)
+        try:
+            after = int(request.args['after']) if 'after' in request.args else None
+        except ValueError:
+            errors.append("'after' must be an integer")
+        if errors:
+            api.abort(400, 'Invalid query', errors=errors)
+
+        job = job_storage.get_job(job_id)
+        if job is None:
+            api.abort(404, f"Job {job_id} not found")
+        complete = job['status'] not in ACTIVE_STATUSES
+        if complete:
+            index_artifact_events(job_id)
+
+        events = job_storage.query_events(job_id=job_id, after=after, **query)
+        for event in events:
+            event.pop('job_id', None)
+        return {
+            'job_id': job_id,
+            'complete': complete,
+            'events': events,
+            'next_after': events[-1]['counter'] if len(events) == query['limit'] else None,
+        }
+
+@ns.route('/events')
+class EventList(Resource):
+    @ns.doc(params=dict(EVENT_QUERY_PARAMS, cursor='Cursor from the X-Next-Cursor header of the previous page'))
+    def get(self):
+        query, errors = parse_event_query_args(request.args)
+        if errors:
+            api.abort(400, 'Invalid query', errors=errors)
+
+        # newest first across every job, answered from the index without opening job directories
+        limit = query['limit']
+        query['limit'] = limit + 1
+        try:
+            events = job_storage.query_events(cursor=request.args.get('cursor'), **query)
+        except ValueError as e:
+            api.abort(400, str(e))
+
+        headers = {}
+        if len(events) > limit:
+            events = events[:limit]
+            last = events[-1]
+            next_cursor = encode_cursor(last['created'], last['job_id'], last['counter'])
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = f'<{request.base_url}?{next_page_query(request.args, next_cursor)}>; rel="next"'
+        return api.make_response({'events': events}, 200, headers)
+
+def format_sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+def poll_job_status(job_id, status, keepalive, interval=1):
+    event_id = 1
+    yield event_id, 'status', {'status': status}
+    idle = 0
+    while status in ACTIVE_STATUSES:
+        time.sleep(interval)
+        job = job_storage.get_job(job_id) or {'status': 'error'}
+        if job['status'] != status:
+            status = job['status']
+            event_id += 1
+            idle = 0
+            yield event_id, 'status', {'status': status}
+        else:
+            idle += interval
+            if idle >= keepalive:
+                idle = 0
+                yield None
+
+@ns.route('/job/<string:job_id>/stream')
+@ns.param('job_id', 'The job identifier')
+class JobStream(Resource):
+    @ns.doc(params={'last_event_id': 'Resume after this event id (the Last-Event-ID header takes precedence)'})
+    @ns.produces(['text/event-stream'])
+    def get(self, job_id):
+        try:
+            last_event_id = int(request.headers.get('Last-Event-ID', request.args.get('last_event_id', 0)))
+        except ValueError:
+            api.abort(400, 'Last-Event-ID must be an integer')
+
+        keepalive = config.get('event_stream', {}).get('keepalive', 15)
+
+        if not event_broadcaster.is_open(job_id):
+            job = job_storage.get_job(job_id)
+            if job is None:
+                api.abort(404, f"Job {job_id} not found")
+            if job['status'] not in ACTIVE_STATUSES:
+                # finished long ago, there is nothing left to stream except the final state
+                return Response(format_sse(0, 'status', {'status': job['status']}), mimetype='text/event-stream')
+            # started by another worker process, only its status changes are visible from here
+            events = poll_job_status(job_id, job['status'], keepalive)
+        else:
+            events = event_broadcaster.subscribe(job_id, last_event_id, keepalive)
+
+        def generate():
+            for event in events:
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield format_sse(*event)
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@ns.route('/inventory/<path:name>/hosts')
+@ns.param('name', 'Inventory file, "default" for the configured inventory_file')
+class InventoryHosts(Resource):
+    @ns.doc(params={'limit': 'Host pattern to resolve (e.g. "webservers:&staging:!web3")'})
+    def get(self, name):
+        inventory_path = request_validator.resolve_inventory_path(None if name == 'default' else name)
+        if inventory_path is None or not inventory_path.exists():
+            api.abort(404, f"Inventory {name} not found")
+
+        limit = request.args.get('limit')
+        try:
+            hosts = inventory_cache.resolve(inventory_path, limit)
+        except InventoryError as e:
+            logger.error(str(e))
+            api.abort(500, str(e))
+        except re.error as e:
+            api.abort(400, f"Invalid host pattern: {str(e)}")
+        return {'inventory': str(inventory_path), 'limit': limit, 'hosts': hosts, 'count': len(hosts)}
 
 @ns.route('/available-playbooks')
 class AvailablePlaybooks(Resource):
     @ns.marshal_with(available_playbooks_model)
     def get(self):
-        playbook_dir = Path(config['playbook_dir'])
-        available_playbooks = []
-
-        for file in playbook_dir.glob('**/*.yml'):
-            relative_path = file.relative_to(playbook_dir)
-            if file.is_file() and (not compiled_whitelist or any(pattern.match(str(relative_path)) for pattern in compiled_whitelist)):
-                available_playbooks.append(str(relative_path))
+        return {'playbooks': playbook_index.playbooks()}
 
-        return {'playbooks': available_playbooks}
+@ns.route('/config/reload')
+class ConfigReload(Resource):
+    @ns.doc(responses={200: 'Reloaded, or unchanged', 400: 'Invalid configuration, the current one stays active', 403: 'Disabled in the config'})
+    def post(self):
+        # reloads this process, the other worker processes pick the change up with their config watcher
+        if not config.get('config_reload', {}).get('endpoint', True):
+            return {'errors': ['Configuration reloads over the API are disabled']}, 403
+        try:
+            return reload_config(), 200
+        except ConfigError as e:
+            return {'errors': e.errors}, 400
 
 # simple healthcheck placeholder
 @app.route('/health')
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/ready')
+def readiness_check():
+    # /health only says the process answers, /ready that it can take jobs
+    started = services_pid == os.getpid()
+    checks = {
+        'services': started,
+        'storage': job_storage.ping(),
+        'playbooks': playbook_index.ready,
+        'scheduler': started and job_scheduler.is_running(),
+    }
+    ready = all(checks.values())
+    return jsonify({
+        'status': 'ready' if ready else 'starting',
+        'checks': checks,
+        'startup': startup_timer.to_dict(),
+    }), 200 if ready else 503
+
 @app.route('/version')
 def version_check():
     return jsonify({"version": VERSION}), 200
 
-def init_app():
-    global config, logger, job_storage, job_storage_dir, compiled_whitelist, webhook_sender, PLAYBOOK_RUNS, PLAYBOOK_DURATION, ACTIVE_JOBS
-
-    config = load_config()
-
-    log_level = getattr(logging, config.get('log_level', 'INFO').upper())
-    logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
-    logger = logging.getLogger(__name__)
-    logger.info(f"Logging level set to {logging.getLevelName(log_level)}")
-    logger.info(f"Initializing Ansible-Link, version {VERSION} - {prefix}")
-
-    job_storage_dir = Path(config.get('job_storage_dir', Path(__file__).parent.absolute() / 'job-storage'))
-    job_storage_dir.mkdir(parents=True, exist_ok=True)
-    job_storage = JobStorage(config.get('job_storage_dir', Path(__file__).parent.absolute() / 'job-storage'))
-
-    playbook_whitelist = config.get('playbook_whitelist', [])
-    compiled_whitelist = [re.compile(pattern) for pattern in playbook_whitelist]
-
-    webhook_sender = WebhookSender(config.get('webhook', {}))
-
-    PLAYBOOK_RUNS = Counter('ansible_link_playbook_runs_total', 'Total number of playbook runs', ['playbook', 'status'])
-    PLAYBOOK_DURATION = Histogram('ansible_link_playbook_duration_seconds', 'Duration of playbook runs in seconds', ['playbook'])
-    ACTIVE_JOBS = Gauge('ansible_link_active_jobs', 'Number of currently active jobs')
-
+def init_app(start=True):
+    """loads the configuration and the state shared by all worker processes, start_services() starts the rest"""
+    global config, config_version, logger, job_storage, job_storage_dir, compiled_whitelist, playbook_index, inventory_cache, request_validator, job_deduplicator, admission_controller, event_broadcaster, startup_timer, gauge_sampler, webhook_metrics, retention_metrics, PLAYBOOK_RUNS, PLAYBOOK_DURATION, ACTIVE_JOBS, QUEUE_DEPTH, QUEUE_WAIT, WORKER_UTILIZATION, GLOBAL_ACTIVE_JOBS, DEDUP_REQUESTS, TASK_DURATION, STARTUP_PHASE, CONFIG_RELOADS, FORKS_IN_USE, FORK_BUDGET, ADMISSION_WAITING, ADMISSION_DECISIONS, CONTROLLER_LOAD, CONTROLLER_MEMORY_AVAILABLE
+
+    startup_timer = StartupTimer()
+    with startup_timer.phase('config'):
+        config = load_config()
+        config_version = config_digest(config)
+
+        log_level = getattr(logging, config.get('log_level', 'INFO').upper())
+        logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+        logger = logging.getLogger(__name__)
+        logger.info(f"Logging level set to {logging.getLevelName(log_level)}")
+        logger.info(f"Initializing Ansible-Link, version {VERSION} - {prefix}")
+
+    with startup_timer.phase('storage'):
+        job_storage_dir = Path(config.get('job_storage_dir', Path(__file__).parent.absolute() / 'job-storage'))
+        job_storage_dir.mkdir(parents=True, exist_ok=True)
+        job_storage = create_job_storage(job_storage_dir, config.get('job_storage_backend', 'sqlite'))
+
+    with startup_timer.phase('playbooks'):
+        playbook_whitelist = config.get('playbook_whitelist', [])
+        compiled_whitelist = [re.compile(pattern) for pattern in playbook_whitelist]
+
+        catalog_config = config.get('playbook_catalog', {})
+        playbook_index = PlaybookIndex(config['playbook_dir'], compiled_whitelist,
+                                       scan_interval=catalog_config.get('scan_interval', 30),
+                                       use_inotify=catalog_config.get('inotify', True))
+
+    with startup_timer.phase('validation'):
+        inventory_cache_config = config.get('inventory_cache', {})
+        inventory_cache = InventoryCache(ttl=inventory_cache_config.get('ttl', 300),
+                                         timeout=inventory_cache_config.get('timeout', 60))
+
+        request_validator = PlaybookRequestValidator(config, playbook_index, inventory_cache)
+
+        dedup_config = config.get('dedup', {})
+        job_deduplicator = None
+        if dedup_config.get('enabled', False):
+            job_deduplicator = JobDeduplicator(ttl=dedup_config.get('ttl', 0), playbook_ttls=dedup_config.get('playbooks'))
+
+        admission_controller = AdmissionController(**admission_settings(config))
+
+        event_stream_config = config.get('event_stream', {})
+        event_broadcaster = EventBroadcaster(buffer_size=event_stream_config.get('buffer_size', 1000),
+                                             retention=event_stream_config.get('retention', 300))
+
+    with startup_timer.phase('metrics'):
+        PLAYBOOK_RUNS = Counter('ansible_link_playbook_runs_total', 'Total number of playbook runs', ['playbook', 'status'])
+        PLAYBOOK_DURATION = Histogram('ansible_link_playbook_duration_seconds', 'Duration of playbook runs in seconds', ['playbook'])
+        ACTIVE_JOBS = Gauge('ansible_link_active_jobs', 'Number of currently active jobs', multiprocess_mode='livesum')
+        # with several worker processes per-process gauges are summed up, host-wide ones report the highest value
+        gauge_sampler = GaugeSampler()
+        FORKS_IN_USE = Gauge('ansible_link_forks_in_use', 'Forks granted to running jobs', multiprocess_mode='livesum')
+        FORK_BUDGET = Gauge('ansible_link_fork_budget', 'Forks running jobs may use together, 0 = unlimited', multiprocess_mode='livesum')
+        ADMISSION_WAITING = Gauge('ansible_link_admission_waiting_jobs', 'Jobs waiting for forks, cpu or memory of the controller',
+                                  multiprocess_mode='livesum')
+        ADMISSION_DECISIONS = Counter('ansible_link_admission_total', 'Jobs passed by the admission controller', ['result'])
+        CONTROLLER_LOAD = Gauge('ansible_link_controller_load', '1 minute load average of the controller per cpu', multiprocess_mode='livemax')
+        CONTROLLER_MEMORY_AVAILABLE = Gauge('ansible_link_controller_memory_available_bytes', 'Memory available on the controller',
+                                            multiprocess_mode='livemax')
+        gauge_sampler.track(FORKS_IN_USE, admission_controller.forks_in_use)
+        gauge_sampler.track(FORK_BUDGET, lambda: admission_controller.max_forks if admission_controller.enabled else 0)
+        gauge_sampler.track(ADMISSION_WAITING, admission_controller.waiting)
+        gauge_sampler.track(CONTROLLER_LOAD, lambda: admission_controller.load.load() or 0)
+        gauge_sampler.track(CONTROLLER_MEMORY_AVAILABLE, lambda: admission_controller.load.available_memory() or 0)
+        QUEUE_DEPTH = Gauge('ansible_link_queue_depth', 'Number of jobs waiting for a free worker', multiprocess_mode='livesum')
+        QUEUE_WAIT = Histogram('ansible_link_queue_wait_seconds', 'Time jobs spend queued before a worker picks them up')
+        WORKER_UTILIZATION = Gauge('ansible_link_worker_utilization', 'Fraction of scheduler workers currently running a job',
+                                   multiprocess_mode='liveall')
+        GLOBAL_ACTIVE_JOBS = Gauge('ansible_link_global_active_jobs', 'Jobs holding a global slot, across all coordinated processes',
+                                   multiprocess_mode='livemax')
+        TASK_DURATION = Histogram('ansible_link_task_duration_seconds', 'Duration of single tasks on single hosts', ['playbook', 'result'],
+                                  buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+        DEDUP_REQUESTS = Counter('ansible_link_dedup_requests_total', 'Playbook requests checked for an identical job', ['result'])
+        CONFIG_RELOADS = Counter('ansible_link_config_reloads_total', 'Configuration reloads by result', ['result'])
+        STARTUP_PHASE = Gauge('ansible_link_startup_phase_seconds', 'Duration of the startup phases of this process', ['phase'])
+        webhook_metrics = WebhookMetrics(
+            delivery_latency=Histogram('ansible_link_webhook_delivery_seconds', 'Time from job event to successful webhook delivery', ['target']),
+            failures=Counter('ansible_link_webhook_failures_total', 'Failed webhook delivery attempts', ['target']),
+            dropped=Counter('ansible_link_webhook_dropped_total', 'Webhook events given up: rejected, expired in the spool or dropped after all retries', ['target']),
+            queue_depth=Gauge('ansible_link_webhook_queue_depth', 'Webhook events waiting for delivery', ['target'], multiprocess_mode='livesum'))
+        retention_metrics = RetentionMetrics(
+            reclaimed=Counter('ansible_link_retention_reclaimed_bytes_total', 'Disk space freed by job retention', ['source']),
+            jobs=Counter('ansible_link_retention_jobs_total', 'Jobs compacted or deleted by job retention', ['action']))
+
+    if start:
+        start_services()
     return app
 
+def start_services():
+    """starts the threads, processes and connections owned by this process, once per process"""
+    global services_pid, retention_manager, slot_leases, webhook_sender, job_executor, job_scheduler
+
+    if services_pid == os.getpid():
+        return
+
+    with startup_timer.phase('retention'):
+        retention_manager = create_retention_manager(config.get('retention', {}))
+        if retention_manager:
+            retention_manager.start()
+
+    with startup_timer.phase('webhooks'):
+        webhook_sender = WebhookSender(webhook_targets(config), spool_dir=job_storage_dir / 'webhook-spool', metrics=webhook_metrics)
+        webhook_sender.start()
+
+    with startup_timer.phase('executor'):
+        scheduler_config = config.get('scheduler', {})
+        execution_config = config.get('execution', {})
+        execution_backend = execution_config.get('backend', 'thread')
+        if execution_backend == 'process':
+            job_executor = create_executor('process',
+                                           processes=execution_config.get('processes', scheduler_config.get('max_workers', 4)),
+                                           max_jobs_per_process=execution_config.get('max_jobs_per_process', 100),
+                                           log_level=getattr(logging, config.get('log_level', 'INFO').upper()))
+        else:
+            job_executor = create_executor(execution_backend)
+        job_executor.start()
+
+    with startup_timer.phase('scheduler'):
+        coordination_config = config.get('coordination', {})
+        slot_leases = None
+        if coordination_config.get('enabled', False):
+            slot_leases = SlotLeases(coordination_config.get('path', job_storage_dir / 'coordination.db'),
+                                     slots=coordination_config.get('max_active_jobs', 4),
+                                     ttl=coordination_config.get('lease_ttl', 60))
+            slot_leases.start()
+            gauge_sampler.track(GLOBAL_ACTIVE_JOBS, slot_leases.active)
+
+        job_scheduler = JobScheduler(max_workers=scheduler_config.get('max_workers', 4),
+                                     max_queue=scheduler_config.get('max_queue', 100),
+                                     wait_observer=QUEUE_WAIT.observe,
+                                     slot_gate=slot_leases)
+        gauge_sampler.track(QUEUE_DEPTH, job_scheduler.queue_depth)
+        gauge_sampler.track(WORKER_UTILIZATION, job_scheduler.utilization)
+        job_scheduler.start()
+
+    with startup_timer.phase('playbooks'):
+        # builds the index in the background unless it was built by init_app
+        playbook_index.start()
+
+    start_config_reload()
+    gauge_sampler.start()
+    services_pid = os.getpid()
+    for phase, duration in startup_timer.phases.items():
+        STARTUP_PHASE.labels(phase=phase).set(duration)
+    logger.info(f"Process {services_pid} started in {startup_timer.total():.3f}s ({startup_timer.summary()})")
+
+def create_retention_manager(retention_config):
+    if not retention_config.get('enabled', False):
+        return None
+    return RetentionManager(job_storage, job_storage_dir,
+                            archive_after_days=retention_config.get('archive_after_days', 7),
+                            max_age_days=retention_config.get('max_age_days', 0),
+                            max_jobs=retention_config.get('max_jobs', 0),
+                            max_bytes=retention_config.get('max_bytes', 0),
+                            archive_size=retention_config.get('archive_size', 256 * 1024 * 1024),
+                            interval=retention_config.get('interval', 3600),
+                            leader_lock=LeaderLock(job_storage_dir / 'retention.lock'),
+                            metrics=retention_metrics)
+
+def webhook_targets(config):
+    targets = list(config.get('webhooks') or [])
+    if config.get('webhook'):
+        targets.append(config['webhook'])
+    return targets
+
+def start_config_reload():
+    # per process: each gunicorn worker watches the file and answers SIGHUP on its own
+    global config_watcher
+    reload_settings = config.get('config_reload', {})
+    config_watcher = None
+    if reload_settings.get('watch', True):
+        config_watcher = ConfigWatcher(config_file(), reload_config, interval=reload_settings.get('interval', 5))
+        config_watcher.start()
+    if reload_settings.get('signal', True) and install_reload_signal(reload_config):
+        logger.debug("Reloading the configuration on SIGHUP")
+
+def reload_config():
+    """reads the config file again and swaps it in, only what depends on changed keys is rebuilt
+
+    config is replaced as a whole and never modified, a job keeps the snapshot it started with
+    """
+    global config, config_version
+    with config_lock:
+        try:
+            new_config, new_whitelist = read_config(config_file())
+        except ConfigError as e:
+            CONFIG_RELOADS.labels(result='failed').inc()
+            logger.error(f"Configuration not reloaded, keeping version {config_version}: {str(e)}")
+            raise
+        resolve_paths(new_config, Path(__file__).parent.absolute())
+
+        version = config_digest(new_config)
+        if version == config_version:
+            CONFIG_RELOADS.labels(result='unchanged').inc()
+            return {'version': version, 'changed': [], 'restart_required': []}
+
+        changed = changed_keys(config, new_config)
+        restart_required = keep_restart_keys(config, new_config, changed)
+        applied = [key for key in changed if key not in restart_required]
+        apply_config(new_config, new_whitelist, applied)
+        previous_version, config, config_version = config_version, new_config, version
+
+    CONFIG_RELOADS.labels(result='reloaded').inc()
+    logger.info(f"Reloaded configuration {previous_version} -> {version}, changed: {', '.join(applied) or 'nothing'}")
+    if restart_required:
+        logger.warning(f"Configuration changes of {', '.join(restart_required)} take effect after a restart")
+    return {'version': version, 'changed': applied, 'restart_required': restart_required}
+
+def apply_config(new_config, new_whitelist, changed):
+    """rebuilds the state derived from the changed config keys"""
+    global compiled_whitelist, playbook_index, request_validator, job_deduplicator, retention_manager
+    started = services_pid == os.getpid()
+
+    if 'log_level' in changed:
+        logging.getLogger().setLevel(getattr(logging, new_config.get('log_level', 'INFO').upper()))
+
+    if 'playbook_dir' in changed or 'playbook_catalog' in changed:
+        catalog_config = new_config.get('playbook_catalog', {})
+        index = PlaybookIndex(new_config['playbook_dir'], new_whitelist,
+                              scan_interval=catalog_config.get('scan_interval', 30),
+                              use_inotify=catalog_config.get('inotify', True))
+        # built before it is swapped in, listings never see an empty index
+        index.build()
+        if started:
+            index.start()
+        previous_index, playbook_index = playbook_index, index
+        previous_index.stop()
+    elif 'playbook_whitelist' in changed:
+        playbook_index.set_whitelist(new_whitelist)
+    compiled_whitelist = new_whitelist
+
+    if 'inventory_cache' in changed:
+        inventory_cache_config = new_config.get('inventory_cache', {})
+        inventory_cache.ttl = inventory_cache_config.get('ttl', 300)
+        inventory_cache.timeout = inventory_cache_config.get('timeout', 60)
+
+    # holds only settings and a short lived stat cache
+    request_validator = PlaybookRequestValidator(new_config, playbook_index, inventory_cache)
+
+    if 'admission' in changed:
+        admission_controller.configure(**admission_settings(new_config))
+
+    if 'dedup' in changed:
+        dedup_config = new_config.get('dedup', {})
+        if not dedup_config.get('enabled', False):
+            job_deduplicator = None
+        elif job_deduplicator is None:
+            job_deduplicator = JobDeduplicator(ttl=dedup_config.get('ttl', 0), playbook_ttls=dedup_config.get('playbooks'))
+        else:
+            # jobs in flight stay registered
+            job_deduplicator.ttl = dedup_config.get('ttl', 0)
+            job_deduplicator.playbook_ttls = dedup_config.get('playbooks') or {}
+
+    # not started yet (a preloaded gunicorn master), the services read the new config when they start
+    if not started:
+        return
+
+    if 'webhook' in changed or 'webhooks' in changed:
+        replaced = webhook_sender.reconfigure(webhook_targets(new_config))
+        logger.info(f"Webhook targets changed: {', '.join(replaced) or 'none'}")
+
+    if 'retention' in changed:
+        if retention_manager:
+            retention_manager.stop(5)
+        retention_manager = create_retention_manager(new_config.get('retention', {}))
+        if retention_manager:
+            retention_manager.start()
+
+def start_metrics_exporter():
+    # with several gunicorn workers only one of them serves the metrics port
+    global metrics_exporter
+    metrics_port = config.get('metrics_port', 8000)
+    metrics_exporter = MetricsExporter(metrics_port, job_storage_dir / 'metrics.lock')
+    metrics_exporter.start()
+
+def start_after_fork():
+    # gunicorn --preload: the master only loaded the app, each worker starts its own threads after the fork
+    global preloaded
+    if not preloaded:
+        return
+    preloaded = False
+    try:
+        job_storage.after_fork()
+        start_services()
+        start_metrics_exporter()
+    except Exception as e:
+        logger.error(f"Failed to start worker process {os.getpid()}: {str(e)}")
+
 def main():
-    app = init_app()
-    
+    global preloaded
+    app = init_app(start=False)
+    preload = gunicorn_preload(config.get('startup', {}).get('preload'))
+
     ANSIBLE_LINK_LOGO_BASE64 = "ICAgX19fICAgICAgICAgICAgXyBfXyAgIF9fICAgICAgICBfXyAgIF8gICAgICBfXyAgCiAgLyBfIHwgX19fICBfX18gKF8pIC8gIC8gL19fIF9fX18vIC8gIChfKV9fICAvIC9fXwogLyBfXyB8LyBfIFwoXy08LyAvIF8gXC8gLyAtXylfX18vIC9fXy8gLyBfIFwvICAnXy8KL18vIHxfL18vL18vX19fL18vXy5fXy9fL1xfXy8gICAvX19fXy9fL18vL18vXy9cX1wgCiAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICAgICA="
     ANSIBLE_LINK_LOGO = base64.b64decode(ANSIBLE_LINK_LOGO_BASE64).decode('utf-8')
     print(ANSIBLE_LINK_LOGO)
 
-    metrics_port = config.get('metrics_port', 8000)
-    start_http_server(metrics_port)
-
-    logger.info(f"Metrics server started, port {metrics_port}")
+    if preload:
+        with startup_timer.phase('playbooks'):
+            # built once in the master and shared with every forked worker
+            playbook_index.build()
+        preloaded = True
+        os.register_at_fork(after_in_child=start_after_fork)
+        logger.info(f"Preloaded in {startup_timer.total():.3f}s ({startup_timer.summary()}), workers start their services after the fork")
+    else:
+        start_services()
+        start_metrics_exporter()
 
     return app
 
@@ -0,0 +1,13 @@
+import ansible_link
+from ansible_link import main, prefix
+from async_server import AsgiServer
+
+# run with any asgi server, e.g. uvicorn asgi:application
+app = main()
+asgi_config = ansible_link.config.get('asgi', {})
+event_stream_config = ansible_link.config.get('event_stream', {})
+application = AsgiServer(app, ansible_link.job_storage, ansible_link.event_broadcaster, f"{prefix}/ansible",
+                         threads=asgi_config.get('threads', 32),
+                         poll_interval=asgi_config.get('poll_interval', 1),
+                         keepalive=event_stream_config.get('keepalive', 15),
+                         max_wait=event_stream_config.get('max_wait', 300))
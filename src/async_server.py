@@ -0,0 +1,348 @@
+"""
+ANSIBLE-LINK class for the asgi server mode
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import io
+import re
+import sys
+import asyncio
+import logging
+from urllib.parse import parse_qsl, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from ansible_link import ACTIVE_STATUSES, format_sse
+
+logger = logging.getLogger(__name__)
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return body
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+def wsgi_environ(scope, body, query_string):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': query_string.decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+class WsgiBridge:
+    """runs the flask app for one asgi request in a thread of a pool, the way a threaded wsgi server would"""
+
+    def __init__(self, app, threads=32):
+        self.app = app
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='ansible-link-wsgi')
+
+    async def respond(self, scope, body, send, query_string=None):
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(scope, body, scope.get('query_string', b'') if query_string is None else query_string)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return lambda data: None
+
+        result = await loop.run_in_executor(self.pool, self.app, environ, start_response)
+        try:
+            chunks = iter(result)
+            chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.pool, result.close)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+class JobWatcher:
+    """wakes coroutines waiting on jobs: local jobs through the event broadcaster, jobs of other processes through one shared status poll"""
+
+    def __init__(self, loop, job_storage, event_broadcaster, poll_interval=1, executor=None):
+        self.loop = loop
+        self.executor = executor
+        self.job_storage = job_storage
+        self.event_broadcaster = event_broadcaster
+        self.poll_interval = poll_interval
+        self._waiters = {}          # job_id -> futures woken by any event
+        self._status_waiters = {}   # job_id -> futures woken by status changes only
+        self._remote = {}           # job_id -> last status seen in the storage
+        self._poller = None
+        event_broadcaster.add_listener(self._on_event)
+
+    def close(self):
+        self.event_broadcaster.remove_listener(self._on_event)
+
+    def _on_event(self, job_id, event_type):
+        # runner thread, only jobs somebody waits for cost a wakeup of the loop
+        if job_id in self._waiters or job_id in self._status_waiters:
+            try:
+                self.loop.call_soon_threadsafe(self._wake, job_id, event_type)
+            except RuntimeError:
+                pass    # event loop closed
+
+    def _wake(self, job_id, event_type):
+        groups = [self._waiters]
+        if event_type in ('status', None):
+            groups.append(self._status_waiters)
+        for group in groups:
+            for future in group.pop(job_id, ()):
+                if not future.done():
+                    future.set_result(None)
+
+    def watch(self, job_id, status_only=False):
+        """registers a waiter, check the job's state after this and before wait() so no change is missed in between"""
+        group = self._status_waiters if status_only else self._waiters
+        future = self.loop.create_future()
+        group.setdefault(job_id, set()).add(future)
+        return future
+
+    def unwatch(self, job_id, future):
+        for group in (self._waiters, self._status_waiters):
+            waiters = group.get(job_id)
+            if waiters and future in waiters:
+                waiters.discard(future)
+                if not waiters:
+                    del group[job_id]
+        future.cancel()
+
+    async def wait(self, job_id, future, timeout):
+        """True if the job changed before timeout"""
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.unwatch(job_id, future)
+
+    def track_remote(self, job_id, status):
+        # not running in this process, its status changes only show up in the storage
+        self._remote.setdefault(job_id, status)
+        if self._poller is None:
+            self._poller = self.loop.create_task(self._poll_remote())
+
+    async def _poll_remote(self):
+        try:
+            while self._remote:
+                await asyncio.sleep(self.poll_interval)
+                for job_id in [job_id for job_id in self._remote if job_id not in self._waiters and job_id not in self._status_waiters]:
+                    del self._remote[job_id]
+                if not self._remote:
+                    break
+                # one query for every waiting client, not one per client
+                job_ids = list(self._remote)
+                statuses = await self.loop.run_in_executor(self.executor, self.job_storage.job_statuses, job_ids)
+                for job_id in job_ids:
+                    status = statuses.get(job_id)
+                    if job_id in self._remote and status != self._remote[job_id]:
+                        self._remote[job_id] = status
+                        self._wake(job_id, 'status')
+        except Exception as e:
+            logger.error(f"Polling the status of remote jobs failed: {str(e)}")
+        finally:
+            self._poller = None
+
+class AsgiServer:
+    """asgi application: job long-polls and event streams wait on the event loop, every other request runs in the flask app"""
+
+    def __init__(self, app, job_storage, event_broadcaster, prefix, threads=32, poll_interval=1, keepalive=15, max_wait=300):
+        self.bridge = WsgiBridge(app, threads)
+        self.job_storage = job_storage
+        self.event_broadcaster = event_broadcaster
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.max_wait = max_wait
+        self.watcher = None
+        self.job_path = re.compile(rf"{re.escape(prefix)}/job/([^/]+)")
+        self.stream_path = re.compile(rf"{re.escape(prefix)}/job/([^/]+)/stream")
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        loop = asyncio.get_running_loop()
+        if self.watcher is None or self.watcher.loop is not loop:
+            if self.watcher:
+                self.watcher.close()
+            self.watcher = JobWatcher(loop, self.job_storage, self.event_broadcaster, self.poll_interval,
+                                      self.bridge.pool)
+
+        body = await read_body(receive)
+        if scope['method'] == 'GET':
+            params = parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+            match = self.job_path.fullmatch(scope['path'])
+            if match and 'wait' in dict(params):
+                await self.long_poll(scope, body, receive, send, match.group(1), params)
+                return
+            match = self.stream_path.fullmatch(scope['path'])
+            if match:
+                await self.stream(scope, body, receive, send, match.group(1), params)
+                return
+        await self.bridge.respond(scope, body, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+        self.bridge.close()
+
+    async def job_status(self, job_id):
+        loop = asyncio.get_running_loop()
+        return (await loop.run_in_executor(self.bridge.pool, self.job_storage.job_statuses, [job_id])).get(job_id)
+
+    async def long_poll(self, scope, body, receive, send, job_id, params):
+        query = dict(params)
+        try:
+            wait = float(query['wait'])
+        except ValueError:
+            wait = -1
+        if not 0 <= wait <= self.max_wait:
+            # invalid, the flask app answers with the error
+            await self.bridge.respond(scope, body, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        disconnected = loop.create_task(receive())
+        try:
+            while not disconnected.done():
+                future = self.watcher.watch(job_id, status_only=True)
+                status = await self.job_status(job_id)
+                remaining = deadline - loop.time()
+                if status not in ACTIVE_STATUSES or remaining <= 0:
+                    self.watcher.unwatch(job_id, future)
+                    break
+                if not self.event_broadcaster.is_open(job_id):
+                    self.watcher.track_remote(job_id, status)
+                waiting = loop.create_task(self.watcher.wait(job_id, future, remaining))
+                await asyncio.wait([disconnected, waiting], return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+            if disconnected.done():
+                return
+        finally:
+            disconnected.cancel()
+
+        # the response itself (ranges, gzip, errors) comes from the flask app, without waiting there again
+        query_string = urlencode([(key, value) for key, value in params if key != 'wait']).encode('latin-1')
+        await self.bridge.respond(scope, body, send, query_string)
+
+    async def stream(self, scope, body, receive, send, job_id, params):
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+        try:
+            last_event_id = int(headers.get('last-event-id', dict(params).get('last_event_id', 0)))
+        except ValueError:
+            await self.bridge.respond(scope, body, send)
+            return
+
+        if self.event_broadcaster.is_open(job_id):
+            events = self.local_events(job_id, last_event_id)
+        else:
+            status = await self.job_status(job_id)
+            if status not in ACTIVE_STATUSES:
+                # unknown or finished, answered by the flask app
+                await self.bridge.respond(scope, body, send)
+                return
+            events = self.remote_events(job_id, status)
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': SSE_HEADERS})
+        loop = asyncio.get_running_loop()
+        disconnected = loop.create_task(receive())
+        try:
+            async for event in events:
+                if disconnected.done():
+                    return
+                data = ': keepalive\n\n' if event is None else format_sse(*event)
+                await send({'type': 'http.response.body', 'body': data.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            await events.aclose()
+
+    async def local_events(self, job_id, last_event_id):
+        while True:
+            future = self.watcher.watch(job_id)
+            polled = self.event_broadcaster.poll(job_id, last_event_id)
+            if polled is None:
+                self.watcher.unwatch(job_id, future)
+                return
+            events, finished = polled
+            if events or finished:
+                self.watcher.unwatch(job_id, future)
+                for event in events:
+                    yield event
+                if not events:
+                    return
+                last_event_id = events[-1][0]
+                continue
+            if not await self.watcher.wait(job_id, future, self.keepalive):
+                yield None
+
+    async def remote_events(self, job_id, status):
+        event_id = 1
+        yield event_id, 'status', {'status': status}
+        while status in ACTIVE_STATUSES:
+            future = self.watcher.watch(job_id, status_only=True)
+            self.watcher.track_remote(job_id, status)
+            if not await self.watcher.wait(job_id, future, self.keepalive):
+                yield None
+                continue
+            current = await self.job_status(job_id) or 'error'
+            if current != status:
+                status = current
+                event_id += 1
+                yield event_id, 'status', {'status': status}
@@ -0,0 +1,405 @@
+"""
+ANSIBLE-LINK benchmark for the API and job pipeline
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+FIXTURE_VERSION = 1
+FIXTURE_CHUNK = 10000
+SAMPLE_SIZE = 1000
+PLAYBOOKS = [f'bench_{i:02d}.yml' for i in range(20)]
+STATUSES = ['completed'] * 16 + ['failed'] * 3 + ['error']
+FINAL_STATUSES = ('completed', 'failed', 'error', 'rejected', 'cancelled')
+
+class FakeExecutor:
+    """stands in for ansible-runner: emits events with output of a given size and sleeps for the job duration"""
+
+    def __init__(self, duration=0.0, events=20, event_size=200, hosts=5):
+        self.duration = duration
+        self.events = events
+        self.event_size = event_size
+        self.hosts = hosts
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def execute(self, job_id, runner_kwargs, on_event, on_status, cancelled=None):
+        on_status('starting')
+        on_status('running')
+        pause = self.duration / self.events if self.events else 0
+        line = 'x' * self.event_size
+        status = 'successful'
+        for counter in range(1, self.events + 1):
+            if cancelled and cancelled():
+                status = 'canceled'
+                break
+            host = f'host-{counter % self.hosts}'
+            on_event(line, {'event': 'runner_on_ok', 'counter': counter, 'stdout': line, 'host': host,
+                            'task': f'task {counter // self.hosts}', 'task_uuid': f'task-{counter // self.hosts}', 'duration': pause})
+            if pause:
+                time.sleep(pause)
+        if not self.events and self.duration:
+            time.sleep(self.duration)
+        on_status(status)
+        return {
+            'status': status,
+            'rc': 0 if status == 'successful' else 254,
+            'stats': {'ok': {f'host-{i}': self.events // self.hosts for i in range(self.hosts)}},
+            'stdout': None,
+            'stderr': '',
+            'command': f"ansible-playbook {runner_kwargs['playbook']}",
+        }
+
+def percentile(sorted_values, fraction):
+    # nearest rank, the same value a reader finds by counting
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def process_usage():
+    usage = {'rss_bytes': None, 'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 'open_fds': None}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    usage['rss_bytes'] = int(line.split()[1]) * 1024
+        usage['open_fds'] = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        pass
+    return usage
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def build_fixture(fixture_dir, jobs, seed=0, output_size=65536):
+    """a job storage with `jobs` finished jobs, reused when it already exists with the same parameters"""
+    from job_storage import SQLiteJobStorage
+
+    fixture_dir = Path(fixture_dir)
+    manifest_path = fixture_dir / 'fixture.json'
+    manifest = {'version': FIXTURE_VERSION, 'jobs': jobs, 'seed': seed, 'output_size': output_size}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            existing = json.load(f)
+        if {key: existing.get(key) for key in manifest} == manifest:
+            return existing
+
+    fixture_dir.mkdir(parents=True, exist_ok=True)
+    for name in ('jobs.db', 'jobs.db-wal', 'jobs.db-shm'):
+        (fixture_dir / name).unlink(missing_ok=True)
+    storage = SQLiteJobStorage(fixture_dir)
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    step = timedelta(days=365) / max(jobs, 1)
+    sample = set(rng.sample(range(jobs), min(SAMPLE_SIZE, jobs)))
+    sample_ids = []
+
+    started = time.perf_counter()
+    chunk = {}
+    for i in range(jobs):
+        job_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        start_time = start + step * i
+        chunk[job_id] = {
+            'status': rng.choice(STATUSES),
+            'playbook': f'/etc/ansible/{rng.choice(PLAYBOOKS)}',
+            'inventory': '/etc/ansible/hosts',
+            'vars': {'release': i},
+            'forks': 5,
+            'start_time': start_time.isoformat(),
+            'end_time': (start_time + timedelta(seconds=rng.randint(5, 600))).isoformat(),
+        }
+        if i in sample:
+            sample_ids.append(job_id)
+        if len(chunk) >= FIXTURE_CHUNK:
+            storage.save_jobs(chunk)
+            chunk = {}
+    if chunk:
+        storage.save_jobs(chunk)
+
+    # output logs only for the sampled jobs, the endpoints read one job at a time
+    line = ('ok: [host] => ' + 'x' * 50 + '\n')
+    for job_id in sample_ids:
+        with storage.open_output_log(job_id) as log:
+            log.write(line * max(1, output_size // len(line)))
+
+    manifest['sample'] = sample_ids
+    manifest['build_seconds'] = round(time.perf_counter() - started, 2)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+def write_config(work_dir, fixture_dir, workers, max_queue):
+    work_dir = Path(work_dir)
+    playbook_dir = work_dir / 'playbooks'
+    playbook_dir.mkdir(parents=True, exist_ok=True)
+    (playbook_dir / 'bench.yml').write_text('- hosts: all\n  gather_facts: false\n  tasks: []\n')
+    inventory_file = work_dir / 'hosts.ini'
+    inventory_file.write_text('localhost ansible_connection=local\n')
+
+    config = {
+        'host': '127.0.0.1',
+        'port': 5001,
+        'debug': False,
+        'suppress_ansible_output': True,
+        'omit_event_data': False,
+        'only_failed_event_data': False,
+        'metrics_port': 9090,
+        'playbook_dir': str(playbook_dir),
+        'inventory_file': str(inventory_file),
+        'job_storage_dir': str(fixture_dir),
+        'job_storage_backend': 'sqlite',
+        'log_level': 'WARNING',
+        'playbook_whitelist': [],
+        'playbook_catalog': {'inotify': False},
+        'inventory_cache': {'validate_limit': False},
+        'scheduler': {'max_workers': workers, 'max_queue': max_queue},
+        'retention': {'enabled': False},
+    }
+    config_path = work_dir / 'config.yml'
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+def measure(app, name, requests, concurrency, expected=(200, 202)):
+    """runs requests ([(method, path, json)]) with `concurrency` clients and returns latency, RSS and fd numbers"""
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def call(request):
+        nonlocal errors
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        method, path, payload = request
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=payload)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code not in expected:
+                errors += 1
+        return response
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        responses = list(pool.map(call, requests))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        'name': name,
+        'concurrency': concurrency,
+        'requests': len(requests),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'rps': round(len(requests) / wall, 1),
+    }
+    result.update(process_usage())
+    return result, responses
+
+def wait_for_jobs(job_storage, job_ids, timeout):
+    pending = set(job_ids)
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        pending = {job_id for job_id in pending if (job_storage.get_job(job_id) or {}).get('status') not in FINAL_STATUSES}
+        if pending:
+            time.sleep(0.05)
+    return len(job_ids) - len(pending)
+
+def run_single(args):
+    """one fixture size in this process, the app (and its prometheus metrics) can only be set up once per process"""
+    work_dir = Path(args.work_dir)
+    fixture_dir = work_dir / f'fixture-{args.jobs}'
+    fixture = build_fixture(fixture_dir, args.jobs, seed=args.seed, output_size=args.output_size)
+    os.environ['ANSIBLE_LINK_CONFIG_PATH'] = str(write_config(work_dir, fixture_dir, args.workers, args.pipeline_jobs + 1))
+
+    import ansible_link
+    app = ansible_link.init_app()
+    ansible_link.job_executor = FakeExecutor(duration=args.job_duration, events=args.job_events, event_size=args.event_size)
+    api_path = f"{ansible_link.prefix}/ansible"
+
+    rng = random.Random(args.seed)
+    sample = fixture['sample'] or ['missing']
+    requests = args.requests
+
+    # name -> (requests, expected status codes)
+    scenarios = {
+        'jobs_first_page': lambda: ([('GET', f'{api_path}/jobs?limit=100', None)] * requests, (200,)),
+        'jobs_filtered': lambda: ([('GET', f'{api_path}/jobs?status=failed&playbook=/etc/ansible/{rng.choice(PLAYBOOKS)}&limit=50', None)
+                                   for _ in range(requests)], (200,)),
+        'jobs_all_fields': lambda: ([('GET', f'{api_path}/jobs?limit=500&fields=status,playbook,start_time,vars', None)] * requests, (200,)),
+        'job_get': lambda: ([('GET', f'{api_path}/job/{rng.choice(sample)}?limit=0', None) for _ in range(requests)], (200,)),
+        'job_get_output': lambda: ([('GET', f'{api_path}/job/{rng.choice(sample)}', None) for _ in range(requests)], (200,)),
+        'job_get_missing': lambda: ([('GET', f'{api_path}/job/{uuid.UUID(int=rng.getrandbits(128))}', None) for _ in range(requests)], (404,)),
+    }
+
+    endpoints = []
+    for concurrency in args.concurrency:
+        for name, build in scenarios.items():
+            scenario_requests, expected = build()
+            result, _ = measure(app, name, scenario_requests, concurrency, expected)
+            endpoints.append(result)
+
+    # job pipeline: submission latency and throughput until every job is finished
+    submissions = [('POST', f'{api_path}/playbook', {'playbook': 'bench.yml', 'vars': {'run': i}}) for i in range(args.pipeline_jobs)]
+    started = time.perf_counter()
+    pipeline, responses = measure(app, 'playbook_post', submissions, max(args.concurrency))
+    job_ids = [response.get_json()['job_id'] for response in responses if response.status_code in (200, 202)]
+    finished = wait_for_jobs(ansible_link.job_storage, job_ids, args.timeout)
+    elapsed = time.perf_counter() - started
+    pipeline.update({
+        'jobs_submitted': len(job_ids),
+        'jobs_finished': finished,
+        'jobs_per_second': round(finished / elapsed, 2),
+        'job_duration': args.job_duration,
+        'job_events': args.job_events,
+        'event_size': args.event_size,
+    })
+    endpoints.append(pipeline)
+
+    ansible_link.job_scheduler.stop()
+    # the benchmark jobs are removed again with their runner directories, so the fixture stays the same between runs
+    ansible_link.job_storage.delete_jobs(job_ids)
+    for job_id in job_ids:
+        shutil.rmtree(Path(ansible_link.job_storage_dir) / job_id, ignore_errors=True)
+    return {'jobs': args.jobs, 'fixture_build_seconds': fixture.get('build_seconds'), 'endpoints': endpoints}
+
+def compare(baseline, results, threshold):
+    """prints p50/p99 changes against a previous result file, returns the regressions beyond threshold"""
+    def index(data):
+        return {(run['jobs'], endpoint['name'], endpoint['concurrency']): endpoint
+                for run in data['runs'] for endpoint in run['endpoints']}
+
+    before, after = index(baseline), index(results)
+    regressions = []
+    print(f"{'jobs':>8} {'endpoint':<18} {'conc':>4} {'p50 ms':>18} {'p99 ms':>18}")
+    for key in sorted(set(before) & set(after)):
+        changes = []
+        for metric in ('p50_ms', 'p99_ms'):
+            old, new = before[key][metric], after[key][metric]
+            change = (new - old) / old if old else 0
+            changes.append(f"{new:>8.2f} ({change:+6.1%})")
+            if change > threshold:
+                regressions.append((key, metric, old, new))
+        print(f"{key[0]:>8} {key[1]:<18} {key[2]:>4} {changes[0]:>18} {changes[1]:>18}")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Ansible-Link API and job pipeline offline, with a fake runner')
+    parser.add_argument('--jobs', default='10000,100000,1000000', help='comma-separated job storage sizes, default 10k, 100k and 1M')
+    parser.add_argument('--concurrency', default='1,8', help='comma-separated numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint and concurrency')
+    parser.add_argument('--pipeline-jobs', type=int, default=200, help='jobs submitted with POST /playbook')
+    parser.add_argument('--workers', type=int, default=4, help='scheduler workers running the fake jobs')
+    parser.add_argument('--job-duration', type=float, default=0.05, help='seconds each fake job runs')
+    parser.add_argument('--job-events', type=int, default=20, help='runner events each fake job emits')
+    parser.add_argument('--event-size', type=int, default=200, help='stdout bytes per runner event')
+    parser.add_argument('--output-size', type=int, default=65536, help='stdout bytes of the fixture jobs read by job_get_output')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the pipeline jobs')
+    parser.add_argument('--work-dir', help='where fixtures are built and kept for the next run, default a directory in the system temp dir')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='results JSON of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='p50/p99 increase counted as regression, default 0.2 (20%%)')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.concurrency = [int(value) for value in args.concurrency.split(',')]
+    args.work_dir = args.work_dir or str(Path(tempfile.gettempdir()) / 'ansible-link-benchmark')
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    Path(args.work_dir).mkdir(parents=True, exist_ok=True)
+
+    if args.single:
+        args.jobs = int(args.jobs)
+        json.dump(run_single(args), sys.stdout)
+        return 0
+
+    runs = []
+    passthrough = argv if argv is not None else sys.argv[1:]
+    for jobs in [int(value) for value in args.jobs.split(',')]:
+        print(f"Benchmarking with {jobs} jobs in storage ...", file=sys.stderr)
+        # a fresh process per size, so RSS and open fds are not carried over from the previous one
+        command = [sys.executable, __file__] + strip_options(passthrough, ('--jobs', '--output', '--compare', '--threshold')) + \
+                  ['--single', '--jobs', str(jobs), '--work-dir', args.work_dir]
+        completed = subprocess.run(command, stdout=subprocess.PIPE, check=True, cwd=Path(__file__).parent)
+        runs.append(json.loads(completed.stdout.decode().strip().splitlines()[-1]))
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('single', 'output', 'compare', 'work_dir')},
+        },
+        'runs': runs,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for (jobs, name, concurrency), metric, old, new in regressions:
+            print(f"Regression: {name} (jobs={jobs}, concurrency={concurrency}) {metric} {old} -> {new}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+def strip_options(argv, options):
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        if arg in options:
+            skip = True
+            continue
+        if arg.split('=', 1)[0] in options:
+            continue
+        stripped.append(arg)
+    return stripped
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""
+ANSIBLE-LINK class for compressed job output
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import zlib
+import json
+import bisect
+
+SEGMENT_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+def compress_log(src_path, dst_path, level=6, segment_size=SEGMENT_SIZE):
+    """gzips a log, returns its index: {'size': raw bytes, 'segments': [[raw offset, compressed offset], ...]}
+
+    the result is a single gzip member, valid for any gzip reader and for Content-Encoding: gzip. Every
+    segment_size bytes the deflate stream is fully flushed, reading can start at any segment from there.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    segments = [[0, 0]]
+    raw = 0
+    written = 0
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        while True:
+            chunk = src.read(segment_size)
+            if not chunk:
+                break
+            if raw:
+                data = compressor.flush(zlib.Z_FULL_FLUSH)
+                dst.write(data)
+                written += len(data)
+                segments.append([raw, written])
+            data = compressor.compress(chunk)
+            dst.write(data)
+            written += len(data)
+            raw += len(chunk)
+        dst.write(compressor.flush())
+        dst.flush()
+        os.fsync(dst.fileno())
+    return {'size': raw, 'segments': segments}
+
+def iter_decompressed(stream, index, offset=0):
+    """yields the decompressed bytes from offset on, only the segment holding offset and the ones after it are read"""
+    segments = index['segments']
+    if offset >= index['size']:
+        return
+    raw_start, compressed_start = segments[bisect.bisect_right([raw for raw, _ in segments], offset) - 1]
+    stream.seek(compressed_start)
+    # the first segment starts with the gzip header, the others are raw deflate after a full flush
+    decompressor = zlib.decompressobj(31 if compressed_start == 0 else -15)
+    skip = offset - raw_start
+    while True:
+        # past the end of the deflate stream only the gzip trailer is left
+        data = b'' if decompressor.eof else decompressor.unconsumed_tail or stream.read(READ_SIZE)
+        # bounded output per call, a highly compressed segment does not expand in memory at once
+        chunk = decompressor.decompress(data, READ_SIZE * 4) if data else decompressor.flush()
+        if skip:
+            dropped = min(skip, len(chunk))
+            chunk = chunk[dropped:]
+            skip -= dropped
+        if chunk:
+            yield chunk
+        if not data:
+            return
+
+def iter_file(stream, chunk_size=READ_SIZE):
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            return
+        yield data
+
+def slice_chunks(chunks, offset, limit, unit):
+    """(bytes, next_offset) of a byte range (chunks start at offset) or a line range (chunks start at 0)"""
+    parts = []
+    if unit == 'lines':
+        skipped = 0
+        taken = 0
+        for chunk in chunks:
+            position = 0
+            while skipped < offset:
+                newline = chunk.find(b'\n', position)
+                if newline == -1:
+                    position = len(chunk)
+                    break
+                position = newline + 1
+                skipped += 1
+            if skipped < offset:
+                continue
+            if limit is None:
+                parts.append(chunk[position:])
+                continue
+            while taken < limit and position < len(chunk):
+                newline = chunk.find(b'\n', position)
+                end = len(chunk) if newline == -1 else newline + 1
+                parts.append(chunk[position:end])
+                position = end
+                taken += newline != -1
+            if taken >= limit:
+                break
+        data = b''.join(parts)
+        return data, offset + data.count(b'\n')
+
+    remaining = limit
+    for chunk in chunks:
+        if remaining is not None:
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+        parts.append(chunk)
+        if remaining is not None and remaining <= 0:
+            break
+    data = b''.join(parts)
+    return data, offset + len(data)
+
+def dump_index(index):
+    return json.dumps(index, separators=(',', ':'))
@@ -0,0 +1,140 @@
+"""
+ANSIBLE-LINK class for configuration reloads
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import re
+import json
+import signal
+import hashlib
+import logging
+import threading
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# paths in the config relative to the ansible-link directory
+PATH_KEYS = ('playbook_dir', 'inventory_file', 'job_storage_dir')
+# read once when the process starts its services, a reload keeps the running value and logs that a restart is needed
+RESTART_KEYS = ('host', 'port', 'debug', 'metrics_port', 'job_storage_dir', 'job_storage_backend', 'scheduler',
+                'execution', 'coordination', 'event_stream', 'asgi', 'startup', 'config_reload')
+
+class ConfigError(Exception):
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+def resolve_paths(config, base_dir):
+    """makes the relative PATH_KEYS absolute, returns the keys that were resolved"""
+    resolved = []
+    for key in PATH_KEYS:
+        if key in config and not os.path.isabs(config[key]):
+            config[key] = os.path.abspath(os.path.join(base_dir, config[key]))
+            resolved.append(key)
+    return resolved
+
+def config_digest(config):
+    # of the parsed config, a comment or formatting change does not count as a change
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+def read_config(path):
+    """parses and validates a config file, returns (config, compiled_whitelist) or raises ConfigError"""
+    try:
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        raise ConfigError([f"Cannot read {path}: {str(e)}"])
+    if not isinstance(config, dict):
+        raise ConfigError([f"{path} is not a mapping"])
+
+    errors = [f"'{key}' is required" for key in ('playbook_dir', 'inventory_file') if not config.get(key)]
+    compiled_whitelist = []
+    for pattern in config.get('playbook_whitelist') or []:
+        try:
+            compiled_whitelist.append(re.compile(pattern))
+        except (re.error, TypeError) as e:
+            errors.append(f"Invalid playbook_whitelist pattern {pattern!r}: {str(e)}")
+    if errors:
+        raise ConfigError(errors)
+    return config, compiled_whitelist
+
+def changed_keys(old, new):
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+def keep_restart_keys(old, new, changed):
+    """puts the running values of changed RESTART_KEYS back into new, returns those keys"""
+    kept = [key for key in changed if key in RESTART_KEYS]
+    for key in kept:
+        if key in old:
+            new[key] = old[key]
+        else:
+            new.pop(key, None)
+    return kept
+
+def install_reload_signal(reload):
+    """reloads on SIGHUP, only possible from the main thread"""
+    if threading.current_thread() is not threading.main_thread():
+        return False
+
+    def run():
+        try:
+            reload()
+        except Exception as e:
+            logger.error(f"Failed to reload configuration: {str(e)}")
+
+    def handle(signum, frame):
+        # not in the signal handler itself, the interrupted thread may hold the locks a reload takes
+        threading.Thread(target=run, name='ansible-link-config-reload', daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handle)
+    return True
+
+class ConfigWatcher:
+    """polls the config file and calls reload when it was written, each worker process watches on its own"""
+
+    def __init__(self, path, reload, interval=5):
+        self.path = path
+        self.reload = reload
+        self.interval = interval
+        self._signature = self._stat()
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def start(self):
+        if self._worker is not None:
+            return
+        self._stopped.clear()
+        self._worker = threading.Thread(target=self._loop, name='ansible-link-config-watcher', daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._worker:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def check(self):
+        signature = self._stat()
+        if signature == self._signature or signature is None:
+            return False
+        self._signature = signature
+        try:
+            self.reload()
+        except Exception as e:
+            logger.error(f"Failed to reload configuration from {self.path}: {str(e)}")
+        return True
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
@@ -0,0 +1,240 @@
+"""
+ANSIBLE-LINK class for coordination between processes
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import time
+import fcntl
+import socket
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+from prometheus_client import CollectorRegistry, REGISTRY, start_http_server, multiprocess
+
+logger = logging.getLogger(__name__)
+
+class LeaderLock:
+    """exclusive flock on a file, only the holder runs tasks that must exist once per host (metrics server, retention)"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        with self._lock:
+            if self._file is not None:
+                return True
+            lock_file = open(self.path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._file = lock_file
+            logger.info(f"Process {os.getpid()} holds {self.path}")
+            return True
+
+    def release(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class NullMetric:
+    """stands in for a metric the app did not create, every update is ignored"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def remove(self, *labels):
+        pass
+
+class GaugeSampler:
+    """keeps gauges at the value of a function. prometheus multiprocess mode does not export set_function gauges,
+    there every process samples the functions into its gauges every interval seconds"""
+
+    def __init__(self, interval=5, multiprocess=None):
+        self.interval = interval
+        self.multiprocess = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR')) if multiprocess is None else multiprocess
+        self._gauges = {}  # gauge -> function
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def track(self, gauge, function):
+        if not self.multiprocess:
+            gauge.set_function(function)
+            return
+        with self._lock:
+            self._gauges[gauge] = function
+        self._set(gauge, function)
+
+    def start(self):
+        # threads do not survive a fork, each worker process starts its own
+        if not self.multiprocess or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._loop, name='ansible-link-gauge-sampler', daemon=True).start()
+
+    def sample(self):
+        with self._lock:
+            gauges = list(self._gauges.items())
+        for gauge, function in gauges:
+            self._set(gauge, function)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    @staticmethod
+    def _set(gauge, function):
+        try:
+            gauge.set(function())
+        except Exception as e:
+            logger.debug(f"Failed to sample gauge: {str(e)}")
+
+class MetricsExporter:
+    """starts the metrics server in exactly one process, the others take over when it exits"""
+
+    def __init__(self, port, lock_path, retry_interval=30):
+        self.port = port
+        self.leader_lock = LeaderLock(lock_path)
+        self.retry_interval = retry_interval
+        self._worker = None
+
+    def start(self):
+        if self._try_export():
+            return
+        self._worker = threading.Thread(target=self._wait_for_lock, name='ansible-link-metrics-election', daemon=True)
+        self._worker.start()
+
+    def _wait_for_lock(self):
+        while not self._try_export():
+            time.sleep(self.retry_interval)
+
+    def _try_export(self):
+        if not self.leader_lock.try_acquire():
+            return False
+        registry = REGISTRY
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            # prometheus multiprocess mode, counters and histograms of every worker are summed up
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        try:
+            start_http_server(self.port, registry=registry)
+        except OSError as e:
+            logger.error(f"Failed to start metrics server on port {self.port}: {str(e)}")
+            self.leader_lock.release()
+            return False
+        logger.info(f"Metrics server started in process {os.getpid()}, port {self.port}")
+        return True
+
+class SlotLeases:
+    """a limit of running jobs shared by every process (and host) using the same database"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            job_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db_path, slots, ttl=60, poll_interval=0.5):
+        self.db_path = Path(db_path)
+        self.slots = slots
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._held = set()
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._worker = None
+        self._connect().executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # autocommit, transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        if self._worker is not None:
+            return
+        self._worker = threading.Thread(target=self._heartbeat, name='ansible-link-slot-leases', daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._worker:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def try_acquire(self, job_id):
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # leases of crashed processes are not renewed and run out
+            conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            active = conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+            acquired = active < self.slots
+            if acquired:
+                conn.execute("INSERT OR REPLACE INTO leases (job_id, owner, expires) VALUES (?, ?, ?)", (job_id, self.owner, now + self.ttl))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if acquired:
+            self._held.add(job_id)
+        return acquired
+
+    def acquire(self, job_id, cancelled=None):
+        """waits for a free slot, returns False if cancelled() turned true first"""
+        waited = False
+        while not self.try_acquire(job_id):
+            if not waited:
+                logger.info(f"Job {job_id} waits for one of {self.slots} global job slots")
+                waited = True
+            if cancelled and cancelled():
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def release(self, job_id):
+        self._held.discard(job_id)
+        self._connect().execute("DELETE FROM leases WHERE job_id = ? AND owner = ?", (job_id, self.owner))
+
+    def active(self):
+        return self._connect().execute("SELECT COUNT(*) FROM leases WHERE expires >= ?", (time.time(),)).fetchone()[0]
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.ttl / 3):
+            if not self._held:
+                continue
+            try:
+                self._connect().execute("UPDATE leases SET expires = ? WHERE owner = ?", (time.time() + self.ttl, self.owner))
+            except sqlite3.Error as e:
+                logger.error(f"Failed to renew job slot leases: {str(e)}")
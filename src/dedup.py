@@ -0,0 +1,80 @@
+"""
+ANSIBLE-LINK class for job deduplication
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# fields of a PlaybookRequest that change what a run does, priority only changes when it runs
+SPEC_FIELDS = ('playbook_path', 'inventory_path', 'vars', 'forks', 'verbosity', 'limit', 'tags', 'skip_tags', 'cmdline')
+
+def _canonical_tags(tags):
+    return ','.join(sorted({tag.strip() for tag in tags.split(',')})) if tags else None
+
+def spec_key(playbook_request):
+    spec = {field: getattr(playbook_request, field) for field in SPEC_FIELDS}
+    spec['tags'] = _canonical_tags(spec['tags'])
+    spec['skip_tags'] = _canonical_tags(spec['skip_tags'])
+    canonical = json.dumps(spec, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class JobDeduplicator:
+    """maps identical job specs to the job already running them, or to a recent successful result"""
+
+    def __init__(self, ttl=0, playbook_ttls=None):
+        self.ttl = ttl
+        self.playbook_ttls = playbook_ttls or {}
+        self._inflight = {}    # key -> job_id
+        self._completed = {}   # key -> (job_id, expires_at)
+        self._lock = threading.Lock()
+
+    def ttl_for(self, playbook):
+        """seconds a successful result is reused, None if the playbook is not deduplicated"""
+        if self.playbook_ttls:
+            return self.playbook_ttls.get(playbook)
+        return self.ttl
+
+    def acquire(self, key, job_id):
+        """registers job_id for key, or returns (existing_job_id, 'inflight'|'cached') when the spec is already served"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._inflight:
+                return self._inflight[key], 'inflight'
+            if key in self._completed:
+                return self._completed[key][0], 'cached'
+            self._inflight[key] = job_id
+        return None
+
+    def release(self, key, job_id):
+        # the job was never run (e.g. rejected by the scheduler)
+        with self._lock:
+            if self._inflight.get(key) == job_id:
+                del self._inflight[key]
+
+    def release_job(self, job_id):
+        # the job was cancelled before it ran, its key is not known here
+        with self._lock:
+            for key in [key for key, inflight_job_id in self._inflight.items() if inflight_job_id == job_id]:
+                del self._inflight[key]
+
+    def finish(self, key, job_id, status, playbook):
+        ttl = self.ttl_for(playbook) or 0
+        with self._lock:
+            if self._inflight.get(key) == job_id:
+                del self._inflight[key]
+            # only successful runs are reused, a failed run is retried by the next request
+            if status == 'completed' and ttl > 0:
+                self._completed[key] = (job_id, time.monotonic() + ttl)
+
+    def _expire(self, now):
+        for key in [key for key, (_, expires_at) in self._completed.items() if expires_at <= now]:
+            del self._completed[key]
@@ -0,0 +1,94 @@
+"""
+ANSIBLE-LINK class for the runner event index
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+
+from events import summarize_event
+from timings import HOST_RESULT_EVENTS
+
+logger = logging.getLogger(__name__)
+
+# statuses kept with their stdout, the message is what the index is queried for
+FAILED_STATUSES = ('failed', 'unreachable', 'ignored')
+
+def event_row(summary, stdout_limit=4096):
+    """the indexed form of a per host result, None for every other event"""
+    status = HOST_RESULT_EVENTS.get(summary.get('event'))
+    if status is None or not summary.get('host'):
+        return None
+    if status == 'ok' and summary.get('changed'):
+        status = 'changed'
+    elif status == 'failed' and summary.get('ignore_errors'):
+        status = 'ignored'
+
+    stdout = summary.get('stdout') if status in FAILED_STATUSES else None
+    return {
+        'counter': summary.get('counter'),
+        'event': summary['event'],
+        'status': status,
+        'host': summary['host'],
+        'task': summary.get('task'),
+        'play': summary.get('play'),
+        'role': summary.get('role'),
+        'duration': summary.get('duration'),
+        # ansible-runner timestamps are UTC without an offset
+        'created': summary.get('created') or datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+        'stdout': stdout[:stdout_limit] if stdout else None,
+    }
+
+def artifact_events(private_data_dir):
+    """summaries of the job_events/*.json ansible-runner left in a job's private_data_dir, in event order"""
+    events = []
+    for path in Path(private_data_dir).glob('artifacts/*/job_events/*.json'):
+        try:
+            with open(path, 'r') as f:
+                events.append(summarize_event(json.load(f)))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable runner event {path}: {str(e)}")
+    events.sort(key=lambda event: event.get('counter') or 0)
+    return events
+
+class EventIndexer:
+    """collects the host results of a running job and writes them to the job storage in batches"""
+
+    def __init__(self, job_storage, job_id, batch_size=200, flush_interval=2, stdout_limit=4096):
+        self.job_storage = job_storage
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stdout_limit = stdout_limit
+        self.indexed = 0
+        self._pending = []
+        self._next_flush = time.monotonic() + flush_interval
+        self._lock = threading.Lock()
+
+    def add(self, summary):
+        row = event_row(summary, self.stdout_limit)
+        if row is None:
+            return
+        with self._lock:
+            self._pending.append(row)
+            due = len(self._pending) >= self.batch_size or time.monotonic() >= self._next_flush
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+            self._next_flush = time.monotonic() + self.flush_interval
+        if not rows:
+            return
+        try:
+            self.job_storage.save_job_events(self.job_id, rows)
+            self.indexed += len(rows)
+        except Exception as e:
+            logger.error(f"Failed to index {len(rows)} events of job {self.job_id}: {str(e)}")
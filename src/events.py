@@ -0,0 +1,148 @@
+"""
+ANSIBLE-LINK class for live job events
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import time
+import logging
+import threading
+import itertools
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+EVENT_DATA_KEYS = ('play', 'task', 'task_uuid', 'role', 'host', 'duration', 'ignore_errors')
+
+def summarize_event(event):
+    # full event payloads carry module results and can be large, subscribers get the essentials
+    summary = {key: event.get(key) for key in ('event', 'counter', 'uuid', 'created', 'stdout')}
+    event_data = event.get('event_data') or {}
+    summary.update({key: event_data[key] for key in EVENT_DATA_KEYS if key in event_data})
+    result = event_data.get('res')
+    if isinstance(result, dict) and 'changed' in result:
+        summary['changed'] = bool(result['changed'])
+    return summary
+
+class JobEventStream:
+    def __init__(self, buffer_size):
+        self.events = deque(maxlen=buffer_size)
+        self.cond = threading.Condition()
+        self.next_id = 1
+        self.finished = False
+        self.finished_at = None
+
+    def events_after(self, last_event_id):
+        # ids are contiguous, so the position in the buffer can be computed instead of searched
+        if not self.events:
+            return []
+        start = max(0, last_event_id - self.events[0][0] + 1)
+        return list(itertools.islice(self.events, start, None))
+
+class EventBroadcaster:
+    """fan out job events from the runner thread to any number of subscribers"""
+
+    def __init__(self, buffer_size=1000, retention=300):
+        self.buffer_size = buffer_size
+        self.retention = retention
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """listener(job_id, event_type) is called from the publishing thread, event_type None when a job's stream closes"""
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [other for other in self._listeners if other is not listener]
+
+    def _notify(self, job_id, event_type):
+        for listener in self._listeners:
+            try:
+                listener(job_id, event_type)
+            except Exception as e:
+                logger.error(f"Event listener failed for job {job_id}: {str(e)}")
+
+    def open(self, job_id):
+        with self._lock:
+            self._expire()
+            stream = self._streams.get(job_id)
+            if stream is None:
+                stream = self._streams[job_id] = JobEventStream(self.buffer_size)
+            return stream
+
+    def publish(self, job_id, event_type, data):
+        stream = self._streams.get(job_id) or self.open(job_id)
+        with stream.cond:
+            event_id = stream.next_id
+            stream.next_id += 1
+            stream.events.append((event_id, event_type, data))
+            stream.cond.notify_all()
+        self._notify(job_id, event_type)
+        return event_id
+
+    def close(self, job_id):
+        stream = self._streams.get(job_id)
+        if stream is None:
+            return
+        with stream.cond:
+            stream.finished = True
+            stream.finished_at = time.monotonic()
+            stream.cond.notify_all()
+        self._notify(job_id, None)
+
+    def wait_closed(self, job_id, timeout):
+        """blocks until the job's stream is closed, None if the job has no stream here"""
+        stream = self._streams.get(job_id)
+        if stream is None:
+            return None
+        with stream.cond:
+            return stream.cond.wait_for(lambda: stream.finished, timeout)
+
+    def poll(self, job_id, last_event_id=0):
+        """(events after last_event_id, finished) without waiting, None if the job has no stream here"""
+        stream = self._streams.get(job_id)
+        if stream is None:
+            return None
+        with stream.cond:
+            events = stream.events_after(last_event_id)
+            finished = stream.finished
+        if events and events[0][0] > last_event_id + 1:
+            logger.warning(f"Subscriber of job {job_id} missed events {last_event_id + 1}-{events[0][0] - 1}, buffer too small")
+        return events, finished
+
+    def is_open(self, job_id):
+        return job_id in self._streams
+
+    def subscribe(self, job_id, last_event_id=0, keepalive=15):
+        """yields (id, event_type, data) tuples, or None when nothing happened for keepalive seconds"""
+        stream = self._streams.get(job_id)
+        if stream is None:
+            return
+
+        while True:
+            with stream.cond:
+                events = stream.events_after(last_event_id)
+                if not events:
+                    if stream.finished:
+                        return
+                    stream.cond.wait(keepalive)
+                    events = stream.events_after(last_event_id)
+
+            if not events:
+                yield None
+                continue
+
+            if events[0][0] > last_event_id + 1:
+                logger.warning(f"Subscriber of job {job_id} missed events {last_event_id + 1}-{events[0][0] - 1}, buffer too small")
+            for event in events:
+                yield event
+            last_event_id = events[-1][0]
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, stream in self._streams.items()
+                   if stream.finished and now - stream.finished_at > self.retention]
+        for job_id in expired:
+            del self._streams[job_id]
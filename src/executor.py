@@ -0,0 +1,249 @@
+"""
+ANSIBLE-LINK class for job execution
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+
+from events import summarize_event
+
+logger = logging.getLogger(__name__)
+
+# seconds between cancellation checks while a job runs in a runner process
+CANCEL_POLL_INTERVAL = 0.5
+
+class CancelToken:
+    """tells the executor to stop a job: cancelled here, cancelled elsewhere (check) or out of time"""
+
+    def __init__(self, timeout=None, check=None, check_interval=1):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason = None
+        # e.g. a storage lookup, for cancellations requested in another process
+        self.check = check
+        self.check_interval = check_interval
+        self._next_check = 0
+
+    def cancel(self, reason='cancelled'):
+        if self.reason is None:
+            self.reason = reason
+
+    def __call__(self):
+        if self.reason is None:
+            now = time.monotonic()
+            if self.deadline is not None and now >= self.deadline:
+                self.cancel('timed_out')
+            elif self.check and now >= self._next_check:
+                self._next_check = now + self.check_interval
+                if self.check():
+                    self.cancel()
+        return self.reason is not None
+
+def run_runner(job_id, runner_kwargs, on_event, on_status, cancelled=None):
+    """runs one job with ansible-runner in the current process and returns its result"""
+    # imported with the first job instead of at startup, every later job finds it in sys.modules
+    import ansible_runner
+    from ansible_runner.config.runner import RunnerConfig
+
+    runner_config = RunnerConfig(**runner_kwargs)
+    logger.debug(f"RunnerConfig: {runner_config.__dict__}")
+    runner_config.prepare()
+
+    streamed = False
+
+    def event_handler(event):
+        nonlocal streamed
+        streamed = streamed or bool(event.get('stdout'))
+        on_event(event.get('stdout'), summarize_event(event))
+        return True
+
+    def status_handler(status_data, runner_config=None):
+        on_status(status_data['status'])
+
+    # ansible-runner polls cancelled() every pexpect_timeout seconds and kills the process group of ansible-playbook
+    runner = ansible_runner.Runner(config=runner_config, event_handler=event_handler, status_handler=status_handler,
+                                   cancel_callback=cancelled)
+    command = ' '.join(runner.config.command)
+    logger.info(f"Runner: {command}")
+    result = runner.run()
+    logger.debug(f"Runner result: {result}")
+
+    return {
+        'status': runner.status,
+        'rc': runner.rc,
+        'stats': runner.stats,
+        # nothing was streamed when ansible failed before emitting events, keep what runner captured
+        'stdout': None if streamed else runner.stdout.read(),
+        'stderr': runner.stderr.read(),
+        'command': command,
+    }
+
+class ThreadExecutor:
+    """runs ansible-runner in the calling scheduler thread, inside the API process"""
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def execute(self, job_id, runner_kwargs, on_event, on_status, cancelled=None):
+        return run_runner(job_id, runner_kwargs, on_event, on_status, cancelled)
+
+def _worker_main(conn, cancel_event, log_level):
+    # runs in the worker process, ansible_runner is imported once here and reused for every job
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    import ansible_runner  # noqa: F401, loaded before the first job arrives
+    conn.send(('ready', os.getpid()))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message[0] == 'stop':
+            return
+
+        _, job_id, runner_kwargs = message
+        # set by the API process to cancel this job
+        cancel_event.clear()
+        try:
+            result = run_runner(job_id, runner_kwargs,
+                                lambda stdout, summary: conn.send(('event', stdout, summary)),
+                                lambda status: conn.send(('status', status)),
+                                cancel_event.is_set)
+            conn.send(('result', result))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+class WorkerProcess:
+    __slots__ = ('process', 'conn', 'cancel_event', 'jobs', 'ready')
+
+    def __init__(self, process, conn, cancel_event):
+        self.process = process
+        self.conn = conn
+        self.cancel_event = cancel_event
+        self.jobs = 0
+        self.ready = False
+
+class ProcessExecutor:
+    """runs jobs in a pool of long-lived runner processes, events are relayed back over a pipe"""
+
+    def __init__(self, processes=4, max_jobs_per_process=100, start_method='spawn', log_level=logging.INFO, start_timeout=60):
+        self.processes = processes
+        self.max_jobs_per_process = max_jobs_per_process
+        self.log_level = log_level
+        self.start_timeout = start_timeout
+        self._context = multiprocessing.get_context(start_method)
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self):
+        # spawned together, each one imports ansible_runner in parallel
+        workers = [self._spawn() for _ in range(self.processes)]
+        try:
+            for worker in workers:
+                self._wait_ready(worker)
+        except RuntimeError:
+            self.stop()
+            raise
+        for worker in workers:
+            self._idle.put(worker)
+        logger.info(f"Started {self.processes} runner processes")
+
+    def stop(self, timeout=5):
+        self._stopped = True
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            self._retire(worker, timeout)
+
+    def execute(self, job_id, runner_kwargs, on_event, on_status, cancelled=None):
+        worker = self._idle.get()
+        reusable = False
+        try:
+            if not worker.ready:
+                # respawned after a recycled or crashed process, nobody waited for it yet
+                self._wait_ready(worker)
+            worker.conn.send(('run', job_id, runner_kwargs))
+            while True:
+                if cancelled and not worker.cancel_event.is_set() and cancelled():
+                    worker.cancel_event.set()
+                if not worker.conn.poll(CANCEL_POLL_INTERVAL):
+                    continue
+                message = worker.conn.recv()
+                if message[0] == 'event':
+                    on_event(message[1], message[2])
+                elif message[0] == 'status':
+                    on_status(message[1])
+                elif message[0] == 'result':
+                    reusable = True
+                    return message[1]
+                elif message[0] == 'error':
+                    reusable = True
+                    raise RuntimeError(message[1])
+        except (EOFError, OSError):
+            raise RuntimeError(f"Runner process {worker.process.pid} exited while running job {job_id}") from None
+        finally:
+            worker.jobs += 1
+            # recycle processes now and then so leaked memory and file descriptors don't pile up
+            if reusable and worker.jobs < self.max_jobs_per_process:
+                self._idle.put(worker)
+            else:
+                self._retire(worker)
+                if not self._stopped:
+                    self._idle.put(self._spawn())
+
+    def pids(self):
+        with self._lock:
+            return [worker.process.pid for worker in self._workers]
+
+    def _spawn(self):
+        parent_conn, child_conn = self._context.Pipe()
+        cancel_event = self._context.Event()
+        process = self._context.Process(target=_worker_main, args=(child_conn, cancel_event, self.log_level),
+                                        name='ansible-link-runner', daemon=True)
+        process.start()
+        child_conn.close()
+        worker = WorkerProcess(process, parent_conn, cancel_event)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _wait_ready(self, worker):
+        """blocks until the process imported ansible_runner and waits for jobs"""
+        try:
+            if worker.conn.poll(self.start_timeout):
+                message = worker.conn.recv()
+                if message[0] == 'ready':
+                    worker.ready = True
+                    return
+        except (EOFError, OSError):
+            pass
+        raise RuntimeError(f"Runner process {worker.process.pid} did not start within {self.start_timeout}s")
+
+    def _retire(self, worker, timeout=5):
+        with self._lock:
+            self._workers.discard(worker)
+        try:
+            worker.conn.send(('stop',))
+        except OSError:
+            pass
+        worker.process.join(timeout)
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.conn.close()
+
+def create_executor(backend='thread', **kwargs):
+    if backend == 'thread':
+        return ThreadExecutor()
+    if backend == 'process':
+        return ProcessExecutor(**kwargs)
+    raise ValueError(f"Unknown execution backend: {backend}")
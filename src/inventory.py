@@ -0,0 +1,210 @@
+"""
+ANSIBLE-LINK class for inventories
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import re
+import json
+import time
+import fnmatch
+import hashlib
+import logging
+import threading
+import subprocess
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPT = re.compile(r'^(?P<pattern>.+)\[(?P<start>-?\d+)(?::(?P<end>-?\d*))?\]$')
+
+class InventoryError(Exception):
+    pass
+
+class Inventory:
+    def __init__(self, data):
+        hostvars = data.get('_meta', {}).get('hostvars', {})
+        self.hosts = list(hostvars)
+        self.groups = {}
+
+        direct = {name: group for name, group in data.items() if name != '_meta' and isinstance(group, dict)}
+        for name in direct:
+            self.groups[name] = self._expand(name, direct, set())
+        for members in self.groups.values():
+            for host in members:
+                if host not in hostvars:
+                    hostvars[host] = {}
+                    self.hosts.append(host)
+        self.groups['all'] = list(self.hosts)
+
+    def _expand(self, name, direct, seen):
+        # hosts of a group including all of its children, in inventory order
+        if name in seen or name not in direct:
+            return []
+        seen.add(name)
+        hosts = dict.fromkeys(direct[name].get('hosts', []))
+        for child in direct[name].get('children', []):
+            hosts.update(dict.fromkeys(self._expand(child, direct, seen)))
+        return list(hosts)
+
+    def resolve(self, limit):
+        """hosts matching an ansible host pattern such as 'webservers:&staging:!web3'"""
+        if not limit:
+            return list(self.hosts)
+
+        # like ansible, ':' only separates patterns when no ',' is used
+        separator = r',' if ',' in limit else r':(?![^\[]*\])'
+        terms = [term.strip() for term in re.split(separator, limit) if term.strip()]
+        included, intersect, excluded = [], [], []
+        for term in terms:
+            if term.startswith('!'):
+                excluded.append(term[1:])
+            elif term.startswith('&'):
+                intersect.append(term[1:])
+            else:
+                included.append(term)
+
+        # dicts keep the inventory order while deduplicating
+        hosts = {}
+        for term in included or ['all']:
+            hosts.update(dict.fromkeys(self._match(term)))
+        hosts = list(hosts)
+        for term in intersect:
+            matched = set(self._match(term))
+            hosts = [host for host in hosts if host in matched]
+        for term in excluded:
+            matched = set(self._match(term))
+            hosts = [host for host in hosts if host not in matched]
+        return hosts
+
+    def _match(self, term):
+        subscript = SUBSCRIPT.match(term)
+        if subscript:
+            hosts = self._match(subscript.group('pattern'))
+            start = int(subscript.group('start'))
+            end = subscript.group('end')
+            if end is None:
+                return [hosts[start]] if -len(hosts) <= start < len(hosts) else []
+            # ansible subscripts include the end index
+            return hosts[start:int(end) + 1] if end not in ('', '-1') else hosts[start:]
+
+        if term in ('all', '*'):
+            return list(self.hosts)
+        if term in self.groups:
+            return list(self.groups[term])
+        if term in self.hosts:
+            return [term]
+
+        if term.startswith('~'):
+            regex = re.compile(term[1:])
+            match = lambda name: regex.match(name) is not None
+        elif any(char in term for char in '*?['):
+            match = lambda name: fnmatch.fnmatchcase(name, term)
+        else:
+            return []
+
+        hosts = dict.fromkeys(host for host in self.hosts if match(host))
+        for group, members in self.groups.items():
+            if match(group):
+                hosts.update(dict.fromkeys(members))
+        return list(hosts)
+
+class CachedInventory:
+    __slots__ = ('inventory', 'signature', 'digest', 'parsed_at')
+
+    def __init__(self, inventory, signature, digest, parsed_at):
+        self.inventory = inventory
+        self.signature = signature
+        self.digest = digest
+        self.parsed_at = parsed_at
+
+class InventoryCache:
+    """parses each inventory once with ansible-inventory and reuses it until the source changes"""
+
+    def __init__(self, ttl=300, timeout=60, binary='ansible-inventory'):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.binary = binary
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, inventory_path):
+        inventory_path = str(inventory_path)
+        with self._lock:
+            path_lock = self._locks.setdefault(inventory_path, threading.Lock())
+
+        # one parse per inventory at a time, concurrent requests wait for its result
+        with path_lock:
+            cached = self._cache.get(inventory_path)
+            signature = self._signature(inventory_path)
+            if cached and time.monotonic() - cached.parsed_at < self.ttl:
+                if cached.signature == signature:
+                    return cached.inventory
+                # touched but not changed, keep the parsed result
+                digest = self._digest(inventory_path)
+                if digest is not None and digest == cached.digest:
+                    cached.signature = signature
+                    return cached.inventory
+
+            inventory = Inventory(self._parse(inventory_path))
+            self._cache[inventory_path] = CachedInventory(inventory, signature, self._digest(inventory_path), time.monotonic())
+            logger.info(f"Parsed inventory {inventory_path}: {len(inventory.hosts)} hosts, {len(inventory.groups)} groups")
+            return inventory
+
+    def resolve(self, inventory_path, limit):
+        return self.get(inventory_path).resolve(limit)
+
+    def invalidate(self, inventory_path=None):
+        with self._lock:
+            if inventory_path is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(str(inventory_path), None)
+
+    def _parse(self, inventory_path):
+        started = time.monotonic()
+        try:
+            result = subprocess.run([self.binary, '-i', inventory_path, '--list'], capture_output=True, text=True, timeout=self.timeout)
+        except FileNotFoundError:
+            raise InventoryError(f"{self.binary} not found, cannot parse inventories") from None
+        except subprocess.TimeoutExpired:
+            raise InventoryError(f"Parsing inventory {inventory_path} took longer than {self.timeout}s") from None
+
+        if result.returncode != 0:
+            raise InventoryError(f"Failed to parse inventory {inventory_path}: {result.stderr.strip()}")
+        try:
+            data = json.loads(result.stdout)
+        except ValueError as e:
+            raise InventoryError(f"Invalid output from {self.binary} for {inventory_path}: {str(e)}") from None
+        logger.debug(f"Parsing inventory {inventory_path} took {time.monotonic() - started:.2f}s")
+        return data
+
+    @staticmethod
+    def _signature(inventory_path):
+        path = Path(inventory_path)
+        try:
+            if path.is_dir():
+                return tuple(sorted((str(file), file.stat().st_mtime_ns, file.stat().st_size)
+                                    for file in path.rglob('*') if file.is_file()))
+            stat = path.stat()
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _digest(inventory_path):
+        # executable (dynamic) inventories produce different hosts from the same file, only the ttl applies to them
+        path = Path(inventory_path)
+        if not path.is_file() or os.access(path, os.X_OK):
+            return None
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+        return digest.hexdigest()
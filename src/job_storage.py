@@ -5,28 +5,426 @@ Author: l.klostermann@pm.me
 License: MPL2
 """
 
+import os
 import json
+import mmap
+import base64
+import sqlite3
+import zipfile
+import logging
+import threading
 from pathlib import Path
 from datetime import datetime
 
+from compression import SEGMENT_SIZE, compress_log, dump_index, iter_decompressed, iter_file, slice_chunks
+
+logger = logging.getLogger(__name__)
+
+# columns kept outside of the json 'data' blob, everything else a job carries lives in 'data'
+INDEXED_FIELDS = ('status', 'playbook', 'start_time', 'end_time')
+OUTPUT_FIELDS = ('stdout', 'stderr', 'stats', 'ansible_cli_command')
+# metadata is read by code, not by people
+JSON_SEPARATORS = (',', ':')
+# columns of the event index, the rest of an event row lives in 'data'
+EVENT_COLUMNS = ('job_id', 'counter', 'status', 'host', 'task', 'created')
+
+def encode_cursor(*key):
+    # (start_time, job_id) of a job, (created, job_id, counter) of an indexed event
+    return base64.urlsafe_b64encode(json.dumps([key[0] or '', *key[1:]]).encode()).decode().rstrip('=')
+
+def pack_stats(stats):
+    """ansible stats (category -> host -> count) stored per host, so every host name is written once"""
+    if not stats or not all(isinstance(hosts, dict) for hosts in stats.values()):
+        return stats
+    categories = sorted(stats)
+    hosts = {}
+    for i, category in enumerate(categories):
+        for host, count in stats[category].items():
+            hosts.setdefault(host, [None] * len(categories))[i] = count
+    return {'categories': categories, 'hosts': hosts}
+
+def unpack_stats(stats):
+    if not isinstance(stats, dict) or set(stats) != {'categories', 'hosts'}:
+        return stats
+    unpacked = {category: {} for category in stats['categories']}
+    for host, counts in stats['hosts'].items():
+        for category, count in zip(stats['categories'], counts):
+            if count is not None:
+                unpacked[category][host] = count
+    return unpacked
+
+def decode_cursor(cursor, size=2):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(key, list) or len(key) != size:
+            raise ValueError
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}") from None
+    return key
+
+def event_matches(event, host=None, status=None, task=None, since=None, until=None):
+    created = event.get('created') or ''
+    return ((not host or event.get('host') == host)
+            and (not status or event.get('status') in status)
+            and (not task or task in (event.get('task') or ''))
+            and (not since or created >= since)
+            and (not until or created < until))
+
 class JobStorage:
     def __init__(self, storage_dir):
         self.storage_dir = Path(storage_dir)
         self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.output_dir = self.storage_dir / 'output'
+        self.output_dir.mkdir(exist_ok=True)
+        self.archive_dir = self.storage_dir / 'archive'
+        self.archive_dir.mkdir(exist_ok=True)
+        self._archive_lock = threading.Lock()
+
+    # stdout is written to an append-only log per job while it runs, separate from the job metadata
+
+    def _get_output_path(self, job_id):
+        return self.output_dir / f"{job_id}.log"
+
+    # finished logs are gzipped, the index maps segment offsets of the log to offsets in the gzip file
+
+    def _get_compressed_path(self, job_id):
+        return self.output_dir / f"{job_id}.log.gz"
+
+    def _get_index_path(self, job_id):
+        return self.output_dir / f"{job_id}.log.idx"
+
+    def _output_paths(self, job_id):
+        return [self._get_output_path(job_id), self._get_compressed_path(job_id), self._get_index_path(job_id)]
+
+    def open_output_log(self, job_id):
+        # line buffered, every event written is visible to readers right away
+        return open(self._get_output_path(job_id), 'a', encoding='utf-8', buffering=1)
+
+    def has_output_log(self, job_id):
+        return (self._get_output_path(job_id).exists() or self._get_index_path(job_id).exists()
+                or self.get_output_archive(job_id) is not None)
+
+    def output_size(self, job_id):
+        try:
+            return self._get_output_path(job_id).stat().st_size
+        except FileNotFoundError:
+            pass
+        index = self._load_index(job_id)
+        if index is not None:
+            return index['size']
+        archive = self.get_output_archive(job_id)
+        if archive is None:
+            return 0
+        with self._archive_lock, zipfile.ZipFile(self.archive_dir / archive) as zf:
+            try:
+                return json.loads(zf.read(f"{job_id}.log.idx"))['size']
+            except KeyError:
+                return zf.getinfo(f"{job_id}.log").file_size
+
+    def compress_output(self, job_id, level=6, segment_size=SEGMENT_SIZE):
+        """replaces the log of a finished job by a gzip file and its index, returns the bytes saved"""
+        output_path = self._get_output_path(job_id)
+        if not output_path.exists():
+            return 0
+        compressed_path = self._get_compressed_path(job_id)
+        compressed_tmp = compressed_path.with_suffix('.gz.tmp')
+        index = compress_log(output_path, compressed_tmp, level, segment_size)
+        os.replace(compressed_tmp, compressed_path)
+        # the index is written last, readers take it as the sign that the gzip file is complete
+        index_path = self._get_index_path(job_id)
+        index_tmp = index_path.with_suffix('.idx.tmp')
+        with open(index_tmp, 'w') as f:
+            f.write(dump_index(index))
+        os.replace(index_tmp, index_path)
+        saved = index['size'] - compressed_path.stat().st_size
+        output_path.unlink()
+        return saved
+
+    def _load_index(self, job_id):
+        try:
+            with open(self._get_index_path(job_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def compressed_output(self, job_id):
+        """(file object, index) of the gzipped log, None if it is not compressed"""
+        index = self._load_index(job_id)
+        if index is not None:
+            try:
+                return open(self._get_compressed_path(job_id), 'rb'), index
+            except FileNotFoundError:
+                return None
+        archive = self.get_output_archive(job_id)
+        if archive is None:
+            return None
+        with self._archive_lock, zipfile.ZipFile(self.archive_dir / archive) as zf:
+            try:
+                index = json.loads(zf.read(f"{job_id}.log.idx"))
+                # streamed from the archive, the member stays readable after the archive was closed
+                return zf.open(f"{job_id}.log.gz"), index
+            except KeyError:
+                return None
+
+    def _open_archived_log(self, job_id):
+        """the uncompressed log of the job in its archive opened for streaming, None if it is not archived"""
+        archive = self.get_output_archive(job_id)
+        if archive is None:
+            return None
+        with self._archive_lock, zipfile.ZipFile(self.archive_dir / archive) as zf:
+            try:
+                return zf.open(f"{job_id}.log")
+            except KeyError:
+                return None
+
+    def iter_output(self, job_id):
+        """the whole log in chunks, decompressed on the fly"""
+        try:
+            with open(self._get_output_path(job_id), 'rb') as f:
+                yield from iter_file(f)
+            return
+        except FileNotFoundError:
+            pass
+        compressed = self.compressed_output(job_id)
+        if compressed is not None:
+            stream, index = compressed
+            with stream:
+                yield from iter_decompressed(stream, index)
+            return
+        stream = self._open_archived_log(job_id)
+        if stream is not None:
+            with stream:
+                yield from iter_file(stream)
+
+    def read_output(self, job_id, offset=0, limit=None, unit='bytes'):
+        """returns (text, next_offset) for a byte or line range of the output log"""
+        output_path = self._get_output_path(job_id)
+        try:
+            with open(output_path, 'rb') as f:
+                if f.seek(0, 2) == 0:
+                    return '', 0
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return self._slice_output(mm, offset, limit, unit)
+        except FileNotFoundError:
+            pass
+
+        compressed = self.compressed_output(job_id)
+        if compressed is not None:
+            stream, index = compressed
+            if unit == 'bytes':
+                offset = min(offset, index['size'])
+            with stream:
+                data, next_offset = slice_chunks(iter_decompressed(stream, index, offset if unit == 'bytes' else 0), offset, limit, unit)
+            return data.decode('utf-8', errors='replace'), next_offset
+
+        # compacted by retention, the log lives in an archive now
+        stream = self._open_archived_log(job_id)
+        if stream is None:
+            return '', 0
+        with stream:
+            if unit == 'bytes':
+                # zip members are seekable, seeking past the end stops at the end
+                offset = stream.seek(offset)
+            data, next_offset = slice_chunks(iter_file(stream), offset, limit, unit)
+        return data.decode('utf-8', errors='replace'), next_offset
+
+    @classmethod
+    def _slice_output(cls, data, offset, limit, unit):
+        if unit == 'lines':
+            start = cls._skip_lines(data, 0, offset)
+            end = cls._skip_lines(data, start, limit) if limit is not None else len(data)
+            next_offset = offset + data[start:end].count(b'\n')
+        else:
+            start = min(offset, len(data))
+            end = min(start + limit, len(data)) if limit is not None else len(data)
+            next_offset = end
+        return data[start:end].decode('utf-8', errors='replace'), next_offset
+
+    @staticmethod
+    def _skip_lines(mm, position, lines):
+        for _ in range(lines):
+            position = mm.find(b'\n', position)
+            if position == -1:
+                return len(mm)
+            position += 1
+        return position
+
+    # finished outputs are compacted into rolling zip archives, an index maps each job to its archive
+
+    def archive_outputs(self, job_ids, archive_size=256 * 1024 * 1024):
+        """moves the output logs of finished jobs into the current archive, returns (archived job ids, bytes freed)"""
+        logs = []
+        for job_id in job_ids:
+            if self._get_index_path(job_id).exists():
+                # gzip is stored as is, deflating it again gains nothing
+                members = [(self._get_compressed_path(job_id), f"{job_id}.log.gz", zipfile.ZIP_STORED),
+                           (self._get_index_path(job_id), f"{job_id}.log.idx", zipfile.ZIP_DEFLATED)]
+            elif self._get_output_path(job_id).exists():
+                members = [(self._get_output_path(job_id), f"{job_id}.log", zipfile.ZIP_DEFLATED)]
+            else:
+                continue
+            logs.append((job_id, members))
+        if not logs:
+            return [], 0
+
+        with self._archive_lock:
+            archive_path = self._current_archive(archive_size)
+            size_before = archive_path.stat().st_size if archive_path.exists() else 0
+            with zipfile.ZipFile(archive_path, 'a', compression=zipfile.ZIP_DEFLATED) as zf:
+                for job_id, members in logs:
+                    for path, name, compress_type in members:
+                        zf.write(path, name, compress_type=compress_type)
+            # index first, a reader that misses the log finds it in the archive
+            self._add_archive_entries([(job_id, archive_path.name) for job_id, _ in logs])
+        log_bytes = 0
+        for job_id, _ in logs:
+            for path in self._output_paths(job_id):
+                try:
+                    log_bytes += path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        return [job_id for job_id, _ in logs], log_bytes - (archive_path.stat().st_size - size_before)
+
+    def _current_archive(self, archive_size):
+        archives = self.archives()
+        if archives and archives[-1][1] < archive_size:
+            return self.archive_dir / archives[-1][0]
+        name = f"output-{datetime.now().strftime('%Y%m%d%H%M%S%f')}.zip"
+        return self.archive_dir / name
+
+    def archives(self):
+        """(name, size) of every output archive, oldest first"""
+        return [(path.name, path.stat().st_size) for path in sorted(self.archive_dir.glob('output-*.zip'))]
 
+    def live_output_bytes(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.output_dir) if entry.is_file())
+
+    def delete_jobs(self, job_ids):
+        """removes jobs with their output, returns the bytes freed"""
+        job_ids = list(job_ids)
+        freed = 0
+        for job_id in job_ids:
+            for path in self._output_paths(job_id):
+                try:
+                    freed += path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        with self._archive_lock:
+            archives = {self.get_output_archive(job_id) for job_id in job_ids} - {None}
+            self._delete_job_records(job_ids)
+            for archive in archives:
+                if not self.archived_jobs(archive):
+                    path = self.archive_dir / archive
+                    freed += path.stat().st_size
+                    path.unlink()
+        return freed
+
+    def get_output_archive(self, job_id):
+        raise NotImplementedError
+
+    def archived_jobs(self, archive):
+        raise NotImplementedError
+
+    def _add_archive_entries(self, entries):
+        raise NotImplementedError
+
+    def _delete_job_records(self, job_ids):
+        # jobs, their output columns and archive index entries
+        raise NotImplementedError
+
+    def save_job(self, job_id, job_data):
+        raise NotImplementedError
+
+    def save_jobs(self, jobs):
+        """stores several jobs ({job_id: job_data}) at once"""
+        for job_id, job_data in jobs.items():
+            self.save_job(job_id, job_data)
+
+    def get_job(self, job_id):
+        raise NotImplementedError
+
+    def get_all_jobs(self):
+        raise NotImplementedError
+
+    def list_jobs(self, status=None, playbook=None, start_after=None, start_before=None, cursor=None, limit=None, include_data=False):
+        # newest first, ordered by (start_time, job_id) so cursors stay stable while new jobs arrive
+        raise NotImplementedError
+
+    def update_job_status(self, job_id, status):
+        raise NotImplementedError
+
+    def ping(self):
+        """True if the storage can be read, used by /ready"""
+        return self.storage_dir.is_dir()
+
+    def after_fork(self):
+        # called in a process forked from the one that created the storage
+        pass
+
+    def job_statuses(self, job_ids):
+        """{job_id: status} of the given jobs, missing jobs are left out"""
+        statuses = {}
+        for job_id in job_ids:
+            job = self.get_job(job_id)
+            if job is not None:
+                statuses[job_id] = job.get('status')
+        return statuses
+
+    def update_jobs_status(self, job_ids, status):
+        for job_id in job_ids:
+            self.update_job_status(job_id, status)
+
+    def update_job_status_if(self, job_id, status, current):
+        """sets status only while the job is in one of the current statuses, returns whether it did"""
+        raise NotImplementedError
+
+    def save_job_output(self, job_id, stdout, stderr, stats, ansible_cli_command=None):
+        raise NotImplementedError
+
+    def save_job_timings(self, job_id, timings):
+        raise NotImplementedError
+
+    def get_job_timings(self, job_id):
+        raise NotImplementedError
+
+    def save_batch(self, batch_id, batch_data, jobs):
+        """stores a batch and its jobs ({job_id: job_data}, in submission order)"""
+        raise NotImplementedError
+
+    def get_batch(self, batch_id):
+        """the batch with the indexed fields of its jobs under 'jobs', or None"""
+        raise NotImplementedError
+
+    def save_job_events(self, job_id, events):
+        """adds rows of the event index (see event_index.event_row) of a job"""
+        raise NotImplementedError
+
+    def has_job_events(self, job_id):
+        raise NotImplementedError
+
+    def query_events(self, job_id=None, host=None, status=None, task=None, since=None, until=None, after=None, cursor=None, limit=100):
+        # the events of one job in run order (after a counter), across jobs newest first (after a cursor)
+        raise NotImplementedError
+
+class JsonJobStorage(JobStorage):
     def _get_job_path(self, job_id):
         return self.storage_dir / f"{job_id}.json"
 
     def save_job(self, job_id, job_data):
         job_path = self._get_job_path(job_id)
         with open(job_path, 'w') as f:
-            json.dump(job_data, f, indent=2)
+            json.dump(job_data, f, separators=JSON_SEPARATORS)
 
     def get_job(self, job_id):
         job_path = self._get_job_path(job_id)
         if job_path.exists():
             with open(job_path, 'r') as f:
-                return json.load(f)
+                job = json.load(f)
+            if 'stats' in job:
+                job['stats'] = unpack_stats(job['stats'])
+            return job
         return None
 
     def get_all_jobs(self):
@@ -37,6 +435,37 @@ class JobStorage:
                 jobs[job_id] = json.load(f)
         return jobs
 
+    def list_jobs(self, status=None, playbook=None, start_after=None, start_before=None, cursor=None, limit=None, include_data=False):
+        # no index here, filters are applied after loading every job file
+        statuses = set(status) if status else None
+        after_key = decode_cursor(cursor) if cursor else None
+        matches = []
+        for job_id, job in self.get_all_jobs().items():
+            start_time = job.get('start_time') or ''
+            if statuses and job.get('status') not in statuses:
+                continue
+            if playbook and job.get('playbook') != playbook:
+                continue
+            if start_after and start_time < start_after:
+                continue
+            if start_before and start_time >= start_before:
+                continue
+            if after_key and (start_time, job_id) >= tuple(after_key):
+                continue
+            matches.append((start_time, job_id, job))
+
+        matches.sort(key=lambda match: (match[0], match[1]), reverse=True)
+        if limit is not None:
+            matches = matches[:limit]
+
+        jobs = {}
+        for _, job_id, job in matches:
+            if include_data:
+                jobs[job_id] = {key: value for key, value in job.items() if key not in OUTPUT_FIELDS}
+            else:
+                jobs[job_id] = {key: job.get(key) for key in INDEXED_FIELDS}
+        return jobs
+
     def update_job_status(self, job_id, status):
         job_path = self._get_job_path(job_id)
         if job_path.exists():
@@ -44,19 +473,481 @@ class JobStorage:
                 job_data = json.load(f)
                 job_data['status'] = status
                 f.seek(0)
-                json.dump(job_data, f, indent=2)
+                json.dump(job_data, f, separators=JSON_SEPARATORS)
                 f.truncate()
 
-    def save_job_output(self, job_id, stdout, stderr, stats, ansible_cli_command):
+    def update_job_status_if(self, job_id, status, current):
+        # not atomic between processes, the json backend is meant for a single one
+        job_path = self._get_job_path(job_id)
+        if not job_path.exists():
+            return False
+        with open(job_path, 'r+') as f:
+            job_data = json.load(f)
+            if job_data.get('status') not in current:
+                return False
+            job_data['status'] = status
+            f.seek(0)
+            json.dump(job_data, f, separators=JSON_SEPARATORS)
+            f.truncate()
+        return True
+
+    def save_batch(self, batch_id, batch_data, jobs):
+        for job_id, job_data in jobs.items():
+            self.save_job(job_id, job_data)
+        # not next to the job files, get_all_jobs reads every *.json there
+        batch_dir = self.storage_dir / 'batches'
+        batch_dir.mkdir(exist_ok=True)
+        with open(batch_dir / f"{batch_id}.json", 'w') as f:
+            json.dump(dict(batch_data, job_ids=list(jobs)), f, separators=JSON_SEPARATORS)
+
+    def get_batch(self, batch_id):
+        batch_path = self.storage_dir / 'batches' / f"{batch_id}.json"
+        if not batch_path.exists():
+            return None
+        with open(batch_path, 'r') as f:
+            batch = json.load(f)
+        jobs = {}
+        for job_id in batch.pop('job_ids'):
+            job = self.get_job(job_id) or {}
+            jobs[job_id] = {key: job.get(key) for key in INDEXED_FIELDS}
+        batch['jobs'] = jobs
+        return batch
+
+    def _archive_index(self):
+        # no database here, the archive index is one json file
+        index_path = self.archive_dir / 'index.json'
+        if not index_path.exists():
+            return {}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _save_archive_index(self, index):
+        with open(self.archive_dir / 'index.json', 'w') as f:
+            json.dump(index, f, separators=JSON_SEPARATORS)
+
+    def get_output_archive(self, job_id):
+        return self._archive_index().get(job_id)
+
+    def archived_jobs(self, archive):
+        return [job_id for job_id, name in self._archive_index().items() if name == archive]
+
+    def _add_archive_entries(self, entries):
+        index = self._archive_index()
+        index.update(entries)
+        self._save_archive_index(index)
+
+    def _delete_job_records(self, job_ids):
+        index = self._archive_index()
+        for job_id in job_ids:
+            index.pop(job_id, None)
+            self._get_job_path(job_id).unlink(missing_ok=True)
+            (self.storage_dir / 'timings' / f"{job_id}.json").unlink(missing_ok=True)
+            self._get_events_path(job_id).unlink(missing_ok=True)
+        self._save_archive_index(index)
+
+    def _get_events_path(self, job_id):
+        return self.storage_dir / 'events' / f"{job_id}.jsonl"
+
+    def save_job_events(self, job_id, events):
+        events_path = self._get_events_path(job_id)
+        events_path.parent.mkdir(exist_ok=True)
+        with open(events_path, 'a') as f:
+            f.writelines(json.dumps(dict(event, job_id=job_id), separators=JSON_SEPARATORS) + '\n' for event in events)
+
+    def has_job_events(self, job_id):
+        return self._get_events_path(job_id).exists()
+
+    def _load_events(self, events_path):
+        with open(events_path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def query_events(self, job_id=None, host=None, status=None, task=None, since=None, until=None, after=None, cursor=None, limit=100):
+        # no index here either, every events file is read for queries across jobs
+        filters = dict(host=host, status=set(status) if status else None, task=task, since=since, until=until)
+        if job_id:
+            events_path = self._get_events_path(job_id)
+            events = self._load_events(events_path) if events_path.exists() else []
+            matches = sorted((event for event in events if event_matches(event, **filters)
+                              and (after is None or event['counter'] > after)), key=lambda event: event['counter'])
+            return matches[:limit]
+
+        after_key = tuple(decode_cursor(cursor, 3)) if cursor else None
+        matches = []
+        for events_path in (self.storage_dir / 'events').glob('*.jsonl'):
+            for event in self._load_events(events_path):
+                key = (event.get('created') or '', event['job_id'], event['counter'])
+                if event_matches(event, **filters) and (after_key is None or key < after_key):
+                    matches.append((key, event))
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return [event for _, event in matches[:limit]]
+
+    def save_job_timings(self, job_id, timings):
+        timings_dir = self.storage_dir / 'timings'
+        timings_dir.mkdir(exist_ok=True)
+        with open(timings_dir / f"{job_id}.json", 'w') as f:
+            json.dump(timings, f, separators=JSON_SEPARATORS)
+
+    def get_job_timings(self, job_id):
+        timings_path = self.storage_dir / 'timings' / f"{job_id}.json"
+        if not timings_path.exists():
+            return None
+        with open(timings_path, 'r') as f:
+            return json.load(f)
+
+    def save_job_output(self, job_id, stdout, stderr, stats, ansible_cli_command=None):
         job_path = self._get_job_path(job_id)
         if job_path.exists():
             with open(job_path, 'r+') as f:
                 job_data = json.load(f)
                 job_data['stdout'] = stdout
                 job_data['stderr'] = stderr
-                job_data['stats'] = stats
+                job_data['stats'] = pack_stats(stats)
                 job_data['end_time'] = datetime.now().isoformat()
                 job_data['ansible_cli_command'] = ansible_cli_command
                 f.seek(0)
-                json.dump(job_data, f, indent=2)
-                f.truncate()
\ No newline at end of file
+                json.dump(job_data, f, separators=JSON_SEPARATORS)
+                f.truncate()
+
+class SQLiteJobStorage(JobStorage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            playbook TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_start_time ON jobs (start_time);
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, start_time);
+        CREATE INDEX IF NOT EXISTS idx_jobs_playbook ON jobs (playbook, start_time);
+        CREATE TABLE IF NOT EXISTS job_output (
+            job_id TEXT PRIMARY KEY,
+            stdout TEXT,
+            stderr TEXT,
+            stats TEXT,
+            ansible_cli_command TEXT
+        );
+        CREATE TABLE IF NOT EXISTS job_timings (
+            job_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS batches (
+            batch_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            batch_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            job_id TEXT NOT NULL,
+            PRIMARY KEY (batch_id, position)
+        );
+        CREATE TABLE IF NOT EXISTS output_archive (
+            job_id TEXT PRIMARY KEY,
+            archive TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_output_archive ON output_archive (archive);
+        CREATE TABLE IF NOT EXISTS job_events (
+            job_id TEXT NOT NULL,
+            counter INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            host TEXT,
+            task TEXT,
+            created TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (job_id, counter)
+        );
+        CREATE INDEX IF NOT EXISTS idx_job_events_host ON job_events (host, status, created, job_id, counter);
+        CREATE INDEX IF NOT EXISTS idx_job_events_status ON job_events (status, created, job_id, counter);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, storage_dir, db_name='jobs.db'):
+        super().__init__(storage_dir)
+        self.db_path = self.storage_dir / db_name
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+        self.migrate_json_jobs()
+
+    def after_fork(self):
+        # connections opened before a fork must not be used by both processes
+        self._local = threading.local()
+
+    def ping(self):
+        try:
+            self._connect().execute("SELECT 1 FROM jobs LIMIT 1").fetchall()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Job storage {self.db_path} is not readable: {str(e)}")
+            return False
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _split_job(job_data):
+        indexed = {key: job_data.get(key) for key in INDEXED_FIELDS}
+        data = {key: value for key, value in job_data.items() if key not in INDEXED_FIELDS and key not in OUTPUT_FIELDS}
+        return indexed, data
+
+    def _insert_job(self, conn, job_id, job_data, replace=True):
+        indexed, data = self._split_job(job_data)
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        cursor = conn.execute(f"{verb} INTO jobs (job_id, status, playbook, start_time, end_time, data) VALUES (?, ?, ?, ?, ?, ?)",
+                              (job_id, indexed['status'] or 'pending', indexed['playbook'], indexed['start_time'] or '',
+                               indexed['end_time'], json.dumps(data, separators=JSON_SEPARATORS)))
+        return cursor.rowcount
+
+    def save_job(self, job_id, job_data):
+        with self._connect() as conn:
+            self._insert_job(conn, job_id, job_data)
+
+    def get_job(self, job_id):
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = self._row_to_job(row)
+        output = conn.execute("SELECT * FROM job_output WHERE job_id = ?", (job_id,)).fetchone()
+        if output is not None:
+            job['stdout'] = output['stdout']
+            job['stderr'] = output['stderr']
+            job['stats'] = unpack_stats(json.loads(output['stats'])) if output['stats'] else {}
+            job['ansible_cli_command'] = output['ansible_cli_command']
+        return job
+
+    @staticmethod
+    def _row_to_job(row):
+        job = json.loads(row['data'])
+        for key in INDEXED_FIELDS:
+            if row[key] not in (None, ''):
+                job[key] = row[key]
+        return job
+
+    def get_all_jobs(self):
+        return {job_id: self.get_job(job_id) for job_id in self.list_jobs()}
+
+    def list_jobs(self, status=None, playbook=None, start_after=None, start_before=None, cursor=None, limit=None, include_data=False):
+        columns = "job_id, status, playbook, start_time, end_time" + (", data" if include_data else "")
+        conditions, params = [], []
+        if status:
+            conditions.append(f"status IN ({', '.join('?' * len(status))})")
+            params.extend(status)
+        if playbook:
+            conditions.append("playbook = ?")
+            params.append(playbook)
+        if start_after:
+            conditions.append("start_time >= ?")
+            params.append(start_after)
+        if start_before:
+            conditions.append("start_time < ?")
+            params.append(start_before)
+        if cursor:
+            cursor_time, cursor_id = decode_cursor(cursor)
+            conditions.append("(start_time < ? OR (start_time = ? AND job_id < ?))")
+            params.extend([cursor_time, cursor_time, cursor_id])
+
+        query = f"SELECT {columns} FROM jobs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY start_time DESC, job_id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        rows = self._connect().execute(query, params)
+        if include_data:
+            return {row['job_id']: self._row_to_job(row) for row in rows}
+        return {row['job_id']: {key: row[key] for key in INDEXED_FIELDS} for row in rows}
+
+    def update_job_status(self, job_id, status):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ? WHERE job_id = ?", (status, job_id))
+
+    def job_statuses(self, job_ids):
+        job_ids = list(job_ids)
+        statuses = {}
+        # stays below the sqlite limit of bound parameters
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            rows = self._connect().execute(f"SELECT job_id, status FROM jobs WHERE job_id IN ({', '.join('?' * len(chunk))})", chunk)
+            statuses.update((row['job_id'], row['status']) for row in rows)
+        return statuses
+
+    def update_jobs_status(self, job_ids, status):
+        with self._connect() as conn:
+            conn.executemany("UPDATE jobs SET status = ? WHERE job_id = ?", [(status, job_id) for job_id in job_ids])
+
+    def update_job_status_if(self, job_id, status, current):
+        placeholders = ','.join('?' * len(current))
+        with self._connect() as conn:
+            return conn.execute(f"UPDATE jobs SET status = ? WHERE job_id = ? AND status IN ({placeholders})",
+                                (status, job_id, *current)).rowcount > 0
+
+    def save_job_timings(self, job_id, timings):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO job_timings (job_id, data) VALUES (?, ?)", (job_id, json.dumps(timings, separators=JSON_SEPARATORS)))
+
+    def get_job_timings(self, job_id):
+        row = self._connect().execute("SELECT data FROM job_timings WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def save_jobs(self, jobs):
+        with self._connect() as conn:
+            for job_id, job_data in jobs.items():
+                self._insert_job(conn, job_id, job_data)
+
+    def save_batch(self, batch_id, batch_data, jobs):
+        # one transaction (and one fsync) for the whole batch instead of one per job
+        with self._connect() as conn:
+            for job_id, job_data in jobs.items():
+                self._insert_job(conn, job_id, job_data)
+            conn.execute("INSERT OR REPLACE INTO batches (batch_id, data) VALUES (?, ?)", (batch_id, json.dumps(batch_data, separators=JSON_SEPARATORS)))
+            conn.executemany("INSERT OR REPLACE INTO batch_jobs (batch_id, position, job_id) VALUES (?, ?, ?)",
+                             [(batch_id, position, job_id) for position, job_id in enumerate(jobs)])
+
+    def get_batch(self, batch_id):
+        conn = self._connect()
+        row = conn.execute("SELECT data FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        if row is None:
+            return None
+        batch = json.loads(row['data'])
+        rows = conn.execute("SELECT b.job_id, j.status, j.playbook, j.start_time, j.end_time FROM batch_jobs b "
+                            "JOIN jobs j ON j.job_id = b.job_id WHERE b.batch_id = ? ORDER BY b.position", (batch_id,))
+        batch['jobs'] = {row['job_id']: {key: row[key] for key in INDEXED_FIELDS} for row in rows}
+        return batch
+
+    def save_job_output(self, job_id, stdout, stderr, stats, ansible_cli_command=None):
+        with self._connect() as conn:
+            updated = conn.execute("UPDATE jobs SET end_time = ? WHERE job_id = ?", (datetime.now().isoformat(), job_id)).rowcount
+            if updated:
+                conn.execute("INSERT OR REPLACE INTO job_output (job_id, stdout, stderr, stats, ansible_cli_command) VALUES (?, ?, ?, ?, ?)",
+                             (job_id, stdout, stderr, json.dumps(pack_stats(stats), separators=JSON_SEPARATORS), ansible_cli_command))
+
+    def save_job_events(self, job_id, events):
+        rows = []
+        for event in events:
+            data = {key: value for key, value in event.items() if key not in EVENT_COLUMNS}
+            rows.append((job_id, event['counter'], event['status'], event.get('host'), event.get('task'), event.get('created') or '',
+                         json.dumps(data, separators=JSON_SEPARATORS)))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO job_events (job_id, counter, status, host, task, created, data) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def has_job_events(self, job_id):
+        return self._connect().execute("SELECT 1 FROM job_events WHERE job_id = ? LIMIT 1", (job_id,)).fetchone() is not None
+
+    def query_events(self, job_id=None, host=None, status=None, task=None, since=None, until=None, after=None, cursor=None, limit=100):
+        conditions, params = [], []
+        for column, value in (('job_id', job_id), ('host', host)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if status:
+            conditions.append(f"status IN ({', '.join('?' * len(status))})")
+            params.extend(status)
+        if task:
+            conditions.append("instr(task, ?) > 0")
+            params.append(task)
+        if since:
+            conditions.append("created >= ?")
+            params.append(since)
+        if until:
+            conditions.append("created < ?")
+            params.append(until)
+
+        if job_id:
+            if after is not None:
+                conditions.append("counter > ?")
+                params.append(after)
+            order = "counter"
+        else:
+            if cursor:
+                created, cursor_job, counter = decode_cursor(cursor, 3)
+                conditions.append("(created < ? OR (created = ? AND (job_id < ? OR (job_id = ? AND counter < ?))))")
+                params.extend([created, created, cursor_job, cursor_job, counter])
+            # matches idx_job_events_host and idx_job_events_status, no sort step for the newest N
+            order = "created DESC, job_id DESC, counter DESC"
+
+        query = f"SELECT {', '.join(EVENT_COLUMNS)}, data FROM job_events"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY {order} LIMIT ?"
+        params.append(limit)
+
+        events = []
+        for row in self._connect().execute(query, params):
+            event = {key: row[key] for key in EVENT_COLUMNS}
+            event.update(json.loads(row['data']))
+            events.append(event)
+        return events
+
+    def get_output_archive(self, job_id):
+        row = self._connect().execute("SELECT archive FROM output_archive WHERE job_id = ?", (job_id,)).fetchone()
+        return row['archive'] if row else None
+
+    def archived_jobs(self, archive):
+        return [row['job_id'] for row in self._connect().execute("SELECT job_id FROM output_archive WHERE archive = ?", (archive,))]
+
+    def _add_archive_entries(self, entries):
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO output_archive (job_id, archive) VALUES (?, ?)", entries)
+
+    def _delete_job_records(self, job_ids):
+        params = [(job_id,) for job_id in job_ids]
+        with self._connect() as conn:
+            for table in ('jobs', 'job_output', 'job_timings', 'output_archive', 'job_events'):
+                conn.executemany(f"DELETE FROM {table} WHERE job_id = ?", params)
+
+    def migrate_json_jobs(self):
+        # one-shot import of the <job_id>.json layout used by JsonJobStorage, the files are left in place
+        conn = self._connect()
+        if conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+            return 0
+
+        migrated = 0
+        with conn:
+            for file_path in self.storage_dir.glob("*.json"):
+                try:
+                    with open(file_path, 'r') as f:
+                        job_data = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Skipping unreadable job file {file_path}: {str(e)}")
+                    continue
+
+                job_id = file_path.stem
+                if not self._insert_job(conn, job_id, job_data, replace=False):
+                    continue
+                if any(key in job_data for key in OUTPUT_FIELDS):
+                    conn.execute("INSERT OR REPLACE INTO job_output (job_id, stdout, stderr, stats, ansible_cli_command) VALUES (?, ?, ?, ?, ?)",
+                                 (job_id, job_data.get('stdout'), job_data.get('stderr'),
+                                  json.dumps(pack_stats(job_data.get('stats', {})), separators=JSON_SEPARATORS), job_data.get('ansible_cli_command')))
+                migrated += 1
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (datetime.now().isoformat(),))
+
+        if migrated:
+            logger.info(f"Migrated {migrated} job files from {self.storage_dir} into {self.db_path}")
+        return migrated
+
+STORAGE_BACKENDS = {
+    'sqlite': SQLiteJobStorage,
+    'json': JsonJobStorage,
+}
+
+def create_job_storage(storage_dir, backend='sqlite'):
+    try:
+        storage_class = STORAGE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown job storage backend: {backend}") from None
+    return storage_class(storage_dir)
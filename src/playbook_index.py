@@ -0,0 +1,226 @@
+"""
+ANSIBLE-LINK class for the playbook catalog
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import logging
+import threading
+from pathlib import Path
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger(__name__)
+
+PLAYBOOK_SUFFIXES = ('.yml', '.yaml')
+
+class PlaybookIndex:
+    """in-memory index of the playbook dir, the whitelist is evaluated once per file instead of per request"""
+
+    def __init__(self, playbook_dir, compiled_whitelist, scan_interval=30, use_inotify=True):
+        self.playbook_dir = Path(os.path.abspath(playbook_dir))
+        self.compiled_whitelist = compiled_whitelist
+        self.scan_interval = scan_interval
+        self.use_inotify = use_inotify and INotify is not None
+        self._playbooks = {}    # relative path -> whitelisted
+        self._dir_mtimes = {}   # directory -> st_mtime_ns when it was last scanned
+        self._listing = []
+        self._built = threading.Event()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = None
+        self._inotify = None
+        self._watches = {}
+
+    def is_whitelisted(self, playbook):
+        return not self.compiled_whitelist or any(pattern.match(playbook) for pattern in self.compiled_whitelist)
+
+    def set_whitelist(self, compiled_whitelist):
+        # the indexed playbooks are evaluated again, the playbook dir is not rescanned
+        with self._lock:
+            self.compiled_whitelist = compiled_whitelist
+            self._playbooks = {relative: self.is_whitelisted(relative) for relative in self._playbooks}
+            self._update_listing()
+
+    @property
+    def ready(self):
+        return self._built.is_set()
+
+    def build(self):
+        playbooks, dir_mtimes = {}, {}
+        try:
+            self._scan_tree(self.playbook_dir, playbooks, dir_mtimes, set())
+            with self._lock:
+                self._playbooks = playbooks
+                self._dir_mtimes = dir_mtimes
+                self._update_listing()
+        finally:
+            self._built.set()
+        logger.info(f"Indexed {len(playbooks)} playbooks in {len(dir_mtimes)} directories of {self.playbook_dir}")
+
+    def refresh(self):
+        # a directory's mtime changes when entries are added, removed or renamed, rescan only those
+        changed = []
+        for directory, mtime in list(self._dir_mtimes.items()):
+            try:
+                current = directory.stat().st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                changed.append(directory)
+        if not changed:
+            return False
+
+        with self._lock:
+            for directory in changed:
+                if directory in self._dir_mtimes:
+                    self._rescan_dir(directory)
+            self._update_listing()
+        logger.debug(f"Playbook index refreshed {len(changed)} directories")
+        return True
+
+    def playbooks(self):
+        # the listing waits for the initial scan, single lookups don't need it
+        if not self._built.is_set():
+            if self._worker is None:
+                self.build()
+            else:
+                self._built.wait()
+        return self._listing
+
+    def lookup(self, playbook):
+        """returns True/False for whitelisted or not, None if the playbook does not exist"""
+        relative = self._relative(playbook)
+        if relative is not None and relative in self._playbooks:
+            return self._playbooks[relative]
+
+        # not indexed yet (or outside the playbook dir), check the filesystem directly
+        if not (self.playbook_dir / playbook).is_file():
+            return None
+        whitelisted = self.is_whitelisted(playbook)
+        if relative is not None and Path(relative).suffix in PLAYBOOK_SUFFIXES:
+            with self._lock:
+                self._playbooks[relative] = whitelisted
+                self._update_listing()
+        return whitelisted
+
+    def start(self):
+        if self._worker is not None:
+            return
+        if self.use_inotify:
+            try:
+                self._inotify = INotify()
+            except OSError as e:
+                logger.warning(f"inotify unavailable, falling back to periodic scans: {str(e)}")
+                self._inotify = None
+        self._worker = threading.Thread(target=self._watch, name='ansible-link-playbook-index', daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._worker:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def _watch(self):
+        # not built up front (e.g. preloaded by a gunicorn master), the process serves requests meanwhile
+        if not self._built.is_set():
+            self.build()
+        while not self._stopped.is_set():
+            if self._inotify is not None:
+                self._add_watches()
+                # the periodic refresh on timeout also covers changes inotify can't see (e.g. NFS)
+                self._inotify.read(timeout=self.scan_interval * 1000, read_delay=100)
+            elif self._stopped.wait(self.scan_interval):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh playbook index: {str(e)}")
+
+    def _add_watches(self):
+        mask = inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO
+        for directory in list(self._dir_mtimes):
+            if directory not in self._watches:
+                try:
+                    self._watches[directory] = self._inotify.add_watch(str(directory), mask)
+                except OSError:
+                    pass
+
+    def _scan_tree(self, directory, playbooks, dir_mtimes, visited):
+        try:
+            real_path = directory.resolve()
+            if real_path in visited:
+                return
+            visited.add(real_path)
+            dir_mtimes[directory] = directory.stat().st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.warning(f"Cannot scan playbook directory {directory}: {str(e)}")
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    self._scan_tree(Path(entry.path), playbooks, dir_mtimes, visited)
+                elif entry.name.endswith(PLAYBOOK_SUFFIXES) and entry.is_file():
+                    relative = Path(entry.path).relative_to(self.playbook_dir).as_posix()
+                    playbooks[relative] = self.is_whitelisted(relative)
+            except OSError:
+                continue
+
+    def _rescan_dir(self, directory):
+        try:
+            mtime = directory.stat().st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            self._forget_tree(directory)
+            return
+        self._dir_mtimes[directory] = mtime
+
+        prefix = self._prefix(directory)
+        for relative in [relative for relative in self._playbooks if relative.startswith(prefix) and '/' not in relative[len(prefix):]]:
+            del self._playbooks[relative]
+
+        subdirs = set()
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    subdir = Path(entry.path)
+                    subdirs.add(subdir)
+                    if subdir not in self._dir_mtimes:
+                        self._scan_tree(subdir, self._playbooks, self._dir_mtimes, set())
+                elif entry.name.endswith(PLAYBOOK_SUFFIXES) and entry.is_file():
+                    relative = prefix + entry.name
+                    self._playbooks[relative] = self.is_whitelisted(relative)
+            except OSError:
+                continue
+
+        for known in [known for known in self._dir_mtimes if known.parent == directory and known not in subdirs]:
+            self._forget_tree(known)
+
+    def _prefix(self, directory):
+        return '' if directory == self.playbook_dir else directory.relative_to(self.playbook_dir).as_posix() + '/'
+
+    def _forget_tree(self, directory):
+        prefix = self._prefix(directory)
+        for relative in [relative for relative in self._playbooks if relative.startswith(prefix)]:
+            del self._playbooks[relative]
+        for known in [known for known in self._dir_mtimes if known == directory or directory in known.parents]:
+            del self._dir_mtimes[known]
+            self._watches.pop(known, None)
+
+    def _relative(self, playbook):
+        path = Path(os.path.normpath(self.playbook_dir / playbook))
+        try:
+            return path.relative_to(self.playbook_dir).as_posix()
+        except ValueError:
+            return None
+
+    def _update_listing(self):
+        self._listing = sorted(relative for relative, whitelisted in self._playbooks.items() if whitelisted)
@@ -0,0 +1,188 @@
+"""
+ANSIBLE-LINK class for job retention
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import json
+import shutil
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+from collections import namedtuple
+
+from coordination import NullMetric
+from job_storage import encode_cursor
+
+logger = logging.getLogger(__name__)
+
+# reclaimed bytes by source and jobs by action, created by init_app
+RetentionMetrics = namedtuple('RetentionMetrics', ['reclaimed', 'jobs'])
+NO_METRICS = RetentionMetrics(NullMetric(), NullMetric())
+
+# jobs in any other status may still be written to
+FINISHED_STATUSES = ['completed', 'failed', 'error', 'rejected', 'cancelled', 'timed_out']
+ACTIVE_STATUSES = ['pending', 'running', 'cancelling']
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+class RetentionManager:
+    """compacts and expires finished jobs in the background so the job storage stays bounded"""
+
+    def __init__(self, job_storage, artifact_dir, archive_after_days=7, max_age_days=0, max_jobs=0, max_bytes=0,
+                 archive_size=256 * 1024 * 1024, interval=3600, page_size=500, leader_lock=None,
+                 metrics=NO_METRICS):
+        self.job_storage = job_storage
+        self.artifact_dir = Path(artifact_dir)
+        self.archive_after_days = archive_after_days
+        self.max_age_days = max_age_days
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self.archive_size = archive_size
+        self.interval = interval
+        self.page_size = page_size
+        # several processes may share the storage, only the lock holder runs retention
+        self.leader_lock = leader_lock
+        self.metrics = metrics
+        self.state_path = job_storage.archive_dir / 'retention.json'
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def start(self):
+        if self._worker is not None:
+            return
+        self._worker = threading.Thread(target=self._loop, name='ansible-link-retention', daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._worker:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            if self.leader_lock and not self.leader_lock.try_acquire():
+                self._stopped.wait(self.interval)
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Job retention run failed: {str(e)}")
+            self._stopped.wait(self.interval)
+
+    def run_once(self, now=None):
+        now = now or datetime.now()
+        summary = {'compacted': 0, 'deleted': 0}
+        if self.archive_after_days:
+            summary['compacted'] = self.compact((now - timedelta(days=self.archive_after_days)).isoformat())
+        if self.max_age_days:
+            summary['deleted'] += self._delete_pages(start_before=(now - timedelta(days=self.max_age_days)).isoformat())
+        if self.max_jobs:
+            summary['deleted'] += self._delete_beyond_count()
+        if self.max_bytes:
+            summary['deleted'] += self._delete_beyond_bytes()
+        if summary['compacted'] or summary['deleted']:
+            logger.info(f"Job retention compacted {summary['compacted']} and deleted {summary['deleted']} jobs")
+        return summary
+
+    def compact(self, cutoff):
+        """archives output and removes runner artifacts of jobs finished before cutoff"""
+        # jobs before the watermark were compacted by an earlier run, they are not looked at again
+        watermark = self._load_state().get('compacted_until')
+        # the watermark stops at the oldest job still running, it is compacted by a later run once it finished.
+        # looked up first, a job finishing while the pages are compacted is still before the new watermark
+        active = self.job_storage.list_jobs(status=ACTIVE_STATUSES, start_after=watermark, start_before=cutoff)
+        compacted_until = min([job['start_time'] for job in active.values() if job.get('start_time')] + [cutoff])
+        compacted = 0
+        cursor = None
+        while True:
+            jobs = self.job_storage.list_jobs(status=FINISHED_STATUSES, start_after=watermark, start_before=cutoff,
+                                              cursor=cursor, limit=self.page_size)
+            if not jobs:
+                break
+            job_ids = list(jobs)
+            # behind a running job the same finished jobs come up again, only count those with something left to compact
+            with_artifacts = [job_id for job_id in job_ids if (self.artifact_dir / job_id).is_dir()]
+            archived, freed = self.job_storage.archive_outputs(job_ids, self.archive_size)
+            self.metrics.reclaimed.labels(source='output').inc(max(freed, 0))
+            self.metrics.reclaimed.labels(source='artifacts').inc(self._remove_artifacts(with_artifacts))
+            count = len(set(archived) | set(with_artifacts))
+            self.metrics.jobs.labels(action='compacted').inc(count)
+            compacted += count
+            cursor = self._cursor(jobs, job_ids[-1])
+        self._save_state({'compacted_until': compacted_until})
+        return compacted
+
+    def _delete_pages(self, start_before=None, cursor=None):
+        deleted = 0
+        while True:
+            jobs = self.job_storage.list_jobs(status=FINISHED_STATUSES, start_before=start_before, cursor=cursor, limit=self.page_size)
+            if not jobs:
+                return deleted
+            self._delete(list(jobs))
+            deleted += len(jobs)
+
+    def _delete_beyond_count(self):
+        newest = self.job_storage.list_jobs(status=FINISHED_STATUSES, limit=self.max_jobs)
+        if len(newest) < self.max_jobs:
+            return 0
+        last_job_id = list(newest)[-1]
+        return self._delete_pages(cursor=self._cursor(newest, last_job_id))
+
+    def _delete_beyond_bytes(self):
+        # archives are the unit that frees space, drop the oldest with all of its jobs until the budget fits
+        deleted = 0
+        archives = self.job_storage.archives()
+        used = self.job_storage.live_output_bytes() + sum(size for _, size in archives)
+        for archive, size in archives:
+            if used <= self.max_bytes:
+                break
+            job_ids = self.job_storage.archived_jobs(archive)
+            self._delete(job_ids)
+            used -= size
+            deleted += len(job_ids)
+        if used > self.max_bytes:
+            logger.warning(f"Job output uses {used} bytes, more than retention.max_bytes, but only live jobs are left")
+        return deleted
+
+    def _delete(self, job_ids):
+        self.metrics.reclaimed.labels(source='deleted').inc(self.job_storage.delete_jobs(job_ids))
+        self.metrics.reclaimed.labels(source='artifacts').inc(self._remove_artifacts(job_ids))
+        self.metrics.jobs.labels(action='deleted').inc(len(job_ids))
+
+    def _remove_artifacts(self, job_ids):
+        # the ansible-runner private_data_dir of each job
+        freed = 0
+        for job_id in job_ids:
+            path = self.artifact_dir / job_id
+            if path.is_dir():
+                freed += directory_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+        return freed
+
+    @staticmethod
+    def _cursor(jobs, job_id):
+        return encode_cursor(jobs[job_id].get('start_time'), job_id)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state):
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
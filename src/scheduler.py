@@ -0,0 +1,215 @@
+"""
+ANSIBLE-LINK class for job scheduling
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# lower value runs first
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+class SchedulerFull(Exception):
+    pass
+
+class QueuedJob:
+    __slots__ = ('priority', 'seq', 'job_id', 'func', 'args', 'group', 'enqueued_at')
+
+    def __init__(self, priority, seq, job_id, func, args, group=None):
+        self.priority = priority
+        self.seq = seq
+        self.job_id = job_id
+        self.func = func
+        self.args = args
+        self.group = group
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class JobScheduler:
+    def __init__(self, max_workers=4, max_queue=100, wait_observer=None, slot_gate=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.wait_observer = wait_observer
+        # optional limit shared with other processes, see coordination.SlotLeases
+        self.slot_gate = slot_gate
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._busy = 0
+        # jobs of a group (e.g. a batch) can be limited to a number of parallel runs
+        self._group_limits = {}
+        self._group_running = {}
+        self._group_pending = {}
+        self._deferred = {}
+        self._running = False
+        self._workers = []
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work, name=f"ansible-link-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Scheduler started with {self.max_workers} workers, queue size {self.max_queue}")
+
+    def is_running(self):
+        return self._running and any(worker.is_alive() for worker in self._workers)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def is_full(self):
+        return self.free_slots() <= 0
+
+    def free_slots(self):
+        with self._cond:
+            return self.max_queue - self._pending()
+
+    def submit(self, job_id, func, args=(), priority='normal'):
+        self.submit_many([(job_id, func, args, priority)])
+        logger.debug(f"Queued job {job_id} with priority {priority}")
+
+    def submit_many(self, jobs, group=None, max_parallel=None):
+        """queues all (job_id, func, args, priority) tuples or none of them"""
+        for _, _, _, priority in jobs:
+            if priority not in PRIORITIES:
+                raise ValueError(f"Invalid priority: {priority}")
+        with self._cond:
+            if self._pending() + len(jobs) > self.max_queue:
+                raise SchedulerFull(f"Job queue is full ({self.max_queue} pending jobs)")
+            if group is not None:
+                self._group_pending[group] = self._group_pending.get(group, 0) + len(jobs)
+                if max_parallel:
+                    self._group_limits[group] = max_parallel
+            for job_id, func, args, priority in jobs:
+                heapq.heappush(self._queue, QueuedJob(PRIORITIES[priority], next(self._seq), job_id, func, args, group))
+            self._cond.notify(len(jobs))
+
+    def cancel_group(self, group):
+        """removes the queued jobs of a group, jobs already running are not touched"""
+        with self._cond:
+            cancelled = [job for job in self._queue if job.group == group] + self._deferred.pop(group, [])
+            if cancelled:
+                self._queue = [job for job in self._queue if job.group != group]
+                heapq.heapify(self._queue)
+                self._group_pending[group] -= len(cancelled)
+                self._release_group(group)
+        return [job.job_id for job in sorted(cancelled)]
+
+    def cancel(self, job_id):
+        """removes a queued job, False if it is not queued (anymore)"""
+        with self._cond:
+            job = next((job for job in self._queue if job.job_id == job_id), None)
+            if job is not None:
+                self._queue.remove(job)
+                heapq.heapify(self._queue)
+            else:
+                job = next((job for deferred in self._deferred.values() for job in deferred if job.job_id == job_id), None)
+                if job is None:
+                    return False
+                deferred = self._deferred[job.group]
+                deferred.remove(job)
+                heapq.heapify(deferred)
+                if not deferred:
+                    del self._deferred[job.group]
+            if job.group is not None:
+                self._group_pending[job.group] -= 1
+                self._release_group(job.group)
+            return True
+
+    def queue_depth(self):
+        return self._pending()
+
+    def busy_workers(self):
+        return self._busy
+
+    def utilization(self):
+        return self._busy / self.max_workers
+
+    def _pending(self):
+        return len(self._queue) + sum(len(deferred) for deferred in self._deferred.values())
+
+    def _release_group(self, group):
+        if not self._group_running.get(group) and not self._group_pending.get(group):
+            self._group_limits.pop(group, None)
+            self._group_running.pop(group, None)
+            self._group_pending.pop(group, None)
+
+    def _next_job(self):
+        # jobs of a group at its parallel limit are parked until one of its runs finishes
+        while self._queue:
+            job = heapq.heappop(self._queue)
+            limit = self._group_limits.get(job.group)
+            if limit and self._group_running.get(job.group, 0) >= limit:
+                heapq.heappush(self._deferred.setdefault(job.group, []), job)
+                continue
+            if job.group is not None:
+                self._group_pending[job.group] -= 1
+                self._group_running[job.group] = self._group_running.get(job.group, 0) + 1
+            return job
+        return None
+
+    def _finish(self, job):
+        self._busy -= 1
+        if job.group is None:
+            return
+        self._group_running[job.group] -= 1
+        deferred = self._deferred.get(job.group)
+        if deferred:
+            heapq.heappush(self._queue, heapq.heappop(deferred))
+            if not deferred:
+                del self._deferred[job.group]
+            self._cond.notify()
+        self._release_group(job.group)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                self._busy += 1
+
+            if self.slot_gate and not self.slot_gate.acquire(job.job_id, cancelled=lambda: not self._running):
+                logger.warning(f"Scheduler stopped while job {job.job_id} waited for a global slot")
+                with self._cond:
+                    self._finish(job)
+                return
+
+            wait_time = time.monotonic() - job.enqueued_at
+            logger.debug(f"Job {job.job_id} picked up after {wait_time:.3f}s in queue")
+            if self.wait_observer:
+                self.wait_observer(wait_time)
+
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                logger.error(f"Unhandled error in scheduled job {job.job_id}: {str(e)}")
+            finally:
+                if self.slot_gate:
+                    self.slot_gate.release(job.job_id)
+                with self._cond:
+                    self._finish(job)
@@ -0,0 +1,52 @@
+"""
+ANSIBLE-LINK class for sharded jobs
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+# the status of a sharded job when not every shard completed, the first one found in its shards
+FAILED_SHARD_STATUSES = ('error', 'failed', 'timed_out', 'cancelled', 'rejected')
+
+def partition_hosts(hosts, shards):
+    """splits hosts into at most `shards` contiguous parts in inventory order, sizes differ by one at most"""
+    shards = min(shards, len(hosts))
+    if shards < 1:
+        return []
+    size, extra = divmod(len(hosts), shards)
+    parts = []
+    start = 0
+    for index in range(shards):
+        end = start + size + (1 if index < extra else 0)
+        parts.append(hosts[start:end])
+        start = end
+    return parts
+
+def shard_limit(hosts, path):
+    """writes the hosts of a shard to path, returns the limit for it (@path)"""
+    # an explicit host list, the shard runs exactly these hosts whatever the original pattern was.
+    # a file, joined on the command line thousands of hosts can exceed ARG_MAX
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(''.join(f"{host}\n" for host in hosts))
+    return f"@{path}"
+
+def merge_stats(stats_list):
+    """combines the ansible stats (category -> host -> count) of several shards"""
+    merged = {}
+    for stats in stats_list:
+        for category, hosts in (stats or {}).items():
+            if not isinstance(hosts, dict):
+                continue
+            counts = merged.setdefault(category, {})
+            for host, count in hosts.items():
+                counts[host] = counts.get(host, 0) + count
+    return merged
+
+def combined_status(statuses):
+    if all(status == 'completed' for status in statuses):
+        return 'completed'
+    for status in FAILED_SHARD_STATUSES:
+        if status in statuses:
+            return status
+    return 'failed'
@@ -0,0 +1,47 @@
+"""
+ANSIBLE-LINK class for startup phases
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import sys
+import time
+import shlex
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """durations of the startup phases, logged once the process is ready and exported as ansible_link_startup_phase_seconds"""
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def summary(self):
+        return ', '.join(f"{name} {duration * 1000:.0f}ms" for name, duration in self.phases.items())
+
+    def to_dict(self):
+        return {name: round(duration, 4) for name, duration in self.phases.items()}
+
+def gunicorn_preload(setting=None):
+    """whether the app is imported in the gunicorn master (--preload) and forked into the workers afterwards"""
+    if setting is not None:
+        return bool(setting)
+    if 'gunicorn' not in os.path.basename(sys.argv[0]):
+        return False
+    args = sys.argv[1:] + shlex.split(os.environ.get('GUNICORN_CMD_ARGS', ''))
+    return '--preload' in args
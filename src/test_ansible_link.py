@@ -1,11 +1,66 @@
 import unittest
+import asyncio
+import gzip
 import json
+import queue
+import os
+import re
+import sys
 import time
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
 from pathlib import Path
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
+import yaml
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+import ansible_link
 from ansible_link import init_app, load_config, VERSION
+from scheduler import JobScheduler, SchedulerFull, PRIORITIES
+from job_storage import SQLiteJobStorage, JsonJobStorage, encode_cursor
+from events import EventBroadcaster
+from webhook import WebhookSender, WebhookMetrics
+from playbook_index import PlaybookIndex
+from inventory import Inventory, InventoryCache
+from validation import PlaybookRequestValidator, PlaybookRequest, StatCache
+from dedup import JobDeduplicator, spec_key
+from retention import RetentionManager, RetentionMetrics
+from executor import ProcessExecutor, CancelToken
+from coordination import LeaderLock, SlotLeases, GaugeSampler
+from timings import TimingAggregator
+from event_index import EventIndexer, event_row
+from async_server import AsgiServer
+from startup import StartupTimer, gunicorn_preload
+from sharding import partition_hosts, merge_stats, combined_status
+from admission import AdmissionController, ControllerLoad, MB
+from config_reload import ConfigError, ConfigWatcher, read_config, changed_keys, keep_restart_keys
+from benchmark_ansible_link import FakeExecutor, build_fixture, percentile
 API_PATH=f'/api/v{VERSION.split(".")[0]}'
 
+def asgi_get(application, path, query_string=b''):
+    async def request():
+        messages = []
+        requested = asyncio.Event()
+
+        async def receive():
+            if not requested.is_set():
+                requested.set()
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': []}
+        await application(scope, receive, send)
+        return messages
+
+    messages = asyncio.run(request())
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
 class TestAnsibleLink(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -19,6 +74,85 @@ class TestAnsibleLink(unittest.TestCase):
         data = json.loads(response.data)
         self.assertEqual(data['status'], 'healthy')
 
+    def test_reload_config(self):
+        # the file the app loaded, ANSIBLE_LINK_CONFIG_PATH is not set in every test run
+        config_path = ansible_link.config_file()
+        previous_env = os.environ.get('ANSIBLE_LINK_CONFIG_PATH')
+        with open(config_path, 'r') as f:
+            original = yaml.safe_load(f)
+        previous_config = ansible_link.config
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            changed_path = Path(tmp_dir) / 'config.yml'
+            with open(changed_path, 'w') as f:
+                yaml.safe_dump(dict(original, playbook_whitelist=['nothing\\.yml$'], port=5099, omit_event_data=True), f)
+            invalid_path = Path(tmp_dir) / 'invalid.yml'
+            with open(invalid_path, 'w') as f:
+                yaml.safe_dump(dict(original, playbook_whitelist=['(unclosed']), f)
+            try:
+                os.environ['ANSIBLE_LINK_CONFIG_PATH'] = str(changed_path)
+                response = self.client.post(f'{API_PATH}/ansible/config/reload')
+                self.assertEqual(response.status_code, 200)
+                data = json.loads(response.data)
+                self.assertEqual(data['changed'], ['omit_event_data', 'playbook_whitelist'])
+                self.assertEqual(data['restart_required'], ['port'])
+                # swapped, not modified: a running job keeps the config it started with
+                self.assertIsNot(ansible_link.config, previous_config)
+                self.assertFalse(previous_config.get('omit_event_data'))
+                self.assertEqual(ansible_link.config['port'], previous_config['port'])
+                self.assertEqual(self.client.get(f'{API_PATH}/ansible/available-playbooks').json['playbooks'], [])
+                self.assertEqual(json.loads(self.client.post(f'{API_PATH}/ansible/config/reload').data)['changed'], [])
+
+                os.environ['ANSIBLE_LINK_CONFIG_PATH'] = str(invalid_path)
+                response = self.client.post(f'{API_PATH}/ansible/config/reload')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('playbook_whitelist', json.loads(response.data)['errors'][0])
+                self.assertEqual(ansible_link.config['playbook_whitelist'], ['nothing\\.yml$'])
+            finally:
+                if previous_env is None:
+                    os.environ.pop('ANSIBLE_LINK_CONFIG_PATH', None)
+                else:
+                    os.environ['ANSIBLE_LINK_CONFIG_PATH'] = previous_env
+                self.assertEqual(ansible_link.config_file(), config_path)
+                ansible_link.reload_config()
+        self.assertEqual(self.client.get(f'{API_PATH}/ansible/available-playbooks').json['playbooks'], ['test_playbook.yml'])
+
+    def test_ready_check(self):
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['status'], 'ready')
+        self.assertTrue(all(data['checks'].values()))
+        self.assertIn('storage', data['startup'])
+
+    def test_preloaded_workers_start_after_fork(self):
+        # a gunicorn master with --preload: main() loads the app, each forked worker starts its own services
+        src_dir = Path(__file__).parent.absolute()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(ansible_link.config_file()) as f:
+                config = yaml.safe_load(f)
+            config.update(job_storage_dir=tmp_dir, metrics_port=0, playbook_dir=str(src_dir / 'test_playbooks'))
+            config_path = Path(tmp_dir) / 'config.yml'
+            config_path.write_text(yaml.safe_dump(config))
+            script = (
+                "import os, sys\n"
+                "sys.argv = ['gunicorn', '--preload', 'wsgi:application']\n"
+                "import ansible_link\n"
+                "app = ansible_link.main()\n"
+                "assert ansible_link.services_pid is None and ansible_link.playbook_index.ready\n"
+                "assert 'ansible_runner' not in sys.modules and 'requests' not in sys.modules\n"
+                "pid = os.fork()\n"
+                "if pid == 0:\n"
+                "    ready = ansible_link.services_pid == os.getpid() and ansible_link.job_scheduler.is_running()\n"
+                "    os._exit(0 if ready and app.test_client().get('/ready').status_code == 200 else 1)\n"
+                "_, status = os.waitpid(pid, 0)\n"
+                "assert ansible_link.services_pid is None\n"
+                "os._exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)\n"
+            )
+            # from the src dir so the script imports ansible_link wherever the suite runs from
+            result = subprocess.run([sys.executable, '-c', script], env=dict(os.environ, ANSIBLE_LINK_CONFIG_PATH=str(config_path)),
+                                    cwd=src_dir, capture_output=True, text=True, timeout=60)
+            self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+
     def test_load_config(self):
         config = load_config()
         self.assertIsInstance(config, dict)
@@ -46,7 +180,7 @@ class TestAnsibleLink(unittest.TestCase):
         self.assertEqual(response.status_code, 202)
         data = json.loads(response.data)
         self.assertIn('job_id', data)
-        self.assertEqual(data['status'], 'running')
+        self.assertEqual(data['status'], 'pending')
 
     def test_job_creation_and_retrieval(self):
         config = load_config()
@@ -62,8 +196,7 @@ class TestAnsibleLink(unittest.TestCase):
         
         time.sleep(2)
         
-        job_file_path = Path(config['job_storage_dir']) / f"{job_id}.json"
-        self.assertTrue(job_file_path.exists(), f"Job file {job_file_path} does not exist")
+        self.assertIsNotNone(ansible_link.job_storage.get_job(job_id), f"Job {job_id} not found in job storage")
         
         job_folder_path = Path(config['job_storage_dir']) / job_id
         self.assertTrue(job_folder_path.exists(), f"Job folder {job_folder_path} does not exist")
@@ -98,11 +231,353 @@ class TestAnsibleLink(unittest.TestCase):
         for key in expected_keys:
             self.assertIn(key, job_data, f"Expected key '{key}' not found in job data")
         
-        # check keys using file on disk
-        with open(job_file_path, 'r') as f:
-            file_data = json.load(f)
+        # check keys using storage
+        stored_data = ansible_link.job_storage.get_job(job_id)
         for key in expected_keys:
-            self.assertIn(key, file_data, f"Expected key '{key}' not found in job file")
+            self.assertIn(key, stored_data, f"Expected key '{key}' not found in stored job")
+
+    def test_jobs_pagination_and_etag(self):
+        for _ in range(2):
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+            self.assertEqual(response.status_code, 202)
+
+        response = self.client.get(f'{API_PATH}/ansible/jobs?limit=1&fields=status,start_time')
+        self.assertEqual(response.status_code, 200)
+        first_page = json.loads(response.data)
+        self.assertEqual(len(first_page), 1)
+        self.assertEqual(set(next(iter(first_page.values()))), {'status', 'start_time'})
+        cursor = response.headers['X-Next-Cursor']
+
+        response = self.client.get(f'{API_PATH}/ansible/jobs?limit=1&fields=status,start_time&cursor={cursor}')
+        second_page = json.loads(response.data)
+        self.assertEqual(len(second_page), 1)
+        self.assertNotEqual(list(first_page), list(second_page))
+
+        response = self.client.get(f'{API_PATH}/ansible/jobs?playbook=test_playbook.yml&since=2000-01-01')
+        etag = response.headers['ETag']
+        response = self.client.get(f'{API_PATH}/ansible/jobs?playbook=test_playbook.yml&since=2000-01-01', headers={'If-None-Match': etag})
+        self.assertIn(response.status_code, [200, 304])  # a job may have changed status in between
+
+        response = self.client.get(f'{API_PATH}/ansible/jobs?fields=stdout')
+        self.assertEqual(response.status_code, 400)
+
+    def test_job_output_range(self):
+        response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+        job_id = json.loads(response.data)['job_id']
+        self.client.get(f'{API_PATH}/ansible/job/{job_id}/stream').get_data()  # returns once the job finished
+
+        response = self.client.get(f'{API_PATH}/ansible/job/{job_id}?offset=0&limit=1&unit=lines')
+        self.assertEqual(response.status_code, 200)
+        job_data = json.loads(response.data)
+        self.assertLessEqual(job_data['stdout'].count('\n'), 1)
+        self.assertIn('stdout_size', job_data)
+        self.assertIn('stdout_next_offset', job_data)
+
+        response = self.client.get(f'{API_PATH}/ansible/job/{job_id}?unit=pages')
+        self.assertEqual(response.status_code, 400)
+
+    def test_job_stream_endpoint(self):
+        response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+        job_id = json.loads(response.data)['job_id']
+
+        response = self.client.get(f'{API_PATH}/ansible/job/{job_id}/stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        body = response.get_data(as_text=True)  # returns once the job finished
+        self.assertIn('event: status', body)
+
+        response = self.client.get(f'{API_PATH}/ansible/job/does-not-exist/stream')
+        self.assertEqual(response.status_code, 404)
+
+    def test_validate_endpoint(self):
+        response = self.client.post(f'{API_PATH}/ansible/playbook/validate', json={'playbook': 'test_playbook.yml', 'forks': '3'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(data['valid'])
+        self.assertEqual(data['request']['forks'], 3)
+
+        response = self.client.post(f'{API_PATH}/ansible/playbook/validate', json={'playbook': 'missing.yml', 'verbosity': 9})
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertFalse(data['valid'])
+        self.assertEqual(len(data['errors']), 2)
+
+    def test_batch_endpoint(self):
+        payload = {'playbook': 'test_playbook.yml', 'limit': ['localhost', 'all'], 'max_parallel': 1}
+        response = self.client.post(f'{API_PATH}/ansible/playbooks/batch', json=payload)
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(len(data['job_ids']), 2)
+
+        response = self.client.get(f'{API_PATH}/ansible/playbooks/batch/{data["batch_id"]}')
+        self.assertEqual(response.status_code, 200)
+        batch = json.loads(response.data)
+        self.assertEqual(batch['total'], 2)
+        self.assertEqual(list(batch['jobs']), data['job_ids'])
+        self.assertEqual(ansible_link.job_storage.get_job(data['job_ids'][0])['limit'], 'localhost')
+
+        response = self.client.post(f'{API_PATH}/ansible/playbooks/batch', json={'jobs': [{'playbook': 'test_playbook.yml'}, {'playbook': 'missing.yml'}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(json.loads(response.data)['errors'][0].startswith('jobs[1]: '))
+
+        response = self.client.get(f'{API_PATH}/ansible/playbooks/batch/does-not-exist')
+        self.assertEqual(response.status_code, 404)
+
+    def test_dedup_attaches_to_inflight_job(self):
+        payload = {'playbook': 'test_playbook.yml', 'vars': {'dedup': True}}
+        playbook_request, _ = ansible_link.request_validator.validate(payload)
+        deduplicator = JobDeduplicator()
+        deduplicator.acquire(spec_key(playbook_request), 'existing-job')
+        previous, ansible_link.job_deduplicator = ansible_link.job_deduplicator, deduplicator
+        try:
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json=payload)
+        finally:
+            ansible_link.job_deduplicator = previous
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(data['job_id'], 'existing-job')
+        self.assertEqual(data['deduplicated'], 'inflight')
+
+    def wait_for_status(self, job_id, statuses, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status = ansible_link.job_storage.get_job(job_id)['status']
+            if status in statuses:
+                return status
+            time.sleep(0.05)
+        return status
+
+    def test_admission_caps_forks(self):
+        class RecordingExecutor(FakeExecutor):
+            def execute(self, job_id, runner_kwargs, *args):
+                forks.append(runner_kwargs['forks'])
+                return super().execute(job_id, runner_kwargs, *args)
+
+        forks = []
+        previous = ansible_link.job_executor
+        ansible_link.job_executor = RecordingExecutor(events=5)
+        ansible_link.admission_controller.configure(enabled=True, max_forks=20, playbooks={'test_playbook.yml': 3})
+        try:
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml', 'forks': 50})
+            job_id = json.loads(response.data)['job_id']
+            self.assertEqual(self.wait_for_status(job_id, ['completed']), 'completed')
+        finally:
+            ansible_link.job_executor = previous
+            ansible_link.admission_controller.configure(**ansible_link.admission_settings(ansible_link.config))
+        self.assertEqual(forks, [3])
+        self.assertEqual(ansible_link.admission_controller.forks_in_use(), 0)
+
+    def test_sharded_job(self):
+        previous = ansible_link.job_executor, ansible_link.inventory_cache
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            binary = Path(tmp_dir) / 'ansible-inventory'
+            binary.write_text(f"#!/bin/sh\necho '{json.dumps(INVENTORY_DATA)}'\n")
+            binary.chmod(0o755)
+            ansible_link.inventory_cache = InventoryCache(binary=str(binary))
+            try:
+                ansible_link.job_executor = FakeExecutor(events=20, hosts=5)
+                response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml', 'limit': 'webservers', 'shards': 2})
+                self.assertEqual(response.status_code, 202)
+                data = json.loads(response.data)
+                # passed as --limit @file, a long host list would not fit on the command line
+                limits = [ansible_link.job_storage.get_job(shard_id)['limit'] for shard_id in data['shard_job_ids']]
+                self.assertEqual(limits, [f"@{ansible_link.job_storage_dir / shard_id / 'limit'}" for shard_id in data['shard_job_ids']])
+                self.assertEqual([Path(limit[1:]).read_text() for limit in limits], ['web1\nweb2\n', 'web3\n'])
+                self.assertEqual(self.wait_for_status(data['job_id'], ['completed']), 'completed')
+
+                ansible_link.job_executor = FakeExecutor(duration=10, events=100)
+                response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml', 'shards': 4})
+                cancelled = json.loads(response.data)
+                self.assertEqual(len(cancelled['shard_job_ids']), 4)
+                self.wait_for_status(cancelled['job_id'], ['running'])
+                response = self.client.delete(f'{API_PATH}/ansible/job/{cancelled["job_id"]}')
+                self.assertIn(response.status_code, (200, 202))
+                self.assertEqual(self.wait_for_status(cancelled['job_id'], ['cancelled']), 'cancelled')
+            finally:
+                ansible_link.job_executor, ansible_link.inventory_cache = previous
+
+        job = json.loads(self.client.get(f'{API_PATH}/ansible/job/{data["job_id"]}').data)
+        self.assertEqual(job['hosts'], 3)
+        self.assertEqual(job['shard_counts'], {'completed': 2})
+        self.assertEqual(list(job['shard_jobs']), data['shard_job_ids'])
+        # both shards report the fake executor's hosts, their counts add up
+        self.assertEqual(job['stats']['ok']['host-0'], 8)
+        job = json.loads(self.client.get(f'{API_PATH}/ansible/job/{cancelled["job_id"]}').data)
+        self.assertEqual(job['shard_counts'], {'cancelled': 4})
+
+        response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml', 'shards': 1000})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("'shards' must be an integer between 1 and 16", json.loads(response.data)['errors'])
+
+    def test_cancel_and_timeout_running_jobs(self):
+        previous, ansible_link.job_executor = ansible_link.job_executor, FakeExecutor(duration=10, events=100)
+        try:
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+            job_id = json.loads(response.data)['job_id']
+            self.assertEqual(self.wait_for_status(job_id, ['running']), 'running')
+
+            response = self.client.delete(f'{API_PATH}/ansible/job/{job_id}')
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(json.loads(response.data)['status'], 'cancelling')
+            self.assertEqual(self.wait_for_status(job_id, ['cancelled'], timeout=3), 'cancelled')
+            self.assertNotIn(job_id, ansible_link.running_jobs)
+            self.assertEqual(self.client.delete(f'{API_PATH}/ansible/job/{job_id}').status_code, 409)
+
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml', 'timeout': 1})
+            job_id = json.loads(response.data)['job_id']
+            self.assertEqual(ansible_link.job_storage.get_job(job_id)['timeout'], 1)
+            self.assertEqual(self.wait_for_status(job_id, ['timed_out'], timeout=5), 'timed_out')
+        finally:
+            ansible_link.job_executor = previous
+
+        self.assertEqual(self.client.delete(f'{API_PATH}/ansible/job/missing').status_code, 404)
+        response = self.client.post(f'{API_PATH}/ansible/playbook/validate', json={'playbook': 'test_playbook.yml', 'timeout': -1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_job_output_endpoint(self):
+        storage = ansible_link.job_storage
+        storage.save_job('output-job', {'status': 'completed', 'playbook': 'test_playbook.yml', 'start_time': '2024-01-01T00:00:00'})
+        output = ''.join(f'ok: [host{i}]\n' for i in range(500))
+        with storage.open_output_log('output-job') as log:
+            log.write(output)
+        self.assertGreater(storage.compress_output('output-job'), 0)
+
+        response = self.client.get(f'{API_PATH}/ansible/job/output-job/output', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data).decode(), output)
+
+        response = self.client.get(f'{API_PATH}/ansible/job/output-job/output')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(as_text=True), output)
+
+        response = self.client.get(f'{API_PATH}/ansible/job/output-job/output?offset=2&limit=1&unit=lines')
+        self.assertEqual(response.get_data(as_text=True), 'ok: [host2]\n')
+        self.assertEqual(response.headers['X-Next-Offset'], '3')
+
+        response = self.client.get(f'{API_PATH}/ansible/job/output-job', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.data))['stdout'], output)
+        self.assertEqual(self.client.get(f'{API_PATH}/ansible/job/missing/output').status_code, 404)
+
+    def test_job_timings_endpoint(self):
+        response = self.client.get(f'{API_PATH}/ansible/job/missing/timings')
+        self.assertEqual(response.status_code, 404)
+
+        ansible_link.job_storage.save_job('timed-job', {'status': 'completed', 'playbook': 'test_playbook.yml', 'start_time': '2024-01-01T00:00:00'})
+        timings = TimingAggregator()
+        for host, duration in (('a', 1.0), ('b', 2.0)):
+            timings.add({'event': 'runner_on_ok', 'host': host, 'task': 'ping', 'task_uuid': 'u1', 'duration': duration})
+        ansible_link.job_storage.save_job_timings('timed-job', timings.summary())
+
+        response = self.client.get(f'{API_PATH}/ansible/job/timed-job/timings?limit=1')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(data['complete'])
+        self.assertEqual(data['hosts'], [{'host': 'b', 'duration': 2.0, 'tasks': 1, 'failed': 0}])
+
+        # running in another worker process, only its last saved timings are visible
+        ansible_link.job_storage.update_job_status('timed-job', 'running')
+        data = json.loads(self.client.get(f'{API_PATH}/ansible/job/timed-job/timings').data)
+        self.assertFalse(data['complete'])
+        self.assertEqual(data['task_count'], 1)
+
+    def test_job_events_endpoint(self):
+        previous, ansible_link.job_executor = ansible_link.job_executor, FakeExecutor(events=20, hosts=5)
+        try:
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+            job_id = json.loads(response.data)['job_id']
+            self.assertEqual(self.wait_for_status(job_id, ['completed']), 'completed')
+        finally:
+            ansible_link.job_executor = previous
+
+        response = self.client.get(f'{API_PATH}/ansible/job/{job_id}/events?host=host-1&limit=3')
+        data = json.loads(response.data)
+        self.assertTrue(data['complete'])
+        self.assertEqual([event['counter'] for event in data['events']], [1, 6, 11])
+        self.assertEqual({event['status'] for event in data['events']}, {'ok'})
+        response = self.client.get(f"{API_PATH}/ansible/job/{job_id}/events?host=host-1&after={data['next_after']}")
+        self.assertEqual([event['counter'] for event in json.loads(response.data)['events']], [16])
+
+        self.assertEqual(self.client.get(f'{API_PATH}/ansible/job/{job_id}/events?status=broken').status_code, 400)
+        self.assertEqual(self.client.get(f'{API_PATH}/ansible/job/missing/events').status_code, 404)
+
+    def test_events_are_indexed_from_artifacts(self):
+        ansible_link.job_storage.delete_jobs(['artifact-job-1', 'artifact-job-2'])
+        for i, job_id in enumerate(['artifact-job-1', 'artifact-job-2']):
+            ansible_link.job_storage.save_job(job_id, {'status': 'failed', 'playbook': 'test_playbook.yml', 'start_time': '2024-01-01T00:00:00'})
+            events_dir = ansible_link.job_storage_dir / job_id / 'artifacts' / 'ident' / 'job_events'
+            events_dir.mkdir(parents=True, exist_ok=True)
+            events = [
+                {'event': 'playbook_on_task_start', 'counter': 1, 'event_data': {'task': 'install'}},
+                {'event': 'runner_on_failed', 'counter': 2, 'created': f'2024-01-0{i + 1}T00:00:00', 'stdout': 'fatal: [db-archived]: FAILED!',
+                 'event_data': {'host': 'db-archived', 'task': 'install', 'play': 'db', 'duration': 1.5}},
+            ]
+            for event in events:
+                with open(events_dir / f"{event['counter']}-uuid.json", 'w') as f:
+                    json.dump(event, f)
+
+        response = self.client.get(f'{API_PATH}/ansible/job/artifact-job-1/events?status=failed&task=inst')
+        events = json.loads(response.data)['events']
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]['host'], events[0]['stdout']), ('db-archived', 'fatal: [db-archived]: FAILED!'))
+
+        # the second job is only found across jobs once it was indexed
+        response = self.client.get(f'{API_PATH}/ansible/events?host=db-archived&status=failed')
+        self.assertEqual([event['job_id'] for event in json.loads(response.data)['events']], ['artifact-job-1'])
+        self.client.get(f'{API_PATH}/ansible/job/artifact-job-2/events')
+        response = self.client.get(f'{API_PATH}/ansible/events?host=db-archived&status=failed&limit=1')
+        self.assertEqual(json.loads(response.data)['events'][0]['job_id'], 'artifact-job-2')
+        response = self.client.get(f"{API_PATH}/ansible/events?host=db-archived&limit=1&cursor={response.headers['X-Next-Cursor']}")
+        self.assertEqual(json.loads(response.data)['events'][0]['job_id'], 'artifact-job-1')
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_wait_for_job(self):
+        storage = ansible_link.job_storage
+        storage.save_job('waiting-job', {'status': 'running', 'playbook': 'test_playbook.yml', 'start_time': '2024-01-01T00:00:00'})
+        response = self.client.get(f'{API_PATH}/ansible/job/waiting-job?wait=0.2')
+        self.assertEqual(json.loads(response.data)['status'], 'running')
+        self.assertEqual(self.client.get(f'{API_PATH}/ansible/job/waiting-job?wait=soon').status_code, 400)
+        self.assertEqual(self.client.get(f'{API_PATH}/ansible/job/waiting-job?wait=100000').status_code, 400)
+
+        server = AsgiServer(self.app, storage, ansible_link.event_broadcaster, f'{API_PATH}/ansible', poll_interval=0.1)
+        try:
+            # running in "another process", only visible through the storage
+            threading.Timer(0.3, storage.update_job_status, ('waiting-job', 'completed')).start()
+            started = time.monotonic()
+            status, body = asgi_get(server, f'{API_PATH}/ansible/job/waiting-job', b'wait=10')
+            self.assertEqual((status, json.loads(body)['status']), (200, 'completed'))
+            self.assertLess(time.monotonic() - started, 5)
+
+            self.assertEqual(asgi_get(server, '/health')[0], 200)
+            self.assertEqual(asgi_get(server, f'{API_PATH}/ansible/job/waiting-job', b'wait=soon')[0], 400)
+            self.assertEqual(asgi_get(server, f'{API_PATH}/ansible/job/missing', b'wait=1')[0], 404)
+        finally:
+            server.close()
+
+    def test_asgi_long_poll_and_stream(self):
+        previous, ansible_link.job_executor = ansible_link.job_executor, FakeExecutor(duration=1, events=10)
+        server = AsgiServer(self.app, ansible_link.job_storage, ansible_link.event_broadcaster, f'{API_PATH}/ansible', poll_interval=0.1)
+        try:
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+            job_id = json.loads(response.data)['job_id']
+            status, body = asgi_get(server, f'{API_PATH}/ansible/job/{job_id}', b'wait=10')
+            self.assertEqual(json.loads(body)['status'], 'completed')
+
+            response = self.client.post(f'{API_PATH}/ansible/playbook', json={'playbook': 'test_playbook.yml'})
+            job_id = json.loads(response.data)['job_id']
+            self.assertEqual(self.wait_for_status(job_id, ['running']), 'running')
+            status, body = asgi_get(server, f'{API_PATH}/ansible/job/{job_id}/stream')
+            body = body.decode()
+            self.assertEqual(status, 200)
+            self.assertEqual(body.count('event: runner_event'), 10)
+            self.assertIn('"status": "completed"', body)
+        finally:
+            ansible_link.job_executor = previous
+            server.close()
+
+    def test_inventory_hosts_endpoint(self):
+        response = self.client.get(f'{API_PATH}/ansible/inventory/missing.ini/hosts')
+        self.assertEqual(response.status_code, 404)
 
     def test_available_playbooks_endpoint(self):
         response = self.client.get(f'{API_PATH}/ansible/available-playbooks')
@@ -114,7 +589,964 @@ class TestAnsibleLink(unittest.TestCase):
         self.assertIn('test_playbook.yml', data['playbooks'], "test_playbook.yml is not in the list of available playbooks")
         
         for playbook in data['playbooks']:
-            self.assertTrue(playbook.endswith('.yml'), f"Playbook {playbook} does not end with .yml")
+            self.assertTrue(playbook.endswith(('.yml', '.yaml')), f"Playbook {playbook} does not end with .yml or .yaml")
+
+class TestSQLiteJobStorage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage_dir = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_job_roundtrip(self):
+        storage = SQLiteJobStorage(self.storage_dir)
+        storage.save_job('job-1', {'status': 'pending', 'playbook': 'site.yml', 'start_time': '2024-01-01T00:00:00', 'vars': {'a': 1}})
+        storage.update_job_status('job-1', 'completed')
+        storage.save_job_output('job-1', 'out', 'err', {'ok': {'localhost': 1}}, 'ansible-playbook site.yml')
+
+        job = storage.get_job('job-1')
+        self.assertEqual(job['status'], 'completed')
+        self.assertEqual(job['vars'], {'a': 1})
+        self.assertEqual(job['stdout'], 'out')
+        self.assertEqual(job['stats'], {'ok': {'localhost': 1}})
+        self.assertIn('end_time', job)
+        self.assertEqual(storage.list_jobs()['job-1']['status'], 'completed')
+        self.assertNotIn('stdout', storage.list_jobs()['job-1'])
+        self.assertIsNone(storage.get_job('missing'))
+
+    def test_list_jobs_filters_and_cursor(self):
+        storage = SQLiteJobStorage(self.storage_dir)
+        for i in range(5):
+            storage.save_job(f'job-{i}', {'status': 'failed' if i % 2 else 'completed', 'playbook': 'site.yml', 'start_time': f'2024-01-0{i + 1}T00:00:00'})
+
+        page = storage.list_jobs(limit=2)
+        self.assertEqual(list(page), ['job-4', 'job-3'])
+        next_page = storage.list_jobs(limit=2, cursor=encode_cursor(page['job-3']['start_time'], 'job-3'))
+        self.assertEqual(list(next_page), ['job-2', 'job-1'])
+
+        self.assertEqual(list(storage.list_jobs(status=['failed'])), ['job-3', 'job-1'])
+        self.assertEqual(list(storage.list_jobs(start_after='2024-01-02', start_before='2024-01-04')), ['job-2', 'job-1'])
+        self.assertEqual(storage.list_jobs(playbook='other.yml'), {})
+
+    def test_batch_roundtrip(self):
+        for storage in [SQLiteJobStorage(self.storage_dir), JsonJobStorage(self.storage_dir / 'json')]:
+            jobs = {f'job-{i}': {'status': 'pending', 'playbook': 'site.yml', 'start_time': '2024-01-01T00:00:00', 'batch_id': 'batch-1'}
+                    for i in (2, 1, 3)}
+            storage.save_batch('batch-1', {'max_parallel': 2}, jobs)
+            storage.update_jobs_status(['job-1', 'job-3'], 'cancelled')
+
+            batch = storage.get_batch('batch-1')
+            self.assertEqual(batch['max_parallel'], 2)
+            self.assertEqual(list(batch['jobs']), ['job-2', 'job-1', 'job-3'])
+            self.assertEqual(batch['jobs']['job-3']['status'], 'cancelled')
+            self.assertEqual(storage.get_job('job-2')['batch_id'], 'batch-1')
+            self.assertIsNone(storage.get_batch('missing'))
+        self.assertEqual(len(JsonJobStorage(self.storage_dir / 'json').get_all_jobs()), 3)
+
+    def test_timings_roundtrip(self):
+        for storage in [SQLiteJobStorage(self.storage_dir), JsonJobStorage(self.storage_dir / 'json')]:
+            storage.save_job('job-1', {'status': 'completed', 'playbook': 'site.yml', 'start_time': '2024-01-01T00:00:00'})
+            storage.save_job_timings('job-1', {'critical_path': 1.5, 'tasks': [], 'hosts': []})
+            self.assertEqual(storage.get_job_timings('job-1')['critical_path'], 1.5)
+            self.assertIsNone(storage.get_job_timings('missing'))
+            storage.delete_jobs(['job-1'])
+            self.assertIsNone(storage.get_job_timings('job-1'))
+
+    def test_conditional_status_update(self):
+        for storage in [SQLiteJobStorage(self.storage_dir), JsonJobStorage(self.storage_dir / 'json')]:
+            storage.save_job('job-1', {'status': 'pending', 'playbook': 'site.yml', 'start_time': '2024-01-01T00:00:00'})
+            self.assertTrue(storage.update_job_status_if('job-1', 'running', ['pending']))
+            self.assertFalse(storage.update_job_status_if('job-1', 'cancelled', ['pending']))
+            self.assertEqual(storage.get_job('job-1')['status'], 'running')
+            self.assertFalse(storage.update_job_status_if('missing', 'running', ['pending']))
+
+    def test_compressed_output(self):
+        storage = SQLiteJobStorage(self.storage_dir)
+        with storage.open_output_log('job-1') as log:
+            for i in range(300):
+                log.write(f'line {i} ' + 'x' * (i % 40) + '\n')
+        ranges = [(0, None, 'bytes'), (1000, 77, 'bytes'), (99999, 5, 'bytes'), (10, 5, 'lines'), (295, 10, 'lines'), (0, None, 'lines')]
+        expected = [storage.read_output('job-1', *args) for args in ranges]
+        size = storage.output_size('job-1')
+
+        storage.compress_output('job-1', segment_size=256)
+        self.assertFalse((self.storage_dir / 'output' / 'job-1.log').exists())
+        self.assertEqual([storage.read_output('job-1', *args) for args in ranges], expected)
+        self.assertEqual(storage.output_size('job-1'), size)
+        self.assertEqual(b''.join(storage.iter_output('job-1')).decode(), expected[0][0])
+
+        storage.save_job('job-1', {'status': 'completed', 'playbook': 'site.yml', 'start_time': '2024-01-01T00:00:00'})
+        self.assertEqual(storage.archive_outputs(['job-1'])[0], ['job-1'])
+        self.assertEqual(list(self.storage_dir.joinpath('output').iterdir()), [])
+        self.assertEqual([storage.read_output('job-1', *args) for args in ranges], expected)
+        self.assertEqual(storage.output_size('job-1'), size)
+        self.assertEqual(b''.join(storage.iter_output('job-1')).decode(), expected[0][0])
+
+        # archived without being compressed first
+        with storage.open_output_log('job-2') as log:
+            log.write(expected[0][0])
+        storage.archive_outputs(['job-2'])
+        self.assertEqual([storage.read_output('job-2', *args) for args in ranges], expected)
+        self.assertEqual(b''.join(storage.iter_output('job-2')).decode(), expected[0][0])
+
+    def test_stats_are_packed_per_host(self):
+        stats = {'ok': {'web1': 3, 'web2': 2}, 'changed': {'web1': 1}, 'failures': {}, 'dark': {'web3': 1}}
+        for storage in [SQLiteJobStorage(self.storage_dir), JsonJobStorage(self.storage_dir / 'json')]:
+            storage.save_job('job-1', {'status': 'running', 'playbook': 'site.yml', 'start_time': '2024-01-01T00:00:00'})
+            storage.save_job_output('job-1', None, '', stats)
+            self.assertEqual(storage.get_job('job-1')['stats'], stats)
+        with open(self.storage_dir / 'json' / 'job-1.json') as f:
+            self.assertEqual(json.load(f)['stats']['hosts']['web1'], [1, None, None, 3])
+
+    def test_output_log_ranges(self):
+        storage = SQLiteJobStorage(self.storage_dir)
+        with storage.open_output_log('job-1') as log:
+            for i in range(5):
+                log.write(f'line {i}\n')
+
+        self.assertEqual(storage.output_size('job-1'), 35)
+        self.assertEqual(storage.read_output('job-1', 7, 7), ('line 1\n', 14))
+        self.assertEqual(storage.read_output('job-1', 3, 10, unit='lines'), ('line 3\nline 4\n', 5))
+        self.assertEqual(storage.read_output('job-1', 1, 1, unit='lines'), ('line 1\n', 2))
+        self.assertEqual(storage.read_output('job-1', 100), ('', 35))
+        self.assertEqual(storage.read_output('missing'), ('', 0))
+
+    def test_json_migration(self):
+        with open(self.storage_dir / 'old-job.json', 'w') as f:
+            json.dump({'status': 'failed', 'playbook': 'old.yml', 'start_time': '2023-01-01T00:00:00', 'stdout': 'old output', 'stats': {}}, f)
+
+        storage = SQLiteJobStorage(self.storage_dir)
+        job = storage.get_job('old-job')
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['stdout'], 'old output')
+
+        # migration only runs once
+        with open(self.storage_dir / 'new-job.json', 'w') as f:
+            json.dump({'status': 'failed', 'playbook': 'new.yml'}, f)
+        self.assertEqual(SQLiteJobStorage(self.storage_dir).migrate_json_jobs(), 0)
+        self.assertIsNone(storage.get_job('new-job'))
+
+class TestRetentionManager(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage_dir = Path(self.tmp_dir.name)
+        self.storage = SQLiteJobStorage(self.storage_dir)
+        for i in range(4):
+            job_id = f'job-{i}'
+            self.storage.save_job(job_id, {'status': 'completed', 'playbook': 'site.yml', 'start_time': f'2024-01-0{i + 1}T00:00:00'})
+            with self.storage.open_output_log(job_id) as log:
+                log.write(f'output of {job_id}\n' * 100)
+            (self.storage_dir / job_id / 'artifacts').mkdir(parents=True)
+            (self.storage_dir / job_id / 'artifacts' / 'stdout').write_text('x' * 100)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_compaction(self):
+        retention = RetentionManager(self.storage, self.storage_dir, archive_after_days=7)
+        summary = retention.run_once(now=datetime(2024, 1, 11))
+        self.assertEqual(summary['compacted'], 3)
+        self.assertFalse((self.storage_dir / 'job-0').exists())
+        self.assertTrue((self.storage_dir / 'job-3').exists())
+        self.assertEqual(len(self.storage.archives()), 1)
+
+        self.assertTrue(self.storage.has_output_log('job-0'))
+        self.assertEqual(self.storage.output_size('job-0'), len('output of job-0\n') * 100)
+        self.assertEqual(self.storage.read_output('job-0', 1, 1, 'lines'), ('output of job-0\n', 2))
+
+        # later runs only look at jobs after the previous cutoff
+        self.assertEqual(retention.run_once(now=datetime(2024, 1, 12))['compacted'], 1)
+
+    def test_compaction_waits_for_running_jobs(self):
+        self.storage.update_job_status('job-1', 'running')
+        retention = RetentionManager(self.storage, self.storage_dir, archive_after_days=7)
+        self.assertEqual(retention.run_once(now=datetime(2024, 1, 11))['compacted'], 2)
+        self.assertTrue((self.storage_dir / 'job-1').exists())
+
+        self.storage.update_job_status('job-1', 'completed')
+        self.assertEqual(retention.run_once(now=datetime(2024, 1, 11))['compacted'], 1)
+        self.assertFalse((self.storage_dir / 'job-1').exists())
+        self.assertEqual(retention.run_once(now=datetime(2024, 1, 11))['compacted'], 0)
+
+    def test_delete_policies(self):
+        registry = CollectorRegistry()
+        metrics = RetentionMetrics(Counter('retention_reclaimed_bytes', 'reclaimed', ['source'], registry=registry),
+                                   Counter('retention_jobs', 'jobs', ['action'], registry=registry))
+        retention = RetentionManager(self.storage, self.storage_dir, archive_after_days=0, max_jobs=2, metrics=metrics)
+        self.assertEqual(retention.run_once()['deleted'], 2)
+        self.assertEqual(registry.get_sample_value('retention_jobs_total', {'action': 'deleted'}), 2)
+        self.assertEqual(list(self.storage.list_jobs()), ['job-3', 'job-2'])
+        self.assertFalse((self.storage_dir / 'job-1').exists())
+        self.assertFalse(self.storage.has_output_log('job-1'))
+
+        self.storage.archive_outputs(['job-2'])
+        retention = RetentionManager(self.storage, self.storage_dir, archive_after_days=0, max_bytes=1)
+        self.assertEqual(retention.run_once()['deleted'], 1)
+        self.assertEqual(self.storage.archives(), [])
+        self.assertIsNone(self.storage.get_job('job-2'))
+
+class TestEventBroadcaster(unittest.TestCase):
+    def test_replay_and_resume(self):
+        broadcaster = EventBroadcaster(buffer_size=10)
+        broadcaster.open('job-1')
+        for i in range(3):
+            broadcaster.publish('job-1', 'runner_event', {'counter': i})
+        broadcaster.close('job-1')
+
+        events = list(broadcaster.subscribe('job-1'))
+        self.assertEqual([event[0] for event in events], [1, 2, 3])
+        resumed = list(broadcaster.subscribe('job-1', last_event_id=2))
+        self.assertEqual(resumed, [(3, 'runner_event', {'counter': 2})])
+        self.assertEqual(list(broadcaster.subscribe('unknown')), [])
+
+    def test_live_subscriber(self):
+        broadcaster = EventBroadcaster()
+        broadcaster.open('job-1')
+        received = []
+        subscriber = threading.Thread(target=lambda: received.extend(broadcaster.subscribe('job-1', keepalive=1)))
+        subscriber.start()
+        broadcaster.publish('job-1', 'status', {'status': 'running'})
+        broadcaster.close('job-1')
+        subscriber.join(5)
+        self.assertEqual([event[2] for event in received if event], [{'status': 'running'}])
+
+class WebhookReceiver(BaseHTTPRequestHandler):
+    received = []
+    fail_next = 0
+    fail_status = 500
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if WebhookReceiver.fail_next:
+            WebhookReceiver.fail_next -= 1
+            self.send_response(WebhookReceiver.fail_status)
+        else:
+            WebhookReceiver.received.append(body)
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class TestWebhookSender(unittest.TestCase):
+    def setUp(self):
+        WebhookReceiver.received = []
+        WebhookReceiver.fail_next = 0
+        WebhookReceiver.fail_status = 500
+        self.server = HTTPServer(('127.0.0.1', 0), WebhookReceiver)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/hook'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline and not condition():
+            time.sleep(0.05)
+        return condition()
+
+    def job(self, job_id):
+        return {'job_id': job_id, 'playbook': 'site.yml', 'status': 'completed'}
+
+    def test_retry_and_spool(self):
+        WebhookReceiver.fail_next = 2
+        sender = WebhookSender({'url': self.url, 'retries': 3, 'backoff': 0.01}, spool_dir=self.tmp_dir.name)
+        sender.start()
+        sender.send('job_completed', self.job('job-1'))
+        self.assertTrue(self.wait_for(lambda: WebhookReceiver.received))
+        sender.stop()
+        self.assertEqual(WebhookReceiver.received[0]['job_id'], 'job-1')
+        self.assertTrue(self.wait_for(lambda: not list(Path(self.tmp_dir.name).rglob('*.json'))))
+
+    def test_spooled_events_survive_restart(self):
+        sender = WebhookSender({'url': self.url}, spool_dir=self.tmp_dir.name)
+        sender.send('job_started', self.job('job-1'))  # never started, stays in the spool
+        self.assertEqual(len(list(Path(self.tmp_dir.name).rglob('*.json'))), 1)
+
+        # the spool of a sender that is still running is not touched
+        other = WebhookSender({'url': self.url}, spool_dir=self.tmp_dir.name)
+        other.targets[0]._adopt_spools()
+        self.assertEqual(len(list(other.targets[0].spool_dir.glob('*.json'))), 0)
+        other.stop()
+        sender.stop()
+        # never started, the spool lock is released by stop
+        self.assertIsNone(sender.targets[0]._spool_lock)
+
+        restarted = WebhookSender({'url': self.url}, spool_dir=self.tmp_dir.name)
+        restarted.start()
+        self.assertTrue(self.wait_for(lambda: WebhookReceiver.received))
+        restarted.stop()
+        self.assertEqual(WebhookReceiver.received[0]['event_type'], 'job_started')
+
+    def test_failed_events_are_retried_from_spool(self):
+        WebhookReceiver.fail_next = 2
+        sender = WebhookSender({'url': self.url, 'retries': 0, 'spool_interval': 0.2}, spool_dir=self.tmp_dir.name)
+        sender.start()
+        sender.send('job_completed', self.job('job-1'))
+        self.assertTrue(self.wait_for(lambda: WebhookReceiver.received))
+        self.assertTrue(self.wait_for(lambda: not list(Path(self.tmp_dir.name).rglob('*.json'))))
+        sender.stop()
+        self.assertEqual([payload['job_id'] for payload in WebhookReceiver.received], ['job-1'])
+
+    def test_rejected_events_are_not_retried(self):
+        WebhookReceiver.fail_next, WebhookReceiver.fail_status = 1, 404
+        registry = CollectorRegistry()
+        metrics = WebhookMetrics(*[metric(f'webhook_{name}', name, ['target'], registry=registry) for metric, name in
+                                   ((Histogram, 'latency'), (Counter, 'failures'), (Counter, 'dropped'), (Gauge, 'queue_depth'))])
+        sender = WebhookSender({'url': self.url, 'retries': 3, 'backoff': 0.01, 'spool_interval': 0.1}, spool_dir=self.tmp_dir.name,
+                               metrics=metrics)
+        sender.start()
+        sender.send('job_completed', self.job('job-1'))
+        self.assertTrue(self.wait_for(lambda: not list(Path(self.tmp_dir.name).rglob('*.json'))))
+        time.sleep(0.3)
+        sender.stop()
+        self.assertEqual(WebhookReceiver.received, [])
+        self.assertEqual(registry.get_sample_value('webhook_dropped_total', {'target': 'generic'}), 1)
+        self.assertEqual(registry.get_sample_value('webhook_failures_total', {'target': 'generic'}), 1)
+
+    def test_spool_is_bounded(self):
+        sender = WebhookSender({'url': self.url, 'spool_max_events': 2, 'spool_max_age': 3600}, spool_dir=self.tmp_dir.name)
+        target = sender.targets[0]
+        target._queue = queue.Queue(maxsize=1)
+        for i in range(4):
+            sender.send('job_completed', self.job(f'job-{i}'))
+        spool_paths = sorted(target.spool_dir.glob('*.json'))
+        os.utime(spool_paths[2], (0, 0))
+        target._load_spool()
+        sender.stop()
+        # job-0 is queued, of the others the oldest and the expired one are dropped
+        self.assertEqual(sorted(target.spool_dir.glob('*.json')), [spool_paths[0], spool_paths[3]])
+
+    def test_batching(self):
+        sender = WebhookSender({'url': self.url, 'type': 'slack', 'batch_window': 0.5})
+        for i in range(3):
+            sender.send('job_completed', self.job(f'job-{i}'))
+        sender.start()
+        self.assertTrue(self.wait_for(lambda: WebhookReceiver.received))
+        sender.stop()
+        self.assertEqual(len(WebhookReceiver.received), 1)
+        self.assertEqual(len(WebhookReceiver.received[0]['attachments']), 3)
+
+    def test_multiple_targets(self):
+        slow_server = HTTPServer(('127.0.0.1', 0), SlowWebhookReceiver)
+        threading.Thread(target=slow_server.serve_forever, daemon=True).start()
+        sender = WebhookSender([
+            {'name': 'errors', 'url': self.url, 'events': ['job_error']},
+            {'name': 'all', 'url': self.url, 'type': 'slack'},
+            {'name': 'slow', 'url': f'http://127.0.0.1:{slow_server.server_port}/hook', 'retries': 0},
+        ])
+        sender.start()
+        sender.send('job_completed', self.job('job-1'))
+        sender.send('job_error', dict(self.job('job-2'), status='error', error='boom'))
+
+        # the slow target must not delay the others
+        self.assertTrue(self.wait_for(lambda: len(WebhookReceiver.received) == 3, timeout=1.5))
+        sender.stop()
+        slow_server.shutdown()
+        slow_server.server_close()
+
+        generic = [payload for payload in WebhookReceiver.received if 'event_type' in payload]
+        self.assertEqual([payload['job_id'] for payload in generic], ['job-2'])
+        self.assertEqual(len([payload for payload in WebhookReceiver.received if 'attachments' in payload]), 2)
+
+class SlowWebhookReceiver(WebhookReceiver):
+    def do_POST(self):
+        time.sleep(2)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class TestPlaybookIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.playbook_dir = Path(self.tmp_dir.name)
+        (self.playbook_dir / 'roles').mkdir()
+        (self.playbook_dir / 'site.yml').touch()
+        (self.playbook_dir / 'deploy.yaml').touch()
+        (self.playbook_dir / 'roles' / 'main.yml').touch()
+        (self.playbook_dir / 'README.md').touch()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def touch_later(self, path):
+        # make sure the directory mtime visibly changes
+        path.touch()
+        stat = path.parent.stat()
+        os.utime(path.parent, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+    def test_listing_and_whitelist(self):
+        index = PlaybookIndex(self.playbook_dir, [re.compile(r'^(site|deploy)\.ya?ml$')], use_inotify=False)
+        index.build()
+        self.assertEqual(index.playbooks(), ['deploy.yaml', 'site.yml'])
+        self.assertTrue(index.lookup('site.yml'))
+        self.assertFalse(index.lookup('roles/main.yml'))
+        self.assertIsNone(index.lookup('missing.yml'))
+
+    def test_refresh(self):
+        index = PlaybookIndex(self.playbook_dir, [], use_inotify=False)
+        index.build()
+        self.assertFalse(index.refresh())
+
+        self.touch_later(self.playbook_dir / 'roles' / 'new.yml')
+        (self.playbook_dir / 'site.yml').unlink()
+        stat = self.playbook_dir.stat()
+        os.utime(self.playbook_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        self.assertTrue(index.refresh())
+        self.assertEqual(index.playbooks(), ['deploy.yaml', 'roles/main.yml', 'roles/new.yml'])
+
+    def test_lookup_falls_back_to_filesystem(self):
+        index = PlaybookIndex(self.playbook_dir, [], use_inotify=False)
+        index.build()
+        (self.playbook_dir / 'fresh.yml').touch()
+        self.assertTrue(index.lookup('fresh.yml'))
+        self.assertIn('fresh.yml', index.playbooks())
+
+INVENTORY_DATA = {
+    '_meta': {'hostvars': {'web1': {}, 'web2': {}, 'web3': {}, 'db1': {}}},
+    'all': {'children': ['ungrouped', 'webservers', 'dbservers', 'production']},
+    'webservers': {'hosts': ['web1', 'web2', 'web3']},
+    'dbservers': {'hosts': ['db1']},
+    'production': {'children': ['dbservers'], 'hosts': ['web1']},
+}
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.inventory = Inventory(json.loads(json.dumps(INVENTORY_DATA)))
+
+    def test_patterns(self):
+        self.assertEqual(self.inventory.resolve(None), ['web1', 'web2', 'web3', 'db1'])
+        self.assertEqual(self.inventory.resolve('production'), ['web1', 'db1'])
+        self.assertEqual(self.inventory.resolve('webservers:&production'), ['web1'])
+        self.assertEqual(self.inventory.resolve('webservers:!web2'), ['web1', 'web3'])
+        self.assertEqual(self.inventory.resolve('web*,db1'), ['web1', 'web2', 'web3', 'db1'])
+        self.assertEqual(self.inventory.resolve('~db\\d'), ['db1'])
+        self.assertEqual(self.inventory.resolve('webservers[0:1]'), ['web1', 'web2'])
+        self.assertEqual(self.inventory.resolve('webservers[-1]'), ['web3'])
+        self.assertEqual(self.inventory.resolve('unknown'), [])
+
+    def test_cache_reparses_only_on_change(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            calls = Path(tmp_dir) / 'calls'
+            binary = Path(tmp_dir) / 'ansible-inventory'
+            binary.write_text(f"#!/bin/sh\necho x >> {calls}\necho '{json.dumps(INVENTORY_DATA)}'\n")
+            binary.chmod(0o755)
+            inventory_file = Path(tmp_dir) / 'hosts.ini'
+            inventory_file.write_text('[webservers]\nweb1\n')
+
+            cache = InventoryCache(binary=str(binary))
+            self.assertEqual(cache.resolve(inventory_file, 'dbservers'), ['db1'])
+            cache.resolve(inventory_file, 'webservers')
+            os.utime(inventory_file, ns=(0, 0))  # touched, same content
+            cache.resolve(inventory_file, 'webservers')
+            self.assertEqual(len(calls.read_text().splitlines()), 1)
+
+            inventory_file.write_text('[webservers]\nweb1\nweb2\n')
+            cache.resolve(inventory_file, 'webservers')
+            self.assertEqual(len(calls.read_text().splitlines()), 2)
+
+class TestPlaybookRequestValidator(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        playbook_dir = Path(self.tmp_dir.name)
+        (playbook_dir / 'site.yml').write_text('- hosts: all\n')
+        (playbook_dir / 'hosts.ini').write_text('[webservers]\nweb1\n')
+        index = PlaybookIndex(playbook_dir, [re.compile(r'site\.yml')], use_inotify=False)
+        index.build()
+        config = {'playbook_dir': str(playbook_dir), 'inventory_file': str(playbook_dir / 'hosts.ini')}
+        self.validator = PlaybookRequestValidator(config, index, InventoryCache(binary='/nonexistent'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_valid_request_is_normalized(self):
+        data = {'playbook': 'site.yml', 'forks': '10', 'vars': {'a': 1}, 'limit': 'web1'}
+        playbook_request, errors = self.validator.validate(data)
+        self.assertEqual(errors, [])
+        self.assertEqual(playbook_request.forks, 10)
+        self.assertEqual(playbook_request.priority, 'normal')
+        self.assertEqual(data, {'playbook': 'site.yml', 'forks': '10', 'vars': {'a': 1}, 'limit': 'web1'})
+
+    def test_all_errors_reported(self):
+        playbook_request, errors = self.validator.validate({
+            'playbook': 'site.yml', 'inventory': 'missing.ini', 'vars': [], 'forks': 0,
+            'tags': 'ok,not ok', 'priority': 'urgent'
+        })
+        self.assertIsNone(playbook_request)
+        self.assertEqual(len(errors), 5)
+        self.assertIn("Invalid tag in 'tags': not ok", errors)
+
+        for inventory in ('/etc/hosts', '../hosts.ini', 42):
+            _, errors = self.validator.validate({'playbook': 'site.yml', 'inventory': inventory})
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(errors[0].startswith('Inventory must be a file in'))
+        self.assertEqual(self.validator.validate({'playbook': 'site.yml', 'inventory': 'hosts.ini'})[1], [])
+
+        _, errors = self.validator.validate({'playbook': 'site.yml', 'priority': []})
+        self.assertEqual(errors, ["'priority' must be one of: " + ', '.join(PRIORITIES)])
+
+    def test_invalid_limit_pattern(self):
+        binary = Path(self.tmp_dir.name) / 'ansible-inventory'
+        binary.write_text(f"#!/bin/sh\necho '{json.dumps(INVENTORY_DATA)}'\n")
+        binary.chmod(0o755)
+        self.validator.inventory_cache = InventoryCache(binary=str(binary))
+        _, errors = self.validator.validate({'playbook': 'site.yml', 'limit': '~(foo'})
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("'limit' is not a valid host pattern: "))
+
+    def test_stat_cache_is_bounded(self):
+        cache = StatCache(ttl=60, max_size=2)
+        for name in ('a.ini', 'b.ini', 'hosts.ini'):
+            cache.is_file(str(Path(self.tmp_dir.name) / name))
+        self.assertEqual(len(cache._cache), 2)
+        self.assertTrue(cache.is_file(str(Path(self.tmp_dir.name) / 'hosts.ini')))
+
+    def test_batch_fan_out(self):
+        batch_request, errors = self.validator.validate_batch({'playbook': 'site.yml', 'forks': 2, 'limit': ['a', 'b'], 'max_parallel': 1})
+        self.assertEqual(errors, [])
+        self.assertEqual([job.limit for job in batch_request.jobs], ['a', 'b'])
+        self.assertEqual(batch_request.jobs[1].forks, 2)
+        self.assertEqual(batch_request.max_parallel, 1)
+
+        _, errors = self.validator.validate_batch({'jobs': [{'playbook': 'site.yml'}, {'playbook': 'site.yml', 'forks': 0}]})
+        self.assertEqual(errors, ["jobs[1]: 'forks' must be a positive integer"])
+        _, errors = self.validator.validate_batch({'playbook': 'site.yml', 'limit': ['a', 'b']}, max_jobs=1)
+        self.assertEqual(errors, ["A batch can have at most 1 jobs, got 2"])
+        _, errors = self.validator.validate_batch({'playbook': 'site.yml', 'stop_on_failure': 'yes'})
+        self.assertEqual(len(errors), 2)
+
+    def test_playbook_checks(self):
+        self.assertEqual(self.validator.validate({})[1], ["'playbook' is required"])
+        self.assertEqual(self.validator.validate([])[1], ["Request body must be a JSON object"])
+        (Path(self.tmp_dir.name) / 'other.yml').write_text('- hosts: all\n')
+        self.assertIn("Playbook other.yml is not in the whitelist", self.validator.validate({'playbook': 'other.yml'})[1])
+
+class TestJobDeduplicator(unittest.TestCase):
+    def request(self, **kwargs):
+        spec = dict({'playbook': 'site.yml', 'playbook_path': '/playbooks/site.yml', 'inventory_path': '/hosts', 'vars': {}}, **kwargs)
+        return PlaybookRequest(**spec)
+
+    def test_spec_key(self):
+        key = spec_key(self.request(vars={'a': 1, 'b': 2}, tags='x,y'))
+        self.assertEqual(key, spec_key(self.request(vars={'b': 2, 'a': 1}, tags='y, x', priority='high')))
+        self.assertNotEqual(key, spec_key(self.request(vars={'a': 1, 'b': 2}, tags='x,y', limit='web1')))
+
+    def test_inflight_and_cached(self):
+        deduplicator = JobDeduplicator(ttl=0.2)
+        self.assertIsNone(deduplicator.acquire('key', 'job-1'))
+        self.assertEqual(deduplicator.acquire('key', 'job-2'), ('job-1', 'inflight'))
+        deduplicator.finish('key', 'job-1', 'completed', 'site.yml')
+        self.assertEqual(deduplicator.acquire('key', 'job-3'), ('job-1', 'cached'))
+        time.sleep(0.3)
+        self.assertIsNone(deduplicator.acquire('key', 'job-4'))
+        deduplicator.finish('key', 'job-4', 'failed', 'site.yml')
+        self.assertIsNone(deduplicator.acquire('key', 'job-5'))
+
+    def test_playbook_ttls(self):
+        deduplicator = JobDeduplicator(ttl=60, playbook_ttls={'check.yml': 30})
+        self.assertEqual(deduplicator.ttl_for('check.yml'), 30)
+        self.assertIsNone(deduplicator.ttl_for('deploy.yml'))
+
+class TestProcessExecutor(unittest.TestCase):
+    def test_jobs_run_in_reused_worker(self):
+        executor = ProcessExecutor(processes=1, max_jobs_per_process=2)
+        executor.start()
+        try:
+            # start returns once the process has imported ansible_runner
+            self.assertTrue(all(worker.ready for worker in executor._workers))
+            pids = executor.pids()
+            statuses = []
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for i in range(2):
+                    runner_kwargs = {'private_data_dir': str(Path(tmp_dir) / str(i)),
+                                     'playbook': str(Path(__file__).parent / 'test_playbooks' / 'test_playbook.yml')}
+                    result = executor.execute(f'job-{i}', runner_kwargs, lambda stdout, summary: None, statuses.append)
+                    self.assertIn(result['status'], ['successful', 'failed'])
+                    self.assertIn('ansible-playbook', result['command'])
+                    if i == 0:
+                        self.assertEqual(executor.pids(), pids)
+            # recycled after max_jobs_per_process
+            self.assertNotEqual(executor.pids(), pids)
+            self.assertIn('starting', statuses)
+        finally:
+            executor.stop()
+
+class TestCoordination(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp_dir.name) / 'coordination.db'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_slot_leases_are_shared(self):
+        first, second = SlotLeases(self.db_path, slots=2), SlotLeases(self.db_path, slots=2)
+        second.owner = 'other-host:1'
+        self.assertTrue(first.try_acquire('job-1'))
+        self.assertTrue(second.try_acquire('job-2'))
+        self.assertFalse(first.try_acquire('job-3'))
+        self.assertEqual(first.active(), 2)
+        second.release('job-2')
+        self.assertTrue(first.try_acquire('job-3'))
+        self.assertFalse(first.acquire('job-4', cancelled=lambda: True))
+
+    def test_expired_leases_are_freed(self):
+        crashed = SlotLeases(self.db_path, slots=1, ttl=0.1)
+        crashed.try_acquire('job-1')
+        time.sleep(0.2)
+        self.assertTrue(SlotLeases(self.db_path, slots=1).try_acquire('job-2'))
+
+    def test_leader_lock(self):
+        leader, follower = LeaderLock(Path(self.tmp_dir.name) / 'x.lock'), LeaderLock(Path(self.tmp_dir.name) / 'x.lock')
+        self.assertTrue(leader.try_acquire())
+        self.assertFalse(follower.try_acquire())
+        leader.release()
+        self.assertTrue(follower.try_acquire())
+
+    def test_gauge_sampler_sets_gauges_in_multiprocess_mode(self):
+        registry = CollectorRegistry()
+        gauge = Gauge('sampled', 'sampled gauge', registry=registry)
+        values = [3]
+        sampler = GaugeSampler(multiprocess=True)
+        sampler.track(gauge, lambda: values[-1])
+        self.assertEqual(registry.get_sample_value('sampled'), 3)
+        values.append(5)
+        sampler.sample()
+        self.assertEqual(registry.get_sample_value('sampled'), 5)
+
+    def test_scheduler_waits_for_slot(self):
+        leases = SlotLeases(self.db_path, slots=1, poll_interval=0.05)
+        leases.try_acquire('other-job')
+        scheduler = JobScheduler(max_workers=2, slot_gate=leases)
+        done = threading.Event()
+        scheduler.submit('job-1', done.set)
+        scheduler.start()
+        self.assertFalse(done.wait(0.3))
+        leases.release('other-job')
+        self.assertTrue(done.wait(2))
+        scheduler.stop(timeout=1)
+        self.assertEqual(leases.active(), 0)
+
+class TestTimingAggregator(unittest.TestCase):
+    def test_slowest_tasks_and_hosts(self):
+        observed = []
+        timings = TimingAggregator(observer=lambda duration, result: observed.append((duration, result)))
+        events = [
+            ('runner_on_ok', 'web1', 'u1', 'gather', 2.0),
+            ('runner_on_ok', 'web2', 'u1', 'gather', 4.0),
+            ('runner_on_failed', 'web1', 'u2', 'install', 10.0),
+            ('runner_on_skipped', 'web2', 'u2', 'install', 0.5),
+            ('playbook_on_task_start', None, 'u3', 'ignored', None),
+        ]
+        for event, host, task_uuid, task, duration in events:
+            timings.add({'event': event, 'host': host, 'task_uuid': task_uuid, 'task': task, 'play': 'site', 'duration': duration})
+
+        summary = timings.summary()
+        self.assertEqual(summary['critical_path'], 14.0)
+        self.assertEqual((summary['task_count'], summary['host_count']), (2, 2))
+        install, gather = summary['tasks']
+        self.assertEqual((install['task'], install['slowest_host'], install['failed'], install['position']), ('install', 'web1', 1, 1))
+        self.assertEqual((gather['duration'], gather['average'], gather['slowest_host']), (4.0, 3.0, 'web2'))
+        self.assertEqual(summary['hosts'][0], {'host': 'web1', 'duration': 12.0, 'tasks': 2, 'failed': 1})
+        self.assertEqual(len(timings.summary(limit=1)['tasks']), 1)
+        self.assertEqual(observed, [(2.0, 'ok'), (4.0, 'ok'), (10.0, 'failed'), (0.5, 'skipped')])
+
+class TestEventIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.storage_dir = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_event_rows(self):
+        self.assertIsNone(event_row({'event': 'playbook_on_task_start', 'task': 'ping'}))
+        self.assertEqual(event_row({'event': 'runner_on_ok', 'host': 'a', 'changed': True, 'stdout': 'changed: [a]'})['status'], 'changed')
+        row = event_row({'event': 'runner_on_failed', 'host': 'a', 'ignore_errors': True, 'stdout': 'x' * 100}, stdout_limit=10)
+        self.assertEqual((row['status'], row['stdout']), ('ignored', 'x' * 10))
+        self.assertIsNone(event_row({'event': 'runner_on_ok', 'host': 'a', 'stdout': 'ok: [a]'})['stdout'])
+
+    def test_indexer_writes_in_batches(self):
+        storage = SQLiteJobStorage(self.storage_dir)
+        indexer = EventIndexer(storage, 'job-1', batch_size=3, flush_interval=60)
+        for counter in range(1, 6):
+            indexer.add({'event': 'runner_on_ok', 'host': 'a', 'counter': counter})
+        self.assertEqual(len(storage.query_events(job_id='job-1')), 3)
+        indexer.flush()
+        self.assertEqual(indexer.indexed, 5)
+
+    def test_queries(self):
+        for storage in [SQLiteJobStorage(self.storage_dir), JsonJobStorage(self.storage_dir / 'json')]:
+            for day, job_id in enumerate(['job-1', 'job-2', 'job-3'], start=1):
+                storage.save_job(job_id, {'status': 'completed', 'start_time': f'2024-01-0{day}T00:00:00'})
+                storage.save_job_events(job_id, [
+                    {'counter': counter, 'event': 'runner_on_failed' if host == 'web1' else 'runner_on_ok', 'status': 'failed' if host == 'web1' else 'ok',
+                     'host': host, 'task': f'task {counter}', 'created': f'2024-01-0{day}T00:00:{counter:02}', 'stdout': None}
+                    for counter, host in enumerate(['web1', 'web2', 'web1'], start=1)])
+
+            failures = storage.query_events(host='web1', status=['failed'], limit=4)
+            self.assertEqual([(event['job_id'], event['counter']) for event in failures],
+                             [('job-3', 3), ('job-3', 1), ('job-2', 3), ('job-2', 1)])
+            cursor = encode_cursor(failures[-1]['created'], failures[-1]['job_id'], failures[-1]['counter'])
+            self.assertEqual([event['job_id'] for event in storage.query_events(host='web1', cursor=cursor)], ['job-1', 'job-1'])
+            self.assertEqual([event['counter'] for event in storage.query_events(job_id='job-2', after=1)], [2, 3])
+            self.assertEqual(len(storage.query_events(task='task 2', since='2024-01-02')), 2)
+            self.assertTrue(storage.has_job_events('job-1'))
+
+            storage.delete_jobs(['job-1'])
+            self.assertFalse(storage.has_job_events('job-1'))
+            self.assertEqual(len(storage.query_events(host='web2')), 2)
+
+class TestStartup(unittest.TestCase):
+    def test_phases(self):
+        timer = StartupTimer()
+        for phase in ('config', 'storage', 'config'):
+            with timer.phase(phase):
+                time.sleep(0.01)
+        self.assertEqual(list(timer.to_dict()), ['config', 'storage'])
+        self.assertGreaterEqual(timer.phases['config'], 0.02)
+        self.assertAlmostEqual(timer.total(), sum(timer.phases.values()))
+
+    def test_gunicorn_preload(self):
+        self.assertTrue(gunicorn_preload(True))
+        self.assertFalse(gunicorn_preload(False))
+        argv = sys.argv
+        try:
+            sys.argv = ['/venv/bin/gunicorn', '--workers', '4', '--preload', 'wsgi:application']
+            self.assertTrue(gunicorn_preload())
+            sys.argv = ['/venv/bin/gunicorn', 'wsgi:application']
+            self.assertFalse(gunicorn_preload())
+        finally:
+            sys.argv = argv
+
+class TestConfigReload(unittest.TestCase):
+    def test_read_config(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'config.yml'
+            path.write_text("playbook_dir: /etc/ansible\nplaybook_whitelist: ['[a-z]+\\.yml$', '(broken']\n")
+            with self.assertRaises(ConfigError) as raised:
+                read_config(path)
+            self.assertEqual(len(raised.exception.errors), 2)
+
+            path.write_text("playbook_dir: /etc/ansible\ninventory_file: hosts\nplaybook_whitelist: ['[a-z]+\\.yml$']\n")
+            config, whitelist = read_config(path)
+            self.assertEqual(config['inventory_file'], 'hosts')
+            self.assertTrue(whitelist[0].match('site.yml'))
+
+    def test_restart_keys_keep_running_values(self):
+        old = {'port': 5001, 'log_level': 'INFO', 'scheduler': {'max_workers': 4}}
+        new = {'port': 5002, 'log_level': 'DEBUG', 'execution': {'backend': 'process'}}
+        changed = changed_keys(old, new)
+        self.assertEqual(changed, ['execution', 'log_level', 'port', 'scheduler'])
+        self.assertEqual(keep_restart_keys(old, new, changed), ['execution', 'port', 'scheduler'])
+        self.assertEqual(new, {'port': 5001, 'log_level': 'DEBUG', 'scheduler': {'max_workers': 4}})
+
+    def test_watcher_reloads_on_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'config.yml'
+            path.write_text('port: 5001\n')
+            reloads = []
+            watcher = ConfigWatcher(path, lambda: reloads.append(path.read_text()), interval=60)
+            self.assertFalse(watcher.check())
+            path.write_text('port: 5002\n')
+            self.assertTrue(watcher.check())
+            self.assertFalse(watcher.check())
+            self.assertEqual(reloads, ['port: 5002\n'])
+
+    def test_webhook_reconfigure_keeps_unchanged_targets(self):
+        sender = WebhookSender([{'name': 'slack', 'type': 'slack', 'url': 'http://127.0.0.1:1/slack'},
+                                {'name': 'audit', 'url': 'http://127.0.0.1:1/audit'}])
+        slack, audit = sender.targets
+        changed = sender.reconfigure([{'name': 'slack', 'type': 'slack', 'url': 'http://127.0.0.1:1/slack'},
+                                      {'name': 'audit', 'url': 'http://127.0.0.1:1/audit', 'timeout': 1},
+                                      {'name': 'ops', 'url': 'http://127.0.0.1:1/ops'}])
+        self.assertEqual(changed, ['audit', 'ops'])
+        self.assertIs(sender.targets[0], slack)
+        self.assertIsNot(sender.targets[1], audit)
+        self.assertEqual(sender.targets[1].webhook_timeout, 1)
+        self.assertEqual(sender.reconfigure([{'name': 'slack', 'type': 'slack', 'url': 'http://127.0.0.1:1/slack'}]), ['audit', 'ops'])
+        self.assertEqual([target.name for target in sender.targets], ['slack'])
+
+    def test_playbook_index_whitelist_change(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ('site.yml', 'deploy.yml'):
+                (Path(tmp_dir) / name).write_text('- hosts: all\n')
+            index = PlaybookIndex(tmp_dir, [])
+            index.build()
+            self.assertEqual(index.playbooks(), ['deploy.yml', 'site.yml'])
+            index.set_whitelist([re.compile(r'site\.yml$')])
+            self.assertEqual(index.playbooks(), ['site.yml'])
+            self.assertFalse(index.lookup('deploy.yml'))
+
+class StaticLoad:
+    def __init__(self, load=None, memory=None):
+        self.values = (load, memory)
+
+    def sample(self):
+        return self.values
+
+class TestAdmission(unittest.TestCase):
+    def test_fork_budget_downscales_and_delays(self):
+        controller = AdmissionController(load=StaticLoad(), max_forks=10, min_forks=3, poll_interval=0.05)
+        self.assertEqual(controller.acquire('job-1', 'site.yml', 6), (6, 'admitted'))
+        self.assertEqual(controller.acquire('job-2', 'site.yml', 6), (4, 'downscaled'))
+        self.assertEqual(controller.forks_in_use(), 10)
+
+        threading.Timer(0.2, controller.release, args=('job-1',)).start()
+        self.assertEqual(controller.acquire('job-3', 'site.yml', 5), (5, 'delayed'))
+        self.assertEqual(controller.acquire('job-4', 'site.yml', 5, cancelled=lambda: True), (None, 'cancelled'))
+        self.assertEqual(controller.waiting(), 0)
+
+    def test_caps_and_idle_controller(self):
+        controller = AdmissionController(load=StaticLoad(load=8.0, memory=100 * MB), max_forks=50, max_forks_per_job=20,
+                                         playbooks={'db.yml': 2}, max_load=2, min_available_memory=512 * MB)
+        self.assertEqual(controller.capped_forks('site.yml', 200), 20)
+        self.assertEqual(controller.capped_forks('db.yml', 200), 2)
+        # overloaded, but nothing runs here: the first job starts anyway, the next one waits
+        self.assertEqual(controller.acquire('job-1', 'site.yml', 10), (10, 'admitted'))
+        self.assertEqual(controller.acquire('job-2', 'site.yml', 10, cancelled=lambda: True), (None, 'cancelled'))
+        controller.release('job-1')
+
+        controller.configure(memory_per_fork=64 * MB, min_available_memory=0, min_forks=1)
+        controller.load = StaticLoad(memory=256 * MB)
+        self.assertEqual(controller.acquire('job-3', 'site.yml', 10), (4, 'downscaled'))
+
+    def test_controller_load_from_proc(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            (Path(tmp_dir) / 'loadavg').write_text('3.00 2.00 1.00 2/300 4242\n')
+            (Path(tmp_dir) / 'meminfo').write_text('MemTotal: 8000000 kB\nMemFree: 100000 kB\nMemAvailable: 2048000 kB\n')
+            load = ControllerLoad(tmp_dir)
+            load.cpus = 2
+            self.assertEqual(load.sample(), (1.5, 2048000 * 1024))
+            self.assertEqual(ControllerLoad(Path(tmp_dir) / 'missing').sample(), (None, None))
+
+class TestSharding(unittest.TestCase):
+    def test_partition_hosts(self):
+        hosts = [f'web{i}' for i in range(10)]
+        self.assertEqual([len(part) for part in partition_hosts(hosts, 3)], [4, 3, 3])
+        self.assertEqual(sum(partition_hosts(hosts, 3), []), hosts)
+        self.assertEqual(partition_hosts(hosts[:2], 5), [['web0'], ['web1']])
+        self.assertEqual(partition_hosts([], 4), [])
+
+    def test_merge_stats_and_status(self):
+        stats = merge_stats([{'ok': {'web1': 3}, 'failures': {}}, {'ok': {'web2': 2}, 'failures': {'web2': 1}}, None])
+        self.assertEqual(stats, {'ok': {'web1': 3, 'web2': 2}, 'failures': {'web2': 1}})
+        self.assertEqual(combined_status(['completed', 'completed']), 'completed')
+        self.assertEqual(combined_status(['completed', 'failed', 'cancelled']), 'failed')
+        self.assertEqual(combined_status(['cancelled', 'timed_out']), 'timed_out')
+
+class TestBenchmark(unittest.TestCase):
+    def test_fixture_is_built_once(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fixture = build_fixture(tmp_dir, 50, output_size=1024)
+            self.assertEqual(len(fixture['sample']), 50)
+            storage = SQLiteJobStorage(Path(tmp_dir))
+            self.assertEqual(len(storage.list_jobs()), 50)
+            self.assertGreater(storage.output_size(fixture['sample'][0]), 0)
+            self.assertEqual(build_fixture(tmp_dir, 50, output_size=1024)['sample'], fixture['sample'])
+
+    def test_fake_executor_and_percentile(self):
+        events = []
+        result = FakeExecutor(events=10, event_size=5).execute('job-1', {'playbook': 'bench.yml'}, lambda stdout, summary: events.append(stdout), lambda status: None)
+        self.assertEqual(result['status'], 'successful')
+        self.assertEqual(events, ['xxxxx'] * 10)
+        self.assertEqual(percentile(list(range(1, 101)), 0.99), 99)
+        self.assertEqual(percentile(list(range(1, 101)), 0.5), 50)
+
+class TestCancelToken(unittest.TestCase):
+    def test_cancel_reasons(self):
+        token = CancelToken()
+        self.assertFalse(token())
+        token.cancel()
+        token.cancel('timed_out')
+        self.assertTrue(token())
+        self.assertEqual(token.reason, 'cancelled')
+
+        token = CancelToken(timeout=0.05)
+        time.sleep(0.1)
+        self.assertTrue(token())
+        self.assertEqual(token.reason, 'timed_out')
+
+        checks = []
+        token = CancelToken(check=lambda: checks.append(1) or len(checks) > 1, check_interval=0)
+        self.assertFalse(token())
+        self.assertTrue(token())
+        self.assertEqual(token.reason, 'cancelled')
+
+class TestJobScheduler(unittest.TestCase):
+    def test_cancel_queued_job(self):
+        scheduler = JobScheduler(max_workers=1, max_queue=2)
+        scheduler.submit('job-1', lambda: None)
+        scheduler.submit_many([('job-2', lambda: None, (), 'normal')], group='batch')
+        self.assertTrue(scheduler.cancel('job-2'))
+        self.assertFalse(scheduler.cancel('job-2'))
+        self.assertEqual(scheduler.queue_depth(), 1)
+        self.assertEqual(scheduler._group_pending, {})
+
+    def test_queue_full(self):
+        scheduler = JobScheduler(max_workers=1, max_queue=1)
+        scheduler.submit('job-1', lambda: None)
+        with self.assertRaises(SchedulerFull):
+            scheduler.submit('job-2', lambda: None)
+        self.assertEqual(scheduler.queue_depth(), 1)
+
+    def test_priority_order(self):
+        scheduler = JobScheduler(max_workers=1, max_queue=10)
+        order = []
+        done = threading.Event()
+        scheduler.submit('low', order.append, args=('low',), priority='low')
+        scheduler.submit('normal', order.append, args=('normal',))
+        scheduler.submit('high', order.append, args=('high',), priority='high')
+        scheduler.submit('last', lambda: done.set(), priority='low')
+        scheduler.start()
+        self.assertTrue(done.wait(5))
+        scheduler.stop(timeout=1)
+        self.assertEqual(order, ['high', 'normal', 'low'])
+
+    def test_submit_many_is_atomic(self):
+        scheduler = JobScheduler(max_workers=1, max_queue=3)
+        scheduler.submit('job-1', lambda: None)
+        with self.assertRaises(SchedulerFull):
+            scheduler.submit_many([(f'batch-{i}', lambda: None, (), 'normal') for i in range(3)], group='batch')
+        self.assertEqual(scheduler.queue_depth(), 1)
+        self.assertEqual(scheduler.free_slots(), 2)
+
+    def test_group_limit_and_cancel(self):
+        scheduler = JobScheduler(max_workers=3, max_queue=10)
+        running, peak = [], []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def job(name):
+            with lock:
+                running.append(name)
+                peak.append(len(running))
+            release.wait(5)
+            with lock:
+                running.remove(name)
+
+        scheduler.submit_many([(f'job-{i}', job, (f'job-{i}',), 'normal') for i in range(4)], group='batch', max_parallel=2)
+        scheduler.start()
+        time.sleep(0.3)
+        self.assertEqual(len(running), 2)
+        self.assertEqual(scheduler.queue_depth(), 2)
+        self.assertEqual(scheduler.cancel_group('batch'), ['job-2', 'job-3'])
+        release.set()
+        time.sleep(0.3)
+        scheduler.stop(timeout=1)
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(scheduler.queue_depth(), 0)
+
+    def test_invalid_priority(self):
+        scheduler = JobScheduler()
+        with self.assertRaises(ValueError):
+            scheduler.submit('job-1', lambda: None, priority='urgent')
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+ANSIBLE-LINK class for task and host timings
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import threading
+
+# per host results of a task, ansible-runner adds the task duration on the host to each of them
+HOST_RESULT_EVENTS = {
+    'runner_on_ok': 'ok',
+    'runner_on_failed': 'failed',
+    'runner_on_skipped': 'skipped',
+    'runner_on_unreachable': 'unreachable',
+}
+
+class TaskTiming:
+    __slots__ = ('task', 'play', 'role', 'order', 'duration', 'total', 'hosts', 'failed', 'slowest_host')
+
+    def __init__(self, task, play, role, order):
+        self.task = task
+        self.play = play
+        self.role = role
+        self.order = order
+        self.duration = 0.0   # slowest host, what the task adds to the run with the linear strategy
+        self.total = 0.0
+        self.hosts = 0
+        self.failed = 0
+        self.slowest_host = None
+
+class HostTiming:
+    __slots__ = ('duration', 'tasks', 'failed')
+
+    def __init__(self):
+        self.duration = 0.0
+        self.tasks = 0
+        self.failed = 0
+
+class TimingAggregator:
+    """folds runner events into per task and per host totals, memory grows with tasks and hosts, not with events"""
+
+    def __init__(self, observer=None):
+        self.observer = observer
+        self._tasks = {}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def add(self, summary):
+        result = HOST_RESULT_EVENTS.get(summary.get('event'))
+        duration = summary.get('duration')
+        if result is None or duration is None or not summary.get('host'):
+            return
+
+        key = summary.get('task_uuid') or (summary.get('play'), summary.get('task'))
+        with self._lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = TaskTiming(summary.get('task'), summary.get('play'), summary.get('role'), len(self._tasks))
+            task.total += duration
+            task.hosts += 1
+            if duration >= task.duration:
+                task.duration = duration
+                task.slowest_host = summary['host']
+
+            host = self._hosts.get(summary['host'])
+            if host is None:
+                host = self._hosts[summary['host']] = HostTiming()
+            host.duration += duration
+            host.tasks += 1
+            if result in ('failed', 'unreachable'):
+                task.failed += 1
+                host.failed += 1
+
+        if self.observer:
+            self.observer(duration, result)
+
+    def summary(self, limit=None):
+        """tasks ordered by their share of the run (the critical path first) and hosts by the time spent on them"""
+        with self._lock:
+            tasks = sorted(self._tasks.values(), key=lambda task: task.duration, reverse=True)
+            hosts = sorted(self._hosts.items(), key=lambda item: item[1].duration, reverse=True)
+            critical_path = sum(task.duration for task in tasks)
+
+        return {
+            'critical_path': round(critical_path, 3),
+            'task_count': len(tasks),
+            'host_count': len(hosts),
+            'tasks': [{
+                'task': task.task,
+                'play': task.play,
+                'role': task.role,
+                'position': task.order,
+                'duration': round(task.duration, 3),
+                'share': round(task.duration / critical_path, 4) if critical_path else 0,
+                'slowest_host': task.slowest_host,
+                'average': round(task.total / task.hosts, 3),
+                'hosts': task.hosts,
+                'failed': task.failed,
+            } for task in tasks[:limit]],
+            'hosts': [{
+                'host': name,
+                'duration': round(host.duration, 3),
+                'tasks': host.tasks,
+                'failed': host.failed,
+            } for name, host in hosts[:limit]],
+        }
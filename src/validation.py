@@ -0,0 +1,254 @@
+"""
+ANSIBLE-LINK class for request validation
+Info: github.com/lfkdev/ansible-link
+Author: l.klostermann@pm.me
+License: MPL2
+"""
+
+import os
+import re
+import copy
+import time
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+from playbook_index import PLAYBOOK_SUFFIXES
+from inventory import InventoryError
+from scheduler import PRIORITIES
+
+logger = logging.getLogger(__name__)
+
+TAG_PATTERN = re.compile(r'^[a-zA-Z0-9_]+$')
+
+@dataclass(frozen=True)
+class PlaybookRequest:
+    playbook: str
+    playbook_path: str
+    inventory_path: str
+    vars: dict
+    forks: int = 5
+    verbosity: int = 0
+    limit: Optional[str] = None
+    tags: Optional[str] = None
+    skip_tags: Optional[str] = None
+    cmdline: Optional[str] = None
+    priority: str = 'normal'
+    timeout: Optional[int] = None
+    shards: Optional[int] = None
+
+    def to_dict(self):
+        return asdict(self)
+
+@dataclass(frozen=True)
+class BatchRequest:
+    jobs: tuple
+    max_parallel: Optional[int] = None
+    stop_on_failure: bool = False
+
+# batch options, everything else in a single-spec batch is the shared job spec
+BATCH_OPTIONS = ('jobs', 'max_parallel', 'stop_on_failure')
+
+class StatCache:
+    """short lived cache of is_file() results, bursts of requests for the same inventory stat it once"""
+
+    def __init__(self, ttl=5, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_file(self, path):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached and cached[1] > now:
+                self._cache.move_to_end(path)
+                return cached[0]
+        result = Path(path).is_file()
+        with self._lock:
+            self._cache[path] = (result, now + self.ttl)
+            self._cache.move_to_end(path)
+            # the paths come from requests, least recently used ones make room
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return result
+
+def _check_type(expected, message):
+    def check(value):
+        return [] if isinstance(value, expected) else [message]
+    return check
+
+def _check_int(name, valid, message):
+    def check(value):
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            return [f"'{name}' must be an integer"]
+        return [] if valid(number) else [message]
+    return check
+
+def _check_tags(name):
+    def check(value):
+        if not isinstance(value, str):
+            return [f"'{name}' must be a comma-separated string"]
+        return [f"Invalid tag in '{name}': {tag}" for tag in value.split(',') if not TAG_PATTERN.match(tag.strip())]
+    return check
+
+# field -> check, run in this order for every field present in the request
+FIELD_CHECKS = (
+    ('vars', _check_type(dict, "'vars' must be a dictionary")),
+    ('forks', _check_int('forks', lambda forks: forks >= 1, "'forks' must be a positive integer")),
+    ('verbosity', _check_int('verbosity', lambda verbosity: verbosity in range(5), "'verbosity' must be an integer between 0 and 4")),
+    ('limit', _check_type(str, "'limit' must be a string")),
+    ('tags', _check_tags('tags')),
+    ('skip_tags', _check_tags('skip_tags')),
+    ('cmdline', _check_type(str, "'cmdline' must be a string")),
+    ('priority', lambda value: [] if isinstance(value, str) and value in PRIORITIES else [f"'priority' must be one of: {', '.join(PRIORITIES)}"]),
+    ('timeout', _check_int('timeout', lambda timeout: timeout >= 0, "'timeout' must be a non-negative integer (seconds)")),
+)
+
+class PlaybookRequestValidator:
+    """built once per configuration, validates a POST /playbook payload in a single pass without modifying it"""
+
+    def __init__(self, config, playbook_index, inventory_cache, stat_ttl=5):
+        self.playbook_dir = Path(config['playbook_dir'])
+        self.default_inventory = Path(config['inventory_file'])
+        self.inventory_dir = Path(os.path.normpath(self.default_inventory.parent))
+        self.validate_limit = config.get('inventory_cache', {}).get('validate_limit', True)
+        self.timeouts = config.get('timeouts', {})
+        self.max_shards = config.get('sharding', {}).get('max_shards', 16)
+        self.playbook_index = playbook_index
+        self.inventory_cache = inventory_cache
+        self.stat_cache = StatCache(stat_ttl)
+
+    def resolve_inventory_path(self, inventory=None):
+        """the configured inventory or a file next to it, None for anything outside its directory"""
+        if inventory is None:
+            return self.default_inventory
+        if not isinstance(inventory, str) or not inventory:
+            return None
+        # ansible-inventory runs executable inventories, a request must not pick an arbitrary file
+        inventory_path = Path(os.path.normpath(self.inventory_dir / inventory))
+        if os.path.commonpath([str(inventory_path), str(self.inventory_dir)]) != str(self.inventory_dir):
+            return None
+        return inventory_path
+
+    def validate_playbook(self, playbook):
+        playbook_path = self.playbook_dir / playbook
+        whitelisted = self.playbook_index.lookup(playbook)
+        if whitelisted is None:
+            raise ValueError(f"Playbook {playbook_path} not found")
+        if playbook_path.suffix not in PLAYBOOK_SUFFIXES:
+            raise ValueError(f"Invalid playbook file type: {playbook}")
+        if not whitelisted:
+            raise ValueError(f"Playbook {playbook} is not in the whitelist")
+        return str(playbook_path)
+
+    def timeout_for(self, playbook, timeout=None):
+        """seconds the job may run, the request's own timeout before the playbook's and the default, None for no limit"""
+        if timeout is None:
+            timeout = (self.timeouts.get('playbooks') or {}).get(playbook, self.timeouts.get('default', 0))
+        return int(timeout) or None
+
+    def validate(self, data):
+        """returns (PlaybookRequest, []) or (None, errors)"""
+        if not isinstance(data, dict):
+            return None, ["Request body must be a JSON object"]
+
+        errors = []
+        playbook_path = None
+        if not isinstance(data.get('playbook'), str) or not data['playbook']:
+            errors.append("'playbook' is required")
+        else:
+            try:
+                playbook_path = self.validate_playbook(data['playbook'])
+            except ValueError as e:
+                errors.append(str(e))
+
+        inventory_path = self.resolve_inventory_path(data.get('inventory'))
+        inventory_found = inventory_path is not None and self.stat_cache.is_file(str(inventory_path))
+        if inventory_path is None:
+            errors.append(f"Inventory must be a file in {self.inventory_dir}: {data.get('inventory')}")
+        elif not inventory_found:
+            errors.append(f"Inventory file not found: {inventory_path}")
+
+        for field, check in FIELD_CHECKS:
+            if field in data:
+                errors.extend(check(data[field]))
+        if data.get('shards') is not None:
+            errors.extend(_check_int('shards', lambda shards: 1 <= shards <= self.max_shards,
+                                     f"'shards' must be an integer between 1 and {self.max_shards}")(data['shards']))
+
+        limit = data.get('limit')
+        if limit and isinstance(limit, str) and inventory_found and self.validate_limit:
+            try:
+                if not self.inventory_cache.resolve(inventory_path, limit):
+                    errors.append(f"'limit' does not match any hosts in {inventory_path}: {limit}")
+            except InventoryError as e:
+                logger.debug(f"Skipping limit validation: {str(e)}")
+            except re.error as e:
+                errors.append(f"'limit' is not a valid host pattern: {str(e)}")
+
+        if errors:
+            return None, errors
+
+        return PlaybookRequest(
+            playbook=data['playbook'],
+            playbook_path=playbook_path,
+            inventory_path=str(inventory_path),
+            vars=copy.deepcopy(data.get('vars', {})),
+            forks=int(data.get('forks', 5)),
+            verbosity=int(data.get('verbosity', 0)),
+            limit=limit,
+            tags=data.get('tags'),
+            skip_tags=data.get('skip_tags'),
+            cmdline=data.get('cmdline'),
+            priority=data.get('priority', 'normal'),
+            timeout=self.timeout_for(data['playbook'], data.get('timeout')),
+            shards=int(data['shards']) if data.get('shards') is not None else None,
+        ), []
+
+    def validate_batch(self, data, max_jobs=100):
+        """returns (BatchRequest, []) or (None, errors) for a list of 'jobs' or one spec with a list of 'limit' values"""
+        if not isinstance(data, dict):
+            return None, ["Request body must be a JSON object"]
+
+        errors = []
+        if 'jobs' in data:
+            specs = data['jobs'] if isinstance(data['jobs'], list) else []
+            labels = [f"jobs[{i}]" for i in range(len(specs))]
+        else:
+            spec = {key: value for key, value in data.items() if key not in BATCH_OPTIONS}
+            limits = spec.get('limit') if isinstance(spec.get('limit'), list) else []
+            specs = [dict(spec, limit=limit) for limit in limits]
+            labels = [f"limit[{i}]" for i in range(len(specs))]
+        if not specs:
+            errors.append("'jobs' or a list of 'limit' values is required")
+        elif len(specs) > max_jobs:
+            errors.append(f"A batch can have at most {max_jobs} jobs, got {len(specs)}")
+
+        max_parallel = data.get('max_parallel')
+        if max_parallel is not None and (not isinstance(max_parallel, int) or isinstance(max_parallel, bool) or max_parallel < 1):
+            errors.append("'max_parallel' must be a positive integer")
+        stop_on_failure = data.get('stop_on_failure', False)
+        if not isinstance(stop_on_failure, bool):
+            errors.append("'stop_on_failure' must be a boolean")
+        if errors:
+            return None, errors
+
+        playbook_requests = []
+        for label, spec in zip(labels, specs):
+            if spec.get('shards') is not None:
+                errors.append(f"{label}: 'shards' is not supported in a batch")
+                continue
+            playbook_request, spec_errors = self.validate(spec)
+            errors.extend(f"{label}: {error}" for error in spec_errors)
+            playbook_requests.append(playbook_request)
+        if errors:
+            return None, errors
+
+        return BatchRequest(tuple(playbook_requests), max_parallel, stop_on_failure), []
@@ -5,80 +5,458 @@ Author: l.klostermann@pm.me
 License: MPL2
 """
 
-import requests
-from datetime import datetime
+import os
+import json
+import time
+import fcntl
+import uuid
+import queue
+import random
 import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+
+from collections import namedtuple
+
+from coordination import NullMetric
 
 logger = logging.getLogger(__name__)
 
-class WebhookSender:
-    def __init__(self, config):
+# the delivery metrics labelled by target, created by init_app
+WebhookMetrics = namedtuple('WebhookMetrics', ['delivery_latency', 'failures', 'dropped', 'queue_depth'])
+NO_METRICS = WebhookMetrics(NullMetric(), NullMetric(), NullMetric(), NullMetric())
+
+# discord rejects messages with more than 10 embeds
+MAX_BATCH_SIZE = {'discord': 10}
+
+EVENT_TYPES = ('job_started', 'job_completed', 'job_error', 'job_cancelled', 'job_timed_out')
+# client errors worth another attempt, any other 4xx means the request itself is rejected
+RETRIED_CLIENT_ERRORS = (408, 429)
+
+def format_payload(webhook_type, event_type, job_data, timestamp=None):
+    timestamp = timestamp or datetime.now()
+    base_payload = {
+        "event_type": event_type,
+        "job_id": job_data['job_id'],
+        "playbook": job_data['playbook'],
+        "status": job_data['status'],
+        "timestamp": timestamp.isoformat()
+    }
+
+    if 'error' in job_data:
+        base_payload['error'] = job_data['error']
+
+    if webhook_type == 'slack':
+        color = "#36a64f" if job_data['status'] in ['completed', 'started'] else "#ff0000"
+        fields = [
+            {"title": "Status", "value": job_data['status'], "short": True},
+        ]
+        if 'error' in job_data:
+            fields.append({"title": "Error", "value": job_data['error'], "short": False})
+
+        return {
+            "attachments": [{
+                "color": color,
+                "title": job_data['playbook'],
+                "text": f"Event: {event_type.replace('_', ' ').title()}",
+                "fields": fields,
+                "footer": f"Ansible-Link | {job_data['job_id']}",
+                "ts": int(timestamp.timestamp())
+            }]
+        }
+    elif webhook_type == 'discord':
+        color = 0x36a64f if job_data['status'] in ['completed', 'started'] else 0xff0000
+        fields = [
+            {"name": "Status", "value": job_data['status'], "inline": True},
+            {"name": "Job ID", "value": job_data['job_id'], "inline": True},
+            {"name": "Event", "value": event_type.replace('_', ' ').title(), "inline": False}
+        ]
+        if 'error' in job_data:
+            fields.append({"name": "Error", "value": job_data['error'], "inline": False})
+
+        return {
+            "embeds": [{
+                "title": job_data['playbook'],
+                "color": color,
+                "fields": fields,
+                "footer": {"text": "Ansible-Link"},
+                "timestamp": timestamp.isoformat()
+            }]
+        }
+    else:  # generic webhook
+        return base_payload
+
+def format_batch(webhook_type, payloads):
+    if len(payloads) == 1:
+        return payloads[0]
+    if webhook_type == 'slack':
+        return {"attachments": [attachment for payload in payloads for attachment in payload['attachments']]}
+    if webhook_type == 'discord':
+        return {"embeds": [embed for payload in payloads for embed in payload['embeds']]}
+    return {"events": payloads}
+
+class WebhookEvent:
+    __slots__ = ('event_type', 'job_id', 'payload', 'queued_at', 'spool_path')
+
+    def __init__(self, event_type, job_id, payload, spool_path=None):
+        self.event_type = event_type
+        self.job_id = job_id
+        self.payload = payload
+        self.queued_at = time.monotonic()
+        self.spool_path = spool_path
+
+class WebhookTarget:
+    """one webhook endpoint with its own queue and delivery thread, a slow target never holds up the others"""
+
+    def __init__(self, config, spool_dir=None, metrics=NO_METRICS):
+        self.metrics = metrics
         self.webhook_url = config.get('url')
         self.webhook_type = config.get('type', 'generic').lower()
+        self.name = config.get('name', self.webhook_type)
+        self.events = set(config.get('events') or EVENT_TYPES)
         self.webhook_timeout = config.get('timeout', 5)
+        self.retries = config.get('retries', 5)
+        self.backoff = config.get('backoff', 1)
+        self.max_backoff = config.get('max_backoff', 60)
+        self.batch_window = config.get('batch_window', 0)
+        self.spool_interval = config.get('spool_interval', 60)
+        self.spool_max_age = config.get('spool_max_age', 86400)
+        self.spool_max_events = config.get('spool_max_events', 10000)
+        self.batch_size = min(config.get('batch_size', 10), MAX_BATCH_SIZE.get(self.webhook_type, 100))
+        self.config = config
+        # every sender spools into its own locked subdirectory, several processes can share the spool root
+        self.spool_root = Path(spool_dir) if spool_dir else None
+        self.spool_dir = None
+        self._spool_lock = None
+        if self.spool_root:
+            self.spool_dir = self.spool_root / f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self.spool_dir.mkdir(parents=True, exist_ok=True)
+            self._spool_lock = open(self.spool_dir / '.lock', 'w')
+            try:
+                fcntl.flock(self._spool_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._spool_lock.close()
+                raise
 
-    def format_payload(self, event_type, job_data):
-        base_payload = {
-            "event_type": event_type,
-            "job_id": job_data['job_id'],
-            "playbook": job_data['playbook'],
-            "status": job_data['status'],
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        if 'error' in job_data:
-            base_payload['error'] = job_data['error']
-
-        if self.webhook_type == 'slack':
-            color = "#36a64f" if job_data['status'] in ['completed', 'started'] else "#ff0000"
-            fields = [
-                {"title": "Status", "value": job_data['status'], "short": True},
-            ]
-            if 'error' in job_data:
-                fields.append({"title": "Error", "value": job_data['error'], "short": False})
-            
-            return {
-                "attachments": [{
-                    "color": color,
-                    "title": job_data['playbook'],
-                    "text": f"Event: {event_type.replace('_', ' ').title()}",
-                    "fields": fields,
-                    "footer": f"Ansible-Link | {job_data['job_id']}",
-                    "ts": int(datetime.now().timestamp())
-                }]
-            }
-        elif self.webhook_type == 'discord':
-            color = 0x36a64f if job_data['status'] in ['completed', 'started'] else 0xff0000
-            fields = [
-                {"name": "Status", "value": job_data['status'], "inline": True},
-                {"name": "Job ID", "value": job_data['job_id'], "inline": True},
-                {"name": "Event", "value": event_type.replace('_', ' ').title(), "inline": False}
-            ]
-            if 'error' in job_data:
-                fields.append({"name": "Error", "value": job_data['error'], "inline": False})
-            
-            return {
-                "embeds": [{
-                    "title": job_data['playbook'],
-                    "color": color,
-                    "fields": fields,
-                    "footer": {"text": "Ansible-Link"},
-                    "timestamp": datetime.now().isoformat()
-                }]
-            }
-        else:  # generic webhook
-            return base_payload
+        self._queue = queue.Queue(maxsize=config.get('queue_size', 1000))
+        self._queued_spool_paths = set()
+        # a spool rescan must not queue an event that enqueue is about to queue
+        self._spool_mutex = threading.Lock()
+        self._worker = None
+        self._stopped = threading.Event()
 
-    def send(self, event_type, job_data):
-        if not self.webhook_url:
-            logger.info("Webhook URL not configured, skipping webhook")
+        self.session = None
+
+        self._update_queue_depth()
+
+    def accepts(self, event_type):
+        return event_type in self.events
+
+    def start(self):
+        if self._worker is not None:
             return
+        if self.spool_dir:
+            self._load_spool()
+        self._worker = threading.Thread(target=self._deliver_loop, name=f'ansible-link-webhook-{self.name}', daemon=True)
+        self._worker.start()
 
-        payload = self.format_payload(event_type, job_data)
+    def stop(self, timeout=None):
+        self._stopped.set()
+        worker, self._worker = self._worker, None
+        if worker:
+            worker.join(timeout)
+        if worker is None or not worker.is_alive():
+            self._release_spool()
+        # otherwise the worker is still delivering, it releases the spool when it exits
 
+    def _release_spool(self):
+        # undelivered events stay on disk for the next sender to adopt
+        with self._spool_mutex:
+            if self._spool_lock:
+                self._spool_lock.close()
+                self._spool_lock = None
+
+    def enqueue(self, event_type, job_id, payload):
+        event = WebhookEvent(event_type, job_id, payload)
+        with self._spool_mutex:
+            # write-ahead to disk so the event survives a restart until it was delivered
+            event.spool_path = self._spool(event)
+            try:
+                self._queue.put_nowait(event)
+                if event.spool_path:
+                    self._queued_spool_paths.add(event.spool_path)
+                self._update_queue_depth()
+            except queue.Full:
+                logger.error(f"Webhook queue of {self.name} full, event {event_type} for job {job_id} " +
+                             ("kept in spool until the queue has room" if event.spool_path else "dropped"))
+                if not event.spool_path:
+                    self.metrics.dropped.labels(target=self.name).inc()
+
+    def _deliver_loop(self):
         try:
-            response = requests.post(self.webhook_url, json=payload, timeout=self.webhook_timeout)
-            response.raise_for_status()
-            logger.info(f"Webhook sent successfully for job {job_data['job_id']}")
-        except requests.RequestException as e:
-            logger.error(f"Failed to send webhook for job {job_data['job_id']}: {str(e)}")
\ No newline at end of file
+            self._deliver_events()
+        finally:
+            self._release_spool()
+
+    def _deliver_events(self):
+        # events that did not fit into the queue or failed all retries are picked up again from the spool
+        next_scan = time.monotonic() + self.spool_interval
+        while not self._stopped.is_set():
+            if self.spool_dir and self.spool_interval and time.monotonic() >= next_scan:
+                self._load_spool()
+                next_scan = time.monotonic() + self.spool_interval
+            try:
+                batch = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+
+            # coalesce a burst of events into one request
+            if self.batch_window:
+                deadline = time.monotonic() + self.batch_window
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+
+            self._update_queue_depth()
+            self._deliver(batch)
+
+    def _update_queue_depth(self):
+        # set on every change, set_function gauges are not exported in prometheus multiprocess mode
+        self.metrics.queue_depth.labels(target=self.name).set(self._queue.qsize())
+
+    def _create_session(self):
+        # requests is imported with the first delivery, not at startup
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # one pooled keep-alive connection per target instead of a new TCP/TLS handshake per event
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        return session
+
+    def _deliver(self, batch):
+        import requests
+        if self.session is None:
+            self.session = self._create_session()
+        payload = format_batch(self.webhook_type, [event.payload for event in batch])
+        job_ids = ', '.join(event.job_id for event in batch)
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.webhook_url, json=payload, timeout=self.webhook_timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                self.metrics.failures.labels(target=self.name).inc()
+                logger.error(f"Failed to send webhook {self.name} for job {job_ids} (attempt {attempt + 1}/{self.retries + 1}): {str(e)}")
+                status = e.response.status_code if e.response is not None else None
+                if status is not None and 400 <= status < 500 and status not in RETRIED_CLIENT_ERRORS:
+                    # a wrong url or payload, sending it again does not help
+                    self._drop(batch, f"rejected with status {status}")
+                    return False
+                if attempt < self.retries and not self._stopped.wait(self._backoff_delay(attempt)):
+                    continue
+                if not self.spool_dir:
+                    self._drop(batch, "all retries failed")
+                    return False
+                # retried with the next spool scan, until the event expires there
+                for event in batch:
+                    self._queued_spool_paths.discard(event.spool_path)
+                logger.error(f"Giving up on webhook {self.name} for job {job_ids} for now, retried from the spool in {self.spool_interval}s")
+                return False
+
+            now = time.monotonic()
+            for event in batch:
+                self.metrics.delivery_latency.labels(target=self.name).observe(now - event.queued_at)
+                self._unspool(event)
+            logger.info(f"Webhook {self.name} sent successfully for job {job_ids}")
+            return True
+
+    def _drop(self, batch, reason):
+        self.metrics.dropped.labels(target=self.name).inc(len(batch))
+        for event in batch:
+            self._unspool(event)
+        logger.error(f"Dropped webhook {self.name} for job {', '.join(event.job_id for event in batch)}: {reason}")
+
+    def _backoff_delay(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _spool(self, event):
+        if not self.spool_dir:
+            return None
+        spool_path = self.spool_dir / f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex}.json"
+        try:
+            with open(spool_path, 'w') as f:
+                json.dump({'event_type': event.event_type, 'job_id': event.job_id, 'payload': event.payload}, f)
+        except OSError as e:
+            logger.error(f"Failed to spool webhook event for job {event.job_id}: {str(e)}")
+            return None
+        return spool_path
+
+    def _unspool(self, event):
+        if event.spool_path:
+            self._queued_spool_paths.discard(event.spool_path)
+            try:
+                event.spool_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _adopt_spools(self):
+        # take over the spool of senders that are gone, their lock is free then
+        adopted = 0
+        for entry in list(self.spool_root.iterdir()):
+            if entry == self.spool_dir:
+                continue
+            if entry.is_file() and entry.suffix == '.json':
+                entry.rename(self.spool_dir / entry.name)
+                adopted += 1
+                continue
+            if not entry.is_dir():
+                continue
+            try:
+                with open(entry / '.lock', 'r+') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    for spool_path in entry.glob('*.json'):
+                        spool_path.rename(self.spool_dir / spool_path.name)
+                        adopted += 1
+                    (entry / '.lock').unlink()
+                entry.rmdir()
+            except OSError:
+                continue
+        if adopted:
+            logger.info(f"Adopted {adopted} webhook events of {self.name} from stopped senders")
+
+    def _expire_spool(self):
+        """drops spooled events older than spool_max_age and the oldest ones beyond spool_max_events"""
+        # file names start with the spool time, sorted oldest first. events in the queue are left to the delivery
+        spool_paths = [path for path in sorted(self.spool_dir.glob('*.json')) if path not in self._queued_spool_paths]
+        expired = []
+        if self.spool_max_events and len(spool_paths) > self.spool_max_events:
+            expired = spool_paths[:len(spool_paths) - self.spool_max_events]
+            spool_paths = spool_paths[len(expired):]
+        if self.spool_max_age:
+            cutoff = time.time() - self.spool_max_age
+            for spool_path in spool_paths:
+                try:
+                    if spool_path.stat().st_mtime < cutoff:
+                        expired.append(spool_path)
+                except FileNotFoundError:
+                    pass
+        for spool_path in expired:
+            try:
+                spool_path.unlink()
+            except FileNotFoundError:
+                pass
+        if expired:
+            self.metrics.dropped.labels(target=self.name).inc(len(expired))
+            logger.error(f"Dropped {len(expired)} undelivered webhook events of {self.name} from the spool "
+                         f"(older than {self.spool_max_age}s or beyond {self.spool_max_events} events)")
+
+    def _load_spool(self):
+        self._adopt_spools()
+        loaded = 0
+        with self._spool_mutex:
+            self._expire_spool()
+            for spool_path in sorted(self.spool_dir.glob('*.json')):
+                if spool_path in self._queued_spool_paths:
+                    continue
+                try:
+                    with open(spool_path, 'r') as f:
+                        spooled = json.load(f)
+                    self._queue.put_nowait(WebhookEvent(spooled['event_type'], spooled['job_id'], spooled['payload'], spool_path))
+                    self._queued_spool_paths.add(spool_path)
+                except queue.Full:
+                    break
+                except (OSError, ValueError, KeyError) as e:
+                    logger.error(f"Skipping unreadable webhook spool file {spool_path}: {str(e)}")
+                    continue
+                loaded += 1
+            self._update_queue_depth()
+        if loaded:
+            logger.info(f"Loaded {loaded} undelivered webhook events for {self.name} from {self.spool_dir}")
+
+def target_configs(targets):
+    """the configs of all usable targets, each with a unique name"""
+    # a single mapping is the old 'webhook:' config with one target
+    if isinstance(targets, dict):
+        targets = [targets] if targets.get('url') else []
+
+    configs = []
+    names = set()
+    for target_config in targets:
+        if not target_config.get('url'):
+            logger.warning(f"Skipping webhook target without url: {target_config}")
+            continue
+        name = target_config.get('name', target_config.get('type', 'generic').lower())
+        if name in names:
+            name = f"{name}-{len(configs)}"
+        names.add(name)
+        configs.append(dict(target_config, name=name))
+    return configs
+
+class WebhookSender:
+    def __init__(self, targets, spool_dir=None, metrics=NO_METRICS):
+        self.spool_dir = spool_dir
+        self.metrics = metrics
+        self.targets = [self._create_target(target_config) for target_config in target_configs(targets)]
+        self._started = False
+
+    def start(self):
+        self._started = True
+        for target in self.targets:
+            target.start()
+
+    def stop(self, timeout=None):
+        self._started = False
+        for target in self.targets:
+            target.stop(timeout)
+
+    def reconfigure(self, targets, timeout=5):
+        """applies a new target list, unchanged targets keep their queue and thread, returns the names of changed ones"""
+        current = {target.name: target for target in self.targets}
+        configs = target_configs(targets)
+        kept = [current[config['name']] for config in configs
+                if config['name'] in current and current[config['name']].config == config]
+        replaced = [target for target in self.targets if target not in kept]
+
+        # stopped first, a new target with the same name adopts the events left in their spool
+        names = {config['name'] for config in configs}
+        for target in replaced:
+            target.stop(timeout)
+            if target.name not in names:
+                self.metrics.queue_depth.remove(target.name)
+        new_targets = []
+        for config in configs:
+            target = next((target for target in kept if target.name == config['name']), None)
+            if target is None:
+                target = self._create_target(config)
+                if self._started:
+                    target.start()
+            new_targets.append(target)
+        self.targets = new_targets
+        return sorted({target.name for target in replaced} | (names - set(current)))
+
+    def _create_target(self, config):
+        target_spool_dir = Path(self.spool_dir) / config['name'] if self.spool_dir else None
+        return WebhookTarget(config, spool_dir=target_spool_dir, metrics=self.metrics)
+
+    def send(self, event_type, job_data):
+        targets = [target for target in self.targets if target.accepts(event_type)]
+        if not targets:
+            logger.info(f"No webhook configured for {event_type}, skipping webhook")
+            return
+
+        # format once per payload type, shared by every target of that type
+        timestamp = datetime.now()
+        payloads = {}
+        for target in targets:
+            if target.webhook_type not in payloads:
+                payloads[target.webhook_type] = format_payload(target.webhook_type, event_type, job_data, timestamp)
+            target.enqueue(event_type, job_data['job_id'], payloads[target.webhook_type])